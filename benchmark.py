@@ -0,0 +1,491 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""
+Benchmarks for the protocol stack, using synthetic traffic composed with
+the MetaProtocolFactory. Every scenario is a stream of messages like a phone
+app would send them, fed into a headless WatchSimulator in chunks of random
+size (so most frames arrive split). Measured are:
+
+  - parse throughput per scenario (frames/s and kB/s)
+  - latency percentiles of every handler (dissected frames, no I/O)
+  - the cost of the CRC alone
+
+With --startup, the startup of metasimulator.py (with and without the GUI)
+and the import time of its heaviest dependencies are measured as well, each
+in a fresh interpreter.
+
+Results can be stored as a baseline and compared against later:
+
+    python benchmark.py --save-baseline baseline.json
+    python benchmark.py --compare baseline.json
+
+The comparison fails (exit status 1) if throughput drops or handler latency
+rises by more than the tolerance.
+"""
+
+import os
+import sys
+import gc
+import json
+import random
+import subprocess
+import struct
+import logging
+import argparse
+import datetime
+import timeit
+
+import protocol_constants as const
+
+from clock import VirtualClock
+from protocol import MetaProtocolFactory, ProtocolError, dissect
+from stats import percentile
+from simulator import WatchSimulator
+
+timer = timeit.default_timer
+
+# Seed of the traffic generator, so every run sees the same traffic
+SEED = 0x3a7c
+
+# Chunks are split at random positions, up to this size
+MAX_CHUNK = 64
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Modules whose import time is measured by the startup benchmark
+STARTUP_MODULES = ('wx', 'wx.propgrid', 'wx.lib.colourdb', 'numpy', 'serial',
+                   'simulator', 'fleet')
+
+
+class TrafficGenerator(object):
+    """Composes the messages of the different scenarios."""
+
+    def __init__(self, seed=SEED):
+        self.random = random.Random(seed)
+        self.factory = MetaProtocolFactory()
+
+    def build(self, name, option_bits=0, payload=None):
+        return self.factory._build_message(const.MESSAGE_TYPES_LOOKUP[name],
+                                           option_bits, payload)
+
+    def write_lcd(self, mode, row):
+        """Writes two rows of random pixels."""
+        lines = bytearray(self.random.getrandbits(8) for _ in xrange(24))
+        payload = bytearray((row, )) + lines[:12] + \
+            bytearray((row + 1, )) + lines[12:]
+        return self.build('writeLCD', mode, payload)
+
+    def lcd_burst(self):
+        """A full screen update of the application buffer."""
+        frames = [self.write_lcd(const.MODE_APP, row)
+                  for row in xrange(0, 96, 2)]
+        frames.append(self.build('updateLCD', const.MODE_APP))
+        return frames
+
+    def mode_switches(self):
+        return [self.build('updateLCD', mode)
+                for mode in (const.MODE_APP, const.MODE_NOTIFY,
+                             const.MODE_IDLE) * 16]
+
+    def vibrate(self):
+        return [self.build('setVibrate', 0, bytearray(struct.pack(
+                    '<BHHB', 1, self.random.randint(50, 500),
+                    self.random.randint(50, 500), self.random.randint(1, 5))))
+                for _ in xrange(32)]
+
+    def button_storm(self):
+        """Registers every button for every mode and press type, then
+        unregisters them again."""
+
+        frames = []
+
+        for mode in xrange(3):
+            for btn_id in const.BUTTON_REAL_IDS:
+                for btn_type in xrange(4):
+                    frames.append(self.build('enableButton', 0, bytearray(
+                        (mode, btn_id, btn_type, 0x34, btn_id))))
+
+        for mode in xrange(3):
+            for btn_id in const.BUTTON_REAL_IDS:
+                for btn_type in xrange(4):
+                    frames.append(self.build('disableButton', 0, bytearray(
+                        (mode, btn_id, btn_type))))
+
+        return frames
+
+    def rtc(self):
+        date = datetime.datetime(2012, 10, 18, 12, 30)
+        frames = []
+
+        for i in xrange(32):
+            date += datetime.timedelta(seconds=self.random.randint(1, 3600))
+            frames.append(self.build('setRTC', 0, bytearray(struct.pack(
+                '>H6B', date.year, date.month, date.day, date.weekday(),
+                date.hour, date.minute, date.second))))
+
+        return frames
+
+    def nval_sync(self):
+        """Reads every NVAL value (like a phone app does when it connects),
+        then writes some of them."""
+
+        frames = []
+
+        for identifier, name, size, default, valuetype in const.NVAL_VALUES:
+            if size is not None and default is not None:
+                frames.append(self.build('nval', const.NVAL_READ, bytearray(
+                    struct.pack('<HB', identifier, size))))
+
+        for i in xrange(16):
+            frames.append(self.build('nval', const.NVAL_WRITE, bytearray(
+                struct.pack('<HBH', 0x0005, 2, self.random.randint(1, 900)))))
+
+        return frames
+
+    def mixed(self):
+        frames = (self.lcd_burst() + self.mode_switches() + self.vibrate() +
+                  self.button_storm() + self.rtc() + self.nval_sync() +
+                  [self.build('getDeviceType'), self.build('setLED', 1)] * 8)
+        self.random.shuffle(frames)
+        return frames
+
+    def corrupted(self, rate=0.05):
+        """The mixed scenario with some frames damaged (one flipped bit)
+        and some garbage in between."""
+
+        frames = []
+
+        for frame in self.mixed():
+            if self.random.random() < rate:
+                frame = bytearray(frame)
+                frame[self.random.randrange(2, len(frame))] ^= \
+                    1 << self.random.randrange(8)
+                frame = bytes(frame)
+
+            if self.random.random() < rate:
+                frames.append(bytes(bytearray(
+                    self.random.getrandbits(8) for _ in xrange(8))))
+
+            frames.append(frame)
+
+        return frames
+
+    def chunks(self, frames):
+        """Joins the frames and splits them into chunks of random size."""
+
+        stream = b''.join(frames)
+        chunks = []
+        i = 0
+
+        while i < len(stream):
+            size = self.random.randint(1, MAX_CHUNK)
+            chunks.append(stream[i:i + size])
+            i += size
+
+        return chunks
+
+    SCENARIOS = ('lcd_burst', 'mode_switches', 'vibrate', 'button_storm',
+                 'rtc', 'nval_sync', 'mixed', 'corrupted')
+
+
+class BenchmarkFactory(MetaProtocolFactory):
+    def _send(self, message):
+        return message
+
+
+def new_simulator():
+    return WatchSimulator(BenchmarkFactory(), VirtualClock())
+
+
+def feed(simulator, chunks):
+    for chunk in chunks:
+        data = chunk
+
+        while True:
+            try:
+                simulator.parse(data)
+            except (NotImplementedError, ProtocolError, ValueError):
+                data = b''
+            else:
+                break
+
+    # Timers (vibration, mode timeouts) would pile up otherwise
+    simulator.clock.advance(simulator.clock.time() + 3600)
+
+
+def measure_throughput(chunks, min_time=0.5):
+    """Feeds the chunks into a simulator repeatedly for at least min_time
+    seconds, with the garbage collector off (like timeit does). Returns
+    (frames/s, bytes/s)."""
+
+    simulator = new_simulator()
+    size = sum(len(chunk) for chunk in chunks)
+
+    feed(simulator, chunks)     # warm-up
+    frames = simulator.framer.frames
+
+    gc.collect()
+    gc.disable()
+
+    try:
+        rounds = 0
+        start = timer()
+
+        while True:
+            feed(simulator, chunks)
+            rounds += 1
+            elapsed = timer() - start
+            if elapsed >= min_time:
+                break
+    finally:
+        gc.enable()
+
+    frames = simulator.framer.frames - frames
+
+    return frames / elapsed, rounds * size / elapsed
+
+
+def measure_handlers(frames, rounds=20):
+    """Times every handler call. Returns {message type: [seconds, ...]}."""
+
+    simulator = new_simulator()
+    messages = [dissect(frame) for frame in frames]
+    samples = {}
+
+    for _ in xrange(rounds):
+        for msgtype, option_bits, payload in messages:
+            start = timer()
+            simulator.handle(msgtype, option_bits, payload)
+            elapsed = timer() - start
+
+            samples.setdefault(const.MESSAGE_TYPE_NAMES[msgtype],
+                               []).append(elapsed)
+
+        simulator.clock.advance(simulator.clock.time() + 3600)
+
+    return samples
+
+
+def measure_crc(frames, rounds=50):
+    """Returns the average time the CRC of a frame takes."""
+
+    engine = WatchSimulator.crc_engine
+    bodies = [memoryview(frame)[:-2] for frame in frames]
+
+    start = timer()
+
+    for _ in xrange(rounds):
+        for body in bodies:
+            engine.checksum(body)
+
+    return (timer() - start) / (rounds * len(bodies))
+
+
+def measure_import(module):
+    """Returns the seconds needed to import a module in a fresh interpreter,
+    or None if it isn't installed."""
+
+    code = ("import time; start = time.time(); import %s; "
+            "print time.time() - start" % module)
+
+    with open(os.devnull, 'w') as devnull:
+        try:
+            output = subprocess.check_output([sys.executable, '-c', code],
+                                             stderr=devnull, cwd=HERE)
+        except subprocess.CalledProcessError:
+            return None
+
+    return float(output)
+
+
+def measure_startup(options, runs=5):
+    """Returns the median time metasimulator.py needs from being started
+    until it is ready and has exited again, or None if it fails (no
+    display, missing modules)."""
+
+    command = [sys.executable, os.path.join(HERE, 'metasimulator.py')] + \
+        options + ['--exit-after-startup']
+    times = []
+
+    with open(os.devnull, 'w') as devnull:
+        for _ in xrange(runs):
+            start = timer()
+
+            if subprocess.call(command, stdout=devnull, stderr=devnull,
+                               cwd=HERE):
+                return None
+
+            times.append(timer() - start)
+
+    return percentile(times, 0.5)
+
+
+def run_startup(runs=5):
+    return {
+        'headless_secs': measure_startup(['--headless'], runs),
+        'gui_secs': measure_startup([], runs),
+        'imports': dict((module, measure_import(module))
+                        for module in STARTUP_MODULES),
+    }
+
+
+def run(min_time=0.5):
+    """Runs all benchmarks and returns the results as a dict."""
+
+    generator = TrafficGenerator()
+    results = {'scenarios': {}, 'handlers': {}}
+
+    for name in TrafficGenerator.SCENARIOS:
+        frames = getattr(generator, name)()
+        fps, bps = measure_throughput(generator.chunks(frames), min_time)
+
+        results['scenarios'][name] = {
+            'frames_per_sec': fps,
+            'kbytes_per_sec': bps / 1024.0,
+        }
+
+    mixed = generator.mixed()
+
+    for name, samples in measure_handlers(mixed).iteritems():
+        results['handlers'][name] = {
+            'p50_usec': percentile(samples, 0.5) * 1e6,
+            'p90_usec': percentile(samples, 0.9) * 1e6,
+            'p99_usec': percentile(samples, 0.99) * 1e6,
+        }
+
+    crc_time = measure_crc(mixed)
+
+    results['crc'] = {
+        'usec_per_frame': crc_time * 1e6,
+        'share_of_parse': crc_time * results['scenarios']['mixed']
+                                            ['frames_per_sec'],
+    }
+
+    return results
+
+
+def report(results):
+    print "%-16s %12s %12s" % ("Scenario", "frames/s", "kB/s")
+
+    for name in TrafficGenerator.SCENARIOS:
+        result = results['scenarios'][name]
+        print "%-16s %12.0f %12.1f" % (
+            name, result['frames_per_sec'], result['kbytes_per_sec'])
+
+    print
+    print "%-16s %12s %12s %12s" % ("Handler", "p50 usec", "p90 usec",
+                                    "p99 usec")
+
+    for name, result in sorted(results['handlers'].iteritems()):
+        print "%-16s %12.2f %12.2f %12.2f" % (
+            name, result['p50_usec'], result['p90_usec'], result['p99_usec'])
+
+    print
+    print "CRC: %.2f usec/frame, %.0f%% of the parse time (mixed)" % (
+        results['crc']['usec_per_frame'],
+        results['crc']['share_of_parse'] * 100)
+
+    startup = results.get('startup')
+
+    if startup:
+        print
+
+        for name in ('headless', 'gui'):
+            secs = startup[name + '_secs']
+            print "Startup (%s): %s" % (name, "failed" if secs is None
+                                        else "%.3f secs" % secs)
+
+        for module in STARTUP_MODULES:
+            secs = startup['imports'][module]
+            print "  import %-16s %s" % (module, "not installed" if secs is None
+                                         else "%.3f secs" % secs)
+
+
+def compare(baseline, results, tolerance):
+    """Returns a list of regressions (as text) against the baseline."""
+
+    regressions = []
+
+    for name, result in results['scenarios'].iteritems():
+        expected = baseline['scenarios'].get(name)
+        if expected and result['frames_per_sec'] < \
+                expected['frames_per_sec'] * (1 - tolerance):
+            regressions.append("%s: %.0f frames/s (baseline %.0f)" % (
+                name, result['frames_per_sec'], expected['frames_per_sec']))
+
+    for name, result in results['handlers'].iteritems():
+        expected = baseline['handlers'].get(name)
+        if expected and result['p50_usec'] > \
+                expected['p50_usec'] * (1 + tolerance):
+            regressions.append("handle_%s: p50 %.2f usec (baseline %.2f)" % (
+                name, result['p50_usec'], expected['p50_usec']))
+
+    startup, expected = results.get('startup'), baseline.get('startup')
+
+    if startup and expected:
+        for name in ('headless_secs', 'gui_secs'):
+            if startup[name] and expected[name] and \
+                    startup[name] > expected[name] * (1 + tolerance):
+                regressions.append("startup: %s %.3f (baseline %.3f)" % (
+                    name, startup[name], expected[name]))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the protocol "
+                                     "stack with synthetic traffic.")
+    parser.add_argument('--min-time', type=float, default=0.5,
+                        help="seconds per throughput measurement "
+                        "(default: 0.5)")
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help="store the results as a baseline")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="compare the results against a baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed regression (default: 0.2 = 20%%)")
+    parser.add_argument('--startup', action='store_true',
+                        help="benchmark the startup of metasimulator.py too")
+    args = parser.parse_args()
+
+    # The simulator logs every message at INFO level
+    logging.basicConfig(level=logging.WARNING)
+
+    results = run(args.min_time)
+
+    if args.startup:
+        results['startup'] = run_startup()
+
+    report(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+
+        print
+
+        if regressions:
+            print "Regressions:"
+            for regression in regressions:
+                print "  " + regression
+            sys.exit(1)
+
+        print "No regressions against %s" % args.compare
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""
+This module records serial sessions and replays them into a simulator.
+
+A capture file starts with a header (magic, version, start time) followed
+by one record per chunk of traffic:
+
+    offset (double, seconds since the start), direction (byte),
+    length (unsigned short), data
+
+RX records hold the data received by the watch, exactly as it was read
+from the port (so replays exercise the frame reassembly, too), TX records
+hold one message sent by the watch, BUTTON records a side button being
+pressed (its letter followed by 1) or released (followed by 0). All
+numbers are little-endian.
+
+Replays run the simulator on a virtual clock which follows the timestamps
+of the capture, so timeouts fire and buttons are held for the same time
+whether the session is replayed at original speed or as fast as possible;
+an hour-long session takes seconds. The resulting watch state can be
+compared against a golden snapshot:
+
+    python capture.py replay session.mwcap --save-golden session.json
+    python capture.py replay session.mwcap --golden session.json --fast
+
+"""
+
+import sys
+import time
+import json
+import struct
+import logging
+import argparse
+import binascii
+import threading
+import collections
+
+from clock import VirtualClock
+from protocol import MetaProtocolFactory, ProtocolError
+from simulator import WatchSimulator
+
+MAGIC = b'MWCAP'
+VERSION = 2
+
+# Versions which can be read (version 1 has no BUTTON records)
+VERSIONS = (1, 2)
+
+HEADER = struct.Struct('<5sBd')
+RECORD = struct.Struct('<dBH')
+
+RX = 0
+TX = 1
+BUTTON = 2
+
+DIRECTIONS = ('RX', 'TX', 'BUTTON')
+
+Record = collections.namedtuple('Record', 'time direction data')
+
+
+class CaptureError(Exception): pass
+
+
+class CaptureWriter(object):
+    """Appends records to a capture file. Can be used from several threads
+    (the serial thread records RX, the GUI thread TX)."""
+
+    def __init__(self, fileobj, start=None):
+        if isinstance(fileobj, basestring):
+            fileobj = open(fileobj, 'wb')
+
+        self.file = fileobj
+        self.start = time.time() if start is None else start
+        self.lock = threading.Lock()
+        self.records = 0
+
+        self.file.write(HEADER.pack(MAGIC, VERSION, self.start))
+
+    def write(self, direction, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        header = RECORD.pack(timestamp - self.start, direction, len(data))
+
+        with self.lock:
+            self.file.write(header)
+            self.file.write(data)
+            self.records += 1
+
+    def write_button(self, btn, pressed, timestamp=None):
+        self.write(BUTTON, btn + (b'\x01' if pressed else b'\x00'),
+                   timestamp)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class CaptureReader(object):
+    """Iterates over the records of a capture file. Record times are
+    seconds since start (the time the capture was started)."""
+
+    def __init__(self, fileobj):
+        if isinstance(fileobj, basestring):
+            fileobj = open(fileobj, 'rb')
+
+        self.file = fileobj
+
+        header = self.file.read(HEADER.size)
+
+        if len(header) < HEADER.size:
+            raise CaptureError("Not a capture file (too short)")
+
+        magic, version, self.start = HEADER.unpack(header)
+
+        if magic != MAGIC:
+            raise CaptureError("Not a capture file (bad magic)")
+        if version not in VERSIONS:
+            raise CaptureError("Unsupported capture version %d" % version)
+
+    def __iter__(self):
+        read = self.file.read
+
+        while True:
+            header = read(RECORD.size)
+
+            if not header:
+                return
+
+            if len(header) < RECORD.size:
+                raise CaptureError("Truncated record header")
+
+            offset, direction, length = RECORD.unpack(header)
+            data = read(length)
+
+            if len(data) < length:
+                raise CaptureError("Truncated record")
+
+            yield Record(offset, direction, data)
+
+
+class ReplayFactory(MetaProtocolFactory):
+    """Counts the messages the simulator sends during a replay."""
+
+    def __init__(self):
+        MetaProtocolFactory.__init__(self)
+        self.sent = 0
+
+    def _send(self, message):
+        self.sent += 1
+        return message
+
+
+def _feed(simulator, data):
+    """Passes received data to the simulator, skipping messages which
+    can't be handled. Returns the number of skipped messages."""
+
+    errors = 0
+
+    while True:
+        try:
+            simulator.parse(data)
+        except (NotImplementedError, ProtocolError, ValueError):
+            errors += 1
+        else:
+            return errors
+
+        data = b''
+
+
+def replay(reader, speed=None, simulator=None, run_on=0):
+    """Feeds the RX and BUTTON records of a capture into a simulator, at
+    original speed (speed=1), N times faster (speed=N) or as fast as
+    possible (speed None). Without a simulator, a new one is created. With
+    a virtual clock, the simulated time goes on for run_on seconds after
+    the last record, so pending timeouts (like the buffer timeouts) can
+    fire. Returns the simulator and a dict of statistics."""
+
+    if simulator is None:
+        simulator = WatchSimulator(ReplayFactory(), VirtualClock(reader.start))
+
+    clock = simulator.clock
+    frames = simulator.framer.frames
+
+    stats = dict(records=0, bytes=0, errors=0, tx_recorded=0, buttons=0)
+
+    started = time.time()
+    end = reader.start
+
+    for record in reader:
+        if record.direction == TX:
+            stats['tx_recorded'] += 1
+            continue
+
+        if speed:
+            delay = started + record.time / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        end = reader.start + record.time
+
+        if isinstance(clock, VirtualClock):
+            clock.advance(end)
+
+        if record.direction == BUTTON:
+            btn, pressed = record.data[:-1], record.data[-1:] != b'\x00'
+
+            if pressed:
+                simulator.button_down(btn)
+            else:
+                simulator.button_up(btn)
+
+            stats['buttons'] += 1
+            continue
+
+        stats['errors'] += _feed(simulator, record.data)
+        stats['records'] += 1
+        stats['bytes'] += len(record.data)
+
+    if run_on and isinstance(clock, VirtualClock):
+        clock.advance(end + run_on)
+
+    elapsed = max(time.time() - started, 1e-9)
+
+    stats['simulated'] = clock.time() - reader.start
+    stats['frames'] = simulator.framer.frames - frames
+    stats['corrupted'] = simulator.framer.corrupted
+    stats['elapsed'] = elapsed
+    stats['frames_per_sec'] = stats['frames'] / elapsed
+    stats['tx_generated'] = getattr(simulator.factory, 'sent', None)
+
+    return simulator, stats
+
+
+def snapshot(simulator):
+    """Returns the watch state as a dict which can be stored as JSON."""
+
+    state = simulator.state
+
+    return {
+        'display_buffers': [binascii.hexlify(buffer.data)
+                            for buffer in state.display_buffers],
+        'active_buffer': state.active_buffer,
+        'button_mapping': sorted(list(key) + list(value) for key, value
+                                 in state.button_mapping.iteritems()),
+        'nvals': dict(('0x%04x' % identifier, value) for identifier, value
+                      in state.nvals.iteritems()),
+        'rtc_offset': int(round(state.rtc_offset.total_seconds())),
+        'vibrating': state.vibrating,
+        'led': state.led,
+    }
+
+
+def compare_snapshots(expected, actual):
+    """Returns the names of all parts of the state which differ."""
+
+    # Round-trip through JSON, so tuples and lists compare equal
+    actual = json.loads(json.dumps(actual))
+
+    return sorted(key for key in set(expected) | set(actual)
+                  if expected.get(key) != actual.get(key))
+
+
+def dump(reader):
+    for record in reader:
+        print "%10.6f %s %s" % (record.time, DIRECTIONS[record.direction],
+                                ' '.join("%02X" % byte
+                                         for byte in bytearray(record.data)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dumps or replays captured "
+                                     "serial sessions.")
+    commands = parser.add_subparsers(dest='command')
+
+    command = commands.add_parser('dump', help="print all records")
+    command.add_argument('capture')
+
+    command = commands.add_parser('replay', help="replay into a simulator")
+    command.add_argument('capture')
+    speed = command.add_mutually_exclusive_group()
+    speed.add_argument('--speed', type=float, default=1.0,
+                       help="replay N times faster (default: 1)")
+    speed.add_argument('--fast', action='store_true',
+                       help="replay as fast as possible")
+    command.add_argument('--run-on', type=float, default=0.0, metavar='SECS',
+                         help="let the simulated time go on for SECS after "
+                         "the last record")
+    command.add_argument('--golden', metavar='FILE',
+                         help="verify the final state against a snapshot")
+    command.add_argument('--save-golden', metavar='FILE',
+                         help="store the final state as a snapshot")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout,
+                        format="%(levelname)s - %(name)s -> %(message)s",
+                        level=logging.WARNING)
+
+    reader = CaptureReader(args.capture)
+
+    if args.command == 'dump':
+        dump(reader)
+        return
+
+    simulator, stats = replay(reader, None if args.fast else args.speed,
+                              run_on=args.run_on)
+
+    print ("Replayed %(records)d records, %(frames)d frames (%(bytes)d "
+           "bytes) and %(buttons)d button events in %(elapsed).3f secs "
+           "(%(simulated).1f secs simulated): %(frames_per_sec).0f frames/s, "
+           "%(errors)d errors, %(corrupted)d corrupted, %(tx_generated)d/"
+           "%(tx_recorded)d messages sent (replay/capture)" % stats)
+
+    state = snapshot(simulator)
+
+    if args.save_golden:
+        with open(args.save_golden, 'w') as f:
+            json.dump(state, f, indent=4, sort_keys=True)
+
+    if args.golden:
+        with open(args.golden) as f:
+            differences = compare_snapshots(json.load(f), state)
+
+        if differences:
+            print "State differs from snapshot: %s" % ', '.join(differences)
+            sys.exit(1)
+
+        print "State matches snapshot"
+
+
+if __name__ == '__main__':
+    main()
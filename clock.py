@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""This module contains the time source of the simulator. Everything in the
+watch which depends on time (RTC, timeouts, vibration, button hold times)
+asks its clock, so the clock can be replaced: the GUI uses one which
+schedules timers with wx, headless simulators run the timers themselves."""
+
+import time
+import heapq
+import datetime
+
+
+class Timer(object):
+    """Handle of a scheduled call, returned by Clock.call_later."""
+
+    def __init__(self, deadline, func, args):
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Clock(object):
+    """Wall-clock time source. Timers are kept in a heap and are run by
+    run_due(), which has to be called regularly by whoever drives the
+    simulator (usually an event loop which sleeps until next_timeout())."""
+
+    def __init__(self):
+        self.timers = []
+
+    def time(self):
+        """Current time in seconds since the epoch."""
+        return time.time()
+
+    def now(self):
+        """Current local time as a datetime."""
+        return datetime.datetime.fromtimestamp(self.time())
+
+    def call_later(self, delay, func, *args):
+        """Calls func(*args) after delay seconds. Returns a Timer which can
+        be cancelled."""
+
+        timer = Timer(self.time() + delay, func, args)
+        heapq.heappush(self.timers, timer)
+
+        return timer
+
+    def next_timeout(self):
+        """Seconds until the next timer expires, or None if there is none."""
+
+        while self.timers and self.timers[0].cancelled:
+            heapq.heappop(self.timers)
+
+        if not self.timers:
+            return None
+
+        return max(0, self.timers[0].deadline - self.time())
+
+    def run_due(self):
+        """Runs all timers which have expired."""
+
+        now = self.time()
+
+        while self.timers and self.timers[0].deadline <= now:
+            timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                timer.func(*timer.args)
+
+
+class VirtualClock(Clock):
+    """Clock which only moves when it is told to. Timers are run by
+    advance(), in the order of their deadlines and with the clock set to
+    each deadline, so the simulation is the same no matter how fast (or
+    slow) the clock is advanced."""
+
+    def __init__(self, start=0.0):
+        Clock.__init__(self)
+        self.current = start
+
+    def time(self):
+        return self.current
+
+    def advance(self, until):
+        """Moves the clock forward to the given time (in seconds since the
+        epoch), running all timers which expire on the way."""
+
+        while self.timers and self.timers[0].deadline <= until:
+            timer = heapq.heappop(self.timers)
+            self.current = max(self.current, timer.deadline)
+
+            if not timer.cancelled:
+                timer.func(*timer.args)
+
+        self.current = max(self.current, until)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""This module contains a minimal single-threaded event loop, used to run
+simulators without the GUI. It waits for file descriptors with poll() and
+runs the timers of a simulator clock in between, so any number of links
+can be served by one thread.
+
+With a VirtualClock, the loop runs in virtual time: it never sleeps until
+a timer expires, but advances the clock to it as soon as there are no
+events waiting. Timeouts of the watch take no time at all, so long
+(scripted) sessions run as fast as the other end sends its messages."""
+
+import select
+import logging
+
+from clock import Clock, VirtualClock
+
+POLL_READ = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+POLL_WRITE = select.POLLOUT
+
+
+class EventLoop(object):
+    """Calls back when registered file descriptors become readable or
+    writable, and runs the timers of its clock."""
+
+    def __init__(self, clock=None):
+        self.clock = clock or Clock()
+        self.virtual = isinstance(self.clock, VirtualClock)
+        self.logger = logging.getLogger('eventloop')
+
+        self._poll = select.poll()
+        self._readers = {}
+        self._writers = {}
+        self._running = False
+
+    def _update(self, fd):
+        mask = 0
+
+        if fd in self._readers:
+            mask |= POLL_READ
+        if fd in self._writers:
+            mask |= POLL_WRITE
+
+        if mask:
+            self._poll.register(fd, mask)
+        else:
+            try:
+                self._poll.unregister(fd)
+            except KeyError:
+                pass
+
+    def add_reader(self, fd, callback, *args):
+        self._readers[fd] = (callback, args)
+        self._update(fd)
+
+    def remove_reader(self, fd):
+        self._readers.pop(fd, None)
+        self._update(fd)
+
+    def add_writer(self, fd, callback, *args):
+        self._writers[fd] = (callback, args)
+        self._update(fd)
+
+    def remove_writer(self, fd):
+        self._writers.pop(fd, None)
+        self._update(fd)
+
+    def call_later(self, delay, func, *args):
+        return self.clock.call_later(delay, func, *args)
+
+    def run_once(self, timeout=None):
+        """Waits for events (at most timeout seconds, or until the next
+        timer expires) and handles them. In virtual time, the clock is
+        advanced instead of waiting."""
+
+        next_timer = self.clock.next_timeout()
+
+        if next_timer is not None:
+            timeout = next_timer if timeout is None else min(timeout, next_timer)
+
+        if self.virtual and timeout is not None:
+            events = self._poll.poll(0)
+
+            if not events:
+                self.clock.advance(self.clock.time() + timeout)
+                return
+        else:
+            events = self._poll.poll(-1 if timeout is None else timeout * 1000)
+
+        for fd, mask in events:
+            if mask & POLL_READ and fd in self._readers:
+                callback, args = self._readers[fd]
+                self._call(callback, args)
+
+            if mask & POLL_WRITE and fd in self._writers:
+                callback, args = self._writers[fd]
+                self._call(callback, args)
+
+        self.clock.run_due()
+
+    def _call(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            self.logger.exception("Unhandled exception in callback")
+
+    def run(self):
+        """Runs until stop() is called."""
+
+        self._running = True
+
+        while self._running:
+            self.run_once()
+
+    def run_until(self, condition, timeout=None):
+        """Runs until condition() returns something true, or until timeout
+        seconds have passed. Returns the last result of condition()."""
+
+        deadline = None if timeout is None else self.clock.time() + timeout
+
+        result = condition()
+
+        while not result:
+            remaining = None
+
+            if deadline is not None:
+                remaining = deadline - self.clock.time()
+                if remaining <= 0:
+                    break
+
+            self.run_once(remaining)
+            result = condition()
+
+        return result
+
+    def stop(self):
+        self._running = False
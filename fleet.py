@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""
+Fleet mode: runs any number of simulated watches in a single process and a
+single thread, without the GUI. Every watch gets its own pseudo-terminal
+(or TCP port), its own watch state and its own statistics; the protocol
+tables (CRC, handler dispatch, prebuilt messages) are shared by all of them.
+
+    python fleet.py -n 200 --link-dir /tmp/watches
+    python fleet.py -n 50 --tcp 7000
+
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import resource
+import collections
+
+import capture
+import latency
+
+from stats import percentile
+from simulator import WatchSimulator
+from eventloop import EventLoop
+from transport import LinkFactory, MetaWatchProtocol, open_pty, open_serial, \
+    create_server
+
+# Number of latency samples kept per watch
+LATENCY_SAMPLES = 256
+
+
+class LinkStats(object):
+    """Traffic counters of a single watch. Latencies are measured from
+    receiving a chunk to writing the responses it caused, in seconds."""
+
+    def __init__(self):
+        self.frames_in = 0
+        self.frames_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+
+class FleetFactory(LinkFactory):
+    """Counts (and records) the messages sent by a watch."""
+
+    def __init__(self, link_stats):
+        LinkFactory.__init__(self)
+        self.link_stats = link_stats
+        self.capture = None
+
+    def _send(self, message):
+        self.link_stats.frames_out += 1
+        self.link_stats.bytes_out += len(message)
+
+        if self.capture is not None:
+            self.capture.write(capture.TX, message)
+
+        return LinkFactory._send(self, message)
+
+
+class FleetWatch(MetaWatchProtocol):
+    """A simulated watch of the fleet. The watch keeps its state when the
+    connection is replaced."""
+
+    def __init__(self, loop, name):
+        self.name = name
+        self.link_stats = LinkStats()
+
+        factory = FleetFactory(self.link_stats)
+        simulator = WatchSimulator(factory, loop.clock)
+
+        MetaWatchProtocol.__init__(self, simulator, factory)
+
+    @property
+    def capture(self):
+        return self.factory.capture
+
+    @capture.setter
+    def capture(self, writer):
+        self.factory.capture = writer
+
+    @property
+    def simulator(self):
+        return self.parser
+
+    def connection_made(self, transport):
+        MetaWatchProtocol.connection_made(self, transport)
+
+        peer = transport.get_extra_info('peername')
+        if peer:
+            self.logger.info("%s: connection from %r", self.name, peer)
+
+    def data_received(self, data):
+        received = time.time()
+
+        if self.capture is not None:
+            self.capture.write(capture.RX, data, received)
+        frames = self.framer.frames
+        errors = self.errors
+        sent = self.link_stats.frames_out
+
+        MetaWatchProtocol.data_received(self, data)
+
+        self.link_stats.bytes_in += len(data)
+        self.link_stats.frames_in += self.framer.frames - frames
+        self.link_stats.errors += self.errors - errors
+
+        # The transport writes the responses right after this returns
+        if self.link_stats.frames_out != sent:
+            self.link_stats.latencies.append(time.time() - received)
+
+
+class Fleet(object):
+    """Hosts a number of watches on one event loop."""
+
+    def __init__(self, loop=None):
+        self.loop = loop or EventLoop()
+        self.logger = logging.getLogger('fleet')
+        self.watches = []
+        self.servers = []
+        self._last_report = (time.time(), 0, 0)
+
+    def add_pty_watch(self, link=None):
+        """Adds a watch on a new pseudo-terminal. Returns its path (which
+        is linked to link, if given)."""
+
+        watch = FleetWatch(self.loop, None)
+        transport, _ = open_pty(self.loop, lambda: watch, link)
+
+        watch.name = transport.get_extra_info('name')
+        self.watches.append(watch)
+
+        return watch.name
+
+    def add_serial_watch(self, port, baudrate=115200):
+        """Adds a watch on a (real or virtual) serial port."""
+
+        watch = FleetWatch(self.loop, port)
+        open_serial(self.loop, lambda: watch, port, baudrate)
+
+        self.watches.append(watch)
+
+        return watch.name
+
+    def add_tcp_watch(self, host, port):
+        """Adds a watch which accepts one TCP connection at a time (a
+        virtual serial cable). A new connection replaces the old one."""
+
+        watch = FleetWatch(self.loop, '%s:%d' % (host, port))
+
+        self.servers.append(create_server(self.loop, lambda: watch,
+                                          host, port, backlog=1))
+        self.watches.append(watch)
+
+        return watch.name
+
+    def report(self, verbose=False):
+        """Logs aggregate (and optionally per-watch) statistics. Rates are
+        calculated since the previous report."""
+
+        now = time.time()
+        last_time, last_in, last_out = self._last_report
+        elapsed = max(now - last_time, 1e-6)
+
+        frames_in = sum(w.link_stats.frames_in for w in self.watches)
+        frames_out = sum(w.link_stats.frames_out for w in self.watches)
+        errors = sum(w.link_stats.errors for w in self.watches)
+        latencies = [l for w in self.watches for l in w.link_stats.latencies]
+
+        self._last_report = (now, frames_in, frames_out)
+
+        self.logger.info(
+            "%d watches: %.0f frames/s in, %.0f frames/s out, %d errors, "
+            "latency p50 %.2f ms, p99 %.2f ms",
+            len(self.watches),
+            (frames_in - last_in) / elapsed, (frames_out - last_out) / elapsed,
+            errors, percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000)
+
+        if verbose:
+            for watch in self.watches:
+                stats = watch.link_stats
+                self.logger.info(
+                    "  %s: %d/%d frames, %d/%d bytes in/out, %d errors, "
+                    "latency p50 %.2f ms", watch.name, stats.frames_in,
+                    stats.frames_out, stats.bytes_in, stats.bytes_out,
+                    stats.errors, percentile(stats.latencies, 0.5) * 1000)
+
+    def run(self, interval=None, verbose=False):
+        """Runs the event loop, reporting statistics every interval secs."""
+
+        def periodic_report():
+            self.report(verbose)
+            self.loop.call_later(interval, periodic_report)
+
+        if interval:
+            self.loop.call_later(interval, periodic_report)
+
+        self.loop.run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a fleet of headless "
+                                     "simulated watches.")
+    parser.add_argument('-n', '--watches', type=int, default=10,
+                        help="number of watches (default: 10)")
+    parser.add_argument('--tcp', type=int, metavar='PORT',
+                        help="listen on TCP ports PORT, PORT+1, ... instead "
+                        "of creating pseudo-terminals")
+    parser.add_argument('--bind', default='127.0.0.1',
+                        help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument('--link-dir', metavar='DIR',
+                        help="create symlinks watch0, watch1, ... to the "
+                        "pseudo-terminals in DIR")
+    parser.add_argument('--interval', type=float, default=5.0,
+                        help="statistics interval in seconds (default: 5)")
+    parser.add_argument('--capture-dir', metavar='DIR',
+                        help="record the traffic of every watch to "
+                        "DIR/watch0.mwcap, ... (see capture.py)")
+    parser.add_argument('--latency', metavar='MODEL', type=latency.from_spec,
+                        help="delay the responses: fixed:SECS, "
+                        "jitter:SECS,SECS or capture:FILE (see latency.py)")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="report statistics for every watch")
+    parser.add_argument('--debug', action='store_true',
+                        help="log every message")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout,
+                        format="%(levelname)s - %(name)s -> %(message)s",
+                        level=logging.DEBUG if args.debug else logging.INFO)
+
+    if not args.debug:
+        logging.getLogger('parser').setLevel(logging.WARNING)
+
+    fleet = Fleet()
+    logger = fleet.logger
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    for i in xrange(args.watches):
+        if args.tcp:
+            name = fleet.add_tcp_watch(args.bind, args.tcp + i)
+        else:
+            link = None
+            if args.link_dir:
+                link = os.path.join(args.link_dir, 'watch%d' % i)
+            name = fleet.add_pty_watch(link)
+
+        fleet.watches[-1].simulator.latency = args.latency
+
+        if args.capture_dir:
+            fleet.watches[-1].capture = capture.CaptureWriter(
+                os.path.join(args.capture_dir, 'watch%d.mwcap' % i))
+
+        logger.debug("watch %d: %s", i, name)
+
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    logger.info("Started %d watches (%s ... %s), about %.1f KB each",
+                args.watches, fleet.watches[0].name, fleet.watches[-1].name,
+                float(rss_after - rss_before) / max(args.watches, 1))
+
+    try:
+        fleet.run(args.interval, args.verbose)
+    except KeyboardInterrupt:
+        fleet.report(args.verbose)
+
+    for watch in fleet.watches:
+        if watch.capture is not None:
+            watch.capture.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""This module contains the display buffer of the digital watch. The watch
+state is kept in the compact wire format, the RGB image needed by the GUI
+is derived from it on demand (using numpy, which is only imported then).
+
+Rows are rasterized without touching single pixels: all rows which changed
+are converted at once, by looking up every packed byte in a table of its
+eight RGB pixels (see rgb_lookup)."""
+
+WIDTH = 96
+HEIGHT = 96
+
+# Bytes per row
+STRIDE = WIDTH // 8
+
+# Display colour of unset and set pixels
+PIXEL_VALUES = (255, 0)
+
+_rgb_lookup = None
+
+
+def rgb_lookup():
+    """Returns the table which maps every possible byte of a packed row to
+    its eight RGB pixels, shape (256, 8, 3). The least significant bit is
+    the leftmost pixel (unpackbits starts with the most significant one,
+    hence the reversal). Built on first use."""
+
+    global _rgb_lookup
+
+    if _rgb_lookup is None:
+        import numpy
+
+        values = numpy.array(PIXEL_VALUES, dtype='uint8')
+        bits = numpy.unpackbits(
+            numpy.arange(256, dtype='uint8')[:, numpy.newaxis], axis=1)[:, ::-1]
+        _rgb_lookup = numpy.repeat(values[bits][:, :, numpy.newaxis], 3,
+                                   axis=2)
+
+    return _rgb_lookup
+
+
+class FrameBuffer(object):
+    """Monochrome display buffer, stored with one bit per pixel (1152
+    bytes) in the same layout as the writeLCD payload: 12 bytes per row,
+    the least significant bit is the leftmost pixel and a set bit is a
+    black pixel. Writing a row is a plain 12 byte copy.
+
+    The RGB representation is only allocated once it is requested, and is
+    kept up to date incrementally: rgb() only expands the rows which have
+    been written since its last call. Until then, no rows are tracked, so
+    a buffer which is never displayed stays small."""
+
+    def __init__(self):
+        self.data = bytearray(HEIGHT * STRIDE)
+        self.dirty = set()
+        self._rgb = None
+
+    def clear(self):
+        """Blanks the display (all pixels white)."""
+        self.data[:] = bytearray(HEIGHT * STRIDE)
+
+        if self._rgb is not None:
+            self.dirty.update(xrange(HEIGHT))
+
+    def write_row(self, row, line):
+        """Replaces a single row with 12 bytes of packed pixel data. Rows
+        outside of the display raise a ValueError."""
+
+        if not 0 <= row < HEIGHT:
+            raise ValueError("Invalid display row %d" % row)
+
+        offset = row * STRIDE
+        self.data[offset:offset + STRIDE] = line
+
+        if self._rgb is not None:
+            self.dirty.add(row)
+
+    def write_rows(self, index, rows):
+        """Replaces any number of rows. The packed rows are passed as one
+        concatenated string, index holds their row numbers. If any row is
+        outside of the display, nothing is written and a ValueError is
+        raised."""
+
+        for row in index:
+            if not 0 <= row < HEIGHT:
+                raise ValueError("Invalid display row %d" % row)
+
+        data = self.data
+
+        for i, row in enumerate(index):
+            offset = row * STRIDE
+            data[offset:offset + STRIDE] = rows[i * STRIDE:(i + 1) * STRIDE]
+
+        if self._rgb is not None:
+            self.dirty.update(index)
+
+    def expand(self):
+        """Brings the RGB array up to date and returns the (sorted) list of
+        rows which have changed since the last call."""
+
+        import numpy
+
+        if self._rgb is None:
+            self._rgb = numpy.empty((HEIGHT, WIDTH, 3), dtype='uint8')
+            self.dirty.update(xrange(HEIGHT))
+
+        if not self.dirty:
+            return []
+
+        rows = sorted(self.dirty)
+        packed = numpy.frombuffer(self.data, dtype='uint8')
+        packed = packed.reshape(HEIGHT, STRIDE)[rows]
+
+        self._rgb[rows] = rgb_lookup()[packed].reshape(-1, WIDTH, 3)
+        self.dirty.clear()
+
+        return rows
+
+    def rgb(self):
+        """Returns the buffer as a (96, 96, 3) RGB array. The array is
+        owned by the frame buffer and updated in place."""
+
+        self.expand()
+        return self._rgb
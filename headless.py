@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""
+Runs a single simulated watch without the GUI, started with
+metasimulator.py --headless. Neither wx nor numpy are imported. The watch
+is attached to a serial port, a new pseudo-terminal or a TCP port and runs
+until it is interrupted:
+
+    python metasimulator.py --headless --port /dev/rfcomm0
+    python metasimulator.py --headless --link /tmp/watch
+
+With --virtual-time, the watch runs on a virtual clock (see the eventloop
+module): its RTC, timeouts, vibration and LED only follow the messages it
+gets, and whenever it waits for a timeout, that time passes instantly.
+
+"""
+
+import sys
+import time
+import logging
+import argparse
+
+import capture
+import latency
+import nvalstore
+
+from fleet import Fleet
+from clock import VirtualClock
+from eventloop import EventLoop
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='metasimulator.py --headless',
+                                     description="Runs a simulated watch "
+                                     "without the GUI.")
+    parser.add_argument('--headless', action='store_true',
+                        help=argparse.SUPPRESS)
+    link = parser.add_mutually_exclusive_group()
+    link.add_argument('--port', help="serial port to use (default: a new "
+                      "pseudo-terminal)")
+    link.add_argument('--tcp', type=int, metavar='PORT',
+                      help="listen on a TCP port instead")
+    parser.add_argument('--baudrate', type=int, default=115200,
+                        help="baud rate of the serial port")
+    parser.add_argument('--link', metavar='PATH',
+                        help="create a symlink to the pseudo-terminal")
+    parser.add_argument('--bind', default='127.0.0.1',
+                        help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument('--capture', metavar='FILE',
+                        help="record the serial traffic (see capture.py)")
+    parser.add_argument('--latency', metavar='MODEL', type=latency.from_spec,
+                        help="delay the responses: fixed:SECS, "
+                        "jitter:SECS,SECS or capture:FILE (see latency.py)")
+    parser.add_argument('--nval-file', metavar='FILE',
+                        help="keep the NVAL values in FILE, so they survive "
+                        "restarts")
+    parser.add_argument('--stats', metavar='FILE',
+                        help="collect statistics and write them to FILE (as "
+                        "JSON) on exit")
+    parser.add_argument('--virtual-time', action='store_true',
+                        help="run on a virtual clock, which skips ahead "
+                        "whenever the watch is idle")
+    parser.add_argument('--debug', action='store_true',
+                        help="log every message")
+    parser.add_argument('--exit-after-startup', action='store_true',
+                        help="exit as soon as the watch is ready (used to "
+                        "benchmark the startup)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stdout,
+                        format="%(levelname)s - %(name)s -> %(message)s",
+                        level=logging.DEBUG if args.debug else logging.INFO)
+
+    if args.virtual_time:
+        fleet = Fleet(EventLoop(VirtualClock(time.time())))
+    else:
+        fleet = Fleet()
+
+    if args.port:
+        name = fleet.add_serial_watch(args.port, args.baudrate)
+    elif args.tcp:
+        name = fleet.add_tcp_watch(args.bind, args.tcp)
+    else:
+        name = fleet.add_pty_watch(args.link)
+
+    watch = fleet.watches[0]
+
+    if args.capture:
+        watch.capture = capture.CaptureWriter(args.capture)
+
+    watch.simulator.latency = args.latency
+
+    if args.nval_file:
+        watch.simulator.nval_store = nvalstore.MappedNVALStore(args.nval_file)
+        watch.simulator.reset()
+
+    if args.stats:
+        watch.simulator.enable_stats()
+
+    fleet.logger.info("Simulated watch ready on %s", name)
+
+    if args.exit_after_startup:
+        return 0
+
+    try:
+        fleet.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if watch.capture is not None:
+            watch.capture.close()
+
+        watch.simulator.flush_nvals()
+        watch.simulator.state.nvals.close()
+
+        if args.stats:
+            watch.simulator.stats.dump(args.stats)
+
+        fleet.report(verbose=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
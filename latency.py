@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""
+This module contains the response latency models of the simulator. A real
+watch takes some time to answer, and phone apps have timeouts; a model
+delays every response of the simulator (see WatchSimulator.latency) by
+the number of seconds its next() method returns.
+
+Models are given on the command line as:
+
+    fixed:0.05          every response is delayed by 50 msecs
+    jitter:0.05,0.02    50 msecs, plus or minus up to 20 msecs
+    capture:FILE        the delays measured in a capture (of a real watch,
+                        for example), in order and over and over again
+
+"""
+
+import random
+import itertools
+import collections
+
+import capture
+import protocol
+import protocol_constants as const
+
+# Response message types and the requests they answer
+RESPONSES = {
+    const.MESSAGE_TYPES_LOOKUP['getDeviceTypeResponse']:
+        const.MESSAGE_TYPES_LOOKUP['getDeviceType'],
+    const.MESSAGE_TYPES_LOOKUP['nvalResponse']:
+        const.MESSAGE_TYPES_LOOKUP['nval'],
+}
+
+REQUESTS = frozenset(RESPONSES.values())
+
+
+class FixedLatency(object):
+    def __init__(self, delay):
+        self.delay = delay
+
+    def next(self):
+        return self.delay
+
+    def __repr__(self):
+        return "fixed:%g" % self.delay
+
+
+class JitteredLatency(object):
+    """Uniformly distributed delays. The random generator is seeded, so
+    runs can be repeated."""
+
+    def __init__(self, delay, jitter, seed=0):
+        self.delay = delay
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+    def next(self):
+        return max(0.0, self.delay + self.random.uniform(-self.jitter,
+                                                         self.jitter))
+
+    def __repr__(self):
+        return "jitter:%g,%g" % (self.delay, self.jitter)
+
+
+class ReplayedLatency(object):
+    """Replays a list of delays, starting over at the end."""
+
+    def __init__(self, delays):
+        if not delays:
+            raise ValueError("No delays to replay")
+
+        self.delays = delays
+        self._next = itertools.cycle(delays).next
+
+    def next(self):
+        return self._next()
+
+    def __repr__(self):
+        return "replayed:%d delays" % len(self.delays)
+
+
+def response_delays(reader):
+    """Measures the time between every request in a capture and the
+    response to it. Returns the delays in seconds, in order."""
+
+    framer = protocol.FrameReassembler()
+    pending = collections.defaultdict(collections.deque)
+    delays = []
+
+    for record in reader:
+        if record.direction == capture.RX:
+            framer.feed(record.data)
+
+            for frame in framer:
+                msgtype, _ = protocol.HEADER.unpack_from(frame)
+
+                if msgtype in REQUESTS:
+                    pending[msgtype].append(record.time)
+
+        elif len(record.data) >= protocol.HEADER.size:
+            msgtype, _ = protocol.HEADER.unpack_from(record.data)
+            request = RESPONSES.get(msgtype)
+
+            if request is not None and pending[request]:
+                delays.append(record.time - pending[request].popleft())
+
+    return delays
+
+
+def from_spec(spec):
+    """Returns the model described by spec (see the module docstring)."""
+
+    kind, _, args = spec.partition(':')
+
+    try:
+        if kind == 'fixed':
+            return FixedLatency(float(args))
+        if kind == 'jitter':
+            delay, jitter = args.split(',')
+            return JitteredLatency(float(delay), float(jitter))
+    except ValueError:
+        raise ValueError("Invalid latency model: %s" % spec)
+
+    if kind == 'capture':
+        return ReplayedLatency(response_delays(capture.CaptureReader(args)))
+
+    raise ValueError("Unknown latency model: %s" % spec)
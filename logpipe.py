@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""
+This module contains the logging pipeline of the GUI.
+
+Logging a record only puts it into a bounded queue (on whatever thread
+logged it). A listener thread takes the records from there, formats them
+and passes them on to the real handlers: the console, and a ring buffer
+from which the GUI log view takes the most recent lines in batches.
+
+Nothing in here blocks the logging thread. When the queue is full or the
+log view falls behind, records are dropped and counted instead.
+"""
+
+import Queue
+import logging
+import threading
+import collections
+
+# Records waiting for the listener thread
+LOG_QUEUE_SIZE = 4096
+
+# Lines kept for the log view
+LOG_VIEW_LINES = 1000
+
+
+class hexdump(object):
+    """Log argument which formats binary data as hex bytes, but only if the
+    record is actually formatted."""
+
+    __slots__ = ('data', )
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return ' '.join("%02X" % byte for byte in bytearray(self.data))
+
+
+class QueueHandler(logging.Handler):
+    """Puts records into a queue, without ever blocking."""
+
+    def __init__(self, maxsize=LOG_QUEUE_SIZE):
+        logging.Handler.__init__(self)
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def take_dropped(self):
+        """Returns the number of records dropped since the last call."""
+        dropped, self.dropped = self.dropped, 0
+        return dropped
+
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the most recent formatted lines (with their level) until the
+    log view takes them. Lines which are pushed out before that are
+    counted as dropped."""
+
+    def __init__(self, capacity=LOG_VIEW_LINES):
+        logging.Handler.__init__(self)
+        self.lines = collections.deque(maxlen=capacity)
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+
+        # The handler lock is held by handle()
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+
+        self.lines.append((record.levelno, line))
+
+    def take(self):
+        """Returns the waiting (level, line) tuples and the number of lines
+        dropped since the last call."""
+
+        self.acquire()
+
+        try:
+            lines = list(self.lines)
+            self.lines.clear()
+            dropped, self.dropped = self.dropped, 0
+        finally:
+            self.release()
+
+        return lines, dropped
+
+
+class LogListener(object):
+    """Passes the records of a QueueHandler on to the given handlers, on
+    its own thread."""
+
+    def __init__(self, queue_handler, handlers):
+        self.queue_handler = queue_handler
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(1)
+        self.thread.start()
+
+    def stop(self, timeout=1.0):
+        """Handles the records which are still queued and stops."""
+
+        if self.thread is None:
+            return
+
+        try:
+            self.queue_handler.queue.put(None, timeout=timeout)
+        except Queue.Full:
+            pass
+
+        self.thread.join(timeout)
+        self.thread = None
+
+    def _run(self):
+        queue = self.queue_handler.queue
+
+        while True:
+            record = queue.get()
+
+            if record is None:
+                return
+
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+def install(*handlers):
+    """Puts a QueueHandler in front of all handlers of the root logger (and
+    the given ones). Returns the started LogListener."""
+
+    root = logging.getLogger()
+    handlers = root.handlers[:] + list(handlers)
+
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+
+    queue_handler = QueueHandler()
+    root.addHandler(queue_handler)
+
+    listener = LogListener(queue_handler, handlers)
+    listener.start()
+
+    return listener
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""
+This module contains the decoded watch messages. Every message type the
+parser understands has its own class, with the decoded fields as slots.
+
+Messages are decoded from the option bits (an int) and the payload, which
+can be a bytearray or a memoryview. The payload isn't copied: the lines of a
+WriteLCD message are slices of it, so if it is a memoryview into a receive
+buffer, the message is only valid until the buffer is fed again.
+"""
+
+import struct
+import datetime
+
+import protocol_constants as const
+
+from framebuffer import HEIGHT
+
+
+def _unpack(fmt, payload, offset=0):
+    """Unpacks fields from the payload using a struct.Struct. A payload
+    which is too short raises a ValueError."""
+
+    try:
+        return fmt.unpack_from(payload, offset)
+    except struct.error, e:
+        raise ValueError("Payload too short (%d bytes): %s" % (len(payload), e))
+
+
+def _check_mode(mode):
+    """Display modes index the display buffers of the watch, so modes which
+    don't exist raise a ValueError."""
+
+    if mode >= const.MODES:
+        raise ValueError("Invalid display mode %d" % mode)
+
+    return mode
+
+
+def _check_row(row):
+    if row >= HEIGHT:
+        raise ValueError("Invalid display row %d" % row)
+
+    return row
+
+
+def _check_button(message):
+    """Button messages index the button slots of the watch, so buttons
+    which don't exist raise a ValueError."""
+
+    if (message.mode >= const.MODES or
+            message.btn_id >= len(const.BUTTON_ALPHA) or
+            message.btn_type >= const.BUTTON_TYPES):
+        raise ValueError("Invalid button (mode %d, id %d, type %d)" %
+                         (message.mode, message.btn_id, message.btn_type))
+
+    return message
+
+
+class Message(object):
+    """Base class of all decoded messages."""
+
+    __slots__ = ()
+
+    msgtype = None
+
+    @classmethod
+    def decode(cls, option_bits, payload):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join(
+            "%s=%r" % (name, getattr(self, name)) for name in self.__slots__))
+
+
+class SetRTC(Message):
+    __slots__ = ('date', 'hrs12', 'day_first')
+
+    msgtype = const.MESSAGE_TYPES_LOOKUP['setRTC']
+
+    # year (big-endian), month, day, week day, hour, minute, second
+    FORMAT = struct.Struct('>H6B')
+    EXTENSION = struct.Struct('2B')
+
+    def __init__(self, date, hrs12=NotImplemented, day_first=NotImplemented):
+        self.date = date
+        self.hrs12 = hrs12
+        self.day_first = day_first
+
+    @classmethod
+    def decode(cls, option_bits, payload):
+        year, month, day, week_day, hour, minute, second = \
+            _unpack(cls.FORMAT, payload)
+
+        date = datetime.datetime(
+            year=year, day=day, month=month,
+            hour=hour, minute=minute, second=second,
+        )
+
+        # There seems to be an undocumented protocol extension which permits
+        # to set these NVAL properties without issuing an NVAL message. Has
+        # to be verified on an actual watch. The MWM doesn't use this, but
+        # the time set application for PC does.
+
+        if len(payload) > 8:
+            hrs12, day_first = _unpack(cls.EXTENSION, payload, 8)
+            return cls(date, bool(hrs12), bool(day_first))
+
+        return cls(date)
+
+
+class SetLED(Message):
+    __slots__ = ('state', )
+
+    msgtype = const.MESSAGE_TYPES_LOOKUP['setLED']
+
+    def __init__(self, state):
+        self.state = state
+
+    @classmethod
+    def decode(cls, option_bits, payload):
+        return cls(bool(option_bits & const.OPTION_LED_ON))
+
+
+class SetVibrate(Message):
+    __slots__ = ('action', 'on_time', 'off_time', 'cycles')
+
+    msgtype = const.MESSAGE_TYPES_LOOKUP['setVibrate']
+
+    FORMAT = struct.Struct('<BHHB')
+
+    def __init__(self, action, on_time, off_time, cycles):
+        self.action = action
+        self.on_time = on_time
+        self.off_time = off_time
+        self.cycles = cycles
+
+    @classmethod
+    def decode(cls, option_bits, payload):
+        return cls(*_unpack(cls.FORMAT, payload))
+
+
+class EnableButton(Message):
+    __slots__ = ('mode', 'btn_id', 'btn_type', 'callback', 'callback_data')
+
+    msgtype = const.MESSAGE_TYPES_LOOKUP['enableButton']
+
+    FORMAT = struct.Struct('5B')
+
+    def __init__(self, mode, btn_id, btn_type, callback, callback_data):
+        self.mode = mode
+        self.btn_id = btn_id
+        self.btn_type = btn_type
+        self.callback = callback
+        self.callback_data = callback_data
+
+    @classmethod
+    def decode(cls, option_bits, payload):
+        return _check_button(cls(*_unpack(cls.FORMAT, payload)))
+
+
+class DisableButton(Message):
+    __slots__ = ('mode', 'btn_id', 'btn_type')
+
+    msgtype = const.MESSAGE_TYPES_LOOKUP['disableButton']
+
+    FORMAT = struct.Struct('3B')
+
+    def __init__(self, mode, btn_id, btn_type):
+        self.mode = mode
+        self.btn_id = btn_id
+        self.btn_type = btn_type
+
+    @classmethod
+    def decode(cls, option_bits, payload):
+        return _check_button(cls(*_unpack(cls.FORMAT, payload)))
+
+
+class WriteLCD(Message):
+    """One or two display rows. The lines are packed, just like they are
+    transmitted: 12 bytes per row, the least significant bit is the
+    leftmost pixel. line2 is empty if only one row is written."""
+
+    __slots__ = ('mode', 'rows', 'line1', 'line2')
+
+    msgtype = const.MESSAGE_TYPES_LOOKUP['writeLCD']
+
+    ROW = struct.Struct('B')
+
+    def __init__(self, mode, rows, line1, line2):
+        self.mode = mode
+        self.rows = rows
+        self.line1 = line1
+        self.line2 = line2
+
+    @property
+    def two_lines(self):
+        return len(self.rows) == 2
+
+    @classmethod
+    def decode(cls, option_bits, payload):
+        if len(payload) < 13:
+            raise ValueError("writeLCD payload too short (%d bytes)"
+                             % len(payload))
+
+        mode = _check_mode(option_bits & const.OPTION_BUFFER_MASK)
+        row1 = _check_row(cls.ROW.unpack_from(payload, 0)[0])
+
+        if not option_bits & const.OPTION_SINGLE_LINE and len(payload) >= 26:
+            row2 = _check_row(cls.ROW.unpack_from(payload, 13)[0])
+            return cls(mode, (row1, row2), payload[1:13], payload[14:26])
+
+        return cls(mode, (row1, ), payload[1:13], payload[0:0])
+
+
+class Nval(Message):
+    """NVAL operation (init, read or write, given by the option bits) on
+    one value. data holds the value for init and write operations; unlike
+    other fields it is copied, since it is stored."""
+
+    __slots__ = ('operation', 'identifier', 'size', 'data')
+
+    msgtype = const.MESSAGE_TYPES_LOOKUP['nval']
+
+    # identifier, size of the value in bytes
+    FORMAT = struct.Struct('<HB')
+
+    def __init__(self, operation, identifier, size, data):
+        self.operation = operation
+        self.identifier = identifier
+        self.size = size
+        self.data = data
+
+    @classmethod
+    def decode(cls, option_bits, payload):
+        identifier, size = _unpack(cls.FORMAT, payload)
+
+        if option_bits == const.NVAL_READ:
+            return cls(option_bits, identifier, size, b'')
+
+        data = bytes(bytearray(payload[3:3 + size]))
+
+        if len(data) < size:
+            raise ValueError("nval payload too short (%d bytes for a %d byte "
+                             "value)" % (len(payload), size))
+
+        return cls(option_bits, identifier, size, data)
+
+
+class UpdateLCD(Message):
+    __slots__ = ('mode', )
+
+    msgtype = const.MESSAGE_TYPES_LOOKUP['updateLCD']
+
+    def __init__(self, mode):
+        self.mode = mode
+
+    @classmethod
+    def decode(cls, option_bits, payload):
+        # TODO: implement undocumented 'activate' flag
+        return cls(_check_mode(option_bits & const.OPTION_BUFFER_MASK))
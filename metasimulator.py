@@ -32,29 +32,50 @@ import logging
 import datetime
 import time
 import json
+import threading
+
+STARTUP_TIME = time.time()
+
+if __name__ == '__main__' and '--headless' in sys.argv:
+    # The headless simulator needs none of the GUI modules below
+    import headless
+    sys.exit(headless.main(sys.argv[1:]))
 
 import serial
 import wx
-import wx.lib.colourdb
 import wx.propgrid as wxpg
-from dateutil.relativedelta import relativedelta
 
-import wxSerialConfigDialog
 import gui_metasimulator
 
 import nval
 import serialcore
+import capture
+import logpipe
+import latency
+import nvalstore
 import protocol
 import protocol_handlers
 import protocol_constants as const
 
 logging.basicConfig(stream=sys.stdout,
                     format="%(levelname)s - %(name)s -> %(message)s",
-                    level=logging.DEBUG)
+                    level=logging.INFO)
 
 
 INI_FILE = 'metasimulator.yml'
 
+# Interval of the log window updates (msecs)
+LOG_INTERVAL = 200
+
+# Nice colorization for log messages in the main window
+LOG_COLORS = {
+    logging.DEBUG: "gray",
+    logging.INFO: "black",
+    logging.WARNING: "blue",
+    logging.ERROR: "red",
+    logging.CRITICAL: "red",
+}
+
 
 class MainFrame(gui_metasimulator.MainFrame, serialcore.SerialMixin):
     def __init__(self, parent):
@@ -74,53 +95,33 @@ class MainFrame(gui_metasimulator.MainFrame, serialcore.SerialMixin):
         
         self.Layout()
         
-        # The GUIMetaProtocolParser is strongly coupled to this class and
-        # contains all reactions to incoming messages, like changing a
-        # PropertyGrid entry or showing an indicator.
+        # The GUIMetaProtocolParser is the simulated watch. It is strongly
+        # coupled to this class and mirrors every change of the watch
+        # state, like changing a PropertyGrid entry or showing an indicator.
         
-        self.parser = protocol_handlers.GUIMetaProtocolParser(self)
         self.factory = protocol_handlers.GUIMetaProtocolFactory(self)
+        self.parser = protocol_handlers.GUIMetaProtocolParser(self)
         
-        # Nice colorization for log messages in the main window. There are
-        # definitely better ways to do this, like implementing a custom
-        # handler, but this works fine as well.
-        
-        class TBStream(object):
-            @staticmethod
-            def write(bytes):
-                if "[ERROR]" in bytes:
-                    color = "red"
-                elif "[DEBUG]" in bytes:
-                    color = "gray"
-                elif "[WARNING]" in bytes:
-                    color = "blue"
-                else:
-                    color = "black"
-                    
-                self.m_log.SetDefaultStyle(wx.TextAttr(color, "white"))
-                    
-                self.m_log.AppendText(bytes)
+        # Log records go through a queue to a listener thread, which writes
+        # them to the console and keeps the most recent lines for the log
+        # window. A timer appends them to the window in batches (see
+        # logpipe and OnLogTimer).
         
-        streamhandler = logging.StreamHandler(stream=TBStream)
-        streamhandler.formatter = logging.Formatter("[%(levelname)s] - %(name)s "
+        self.log_view = logpipe.RingBufferHandler()
+        self.log_view.formatter = logging.Formatter("[%(levelname)s] - %(name)s "
                                                     "-> %(message)s")
+        self.log_listener = logpipe.install(self.log_view)
         
-        self.log_window_handler = streamhandler
-        logging.root.addHandler(streamhandler)
+        self.log_timer = wx.Timer(self)
+        self.log_timer.Start(LOG_INTERVAL)
+        self.Bind(wx.EVT_TIMER, self.OnLogTimer, self.log_timer)
         
-        # Shortcut for NVAL access
+        # NVAL values edited in the property grid go to the watch state
         
-        class NVALAccess(object):
-            def __init__(self, pg):
-                self.pg = pg
-            def __getitem__(self, item):
-                return self.pg.GetPropertyValue(item)
-            def __setitem__(self, item, value):
-                return self.pg.SetPropertyValue(item, value)
-            
-        self.nval_store = NVALAccess(self.m_pg)        
+        self.m_pg.Bind(wxpg.EVT_PG_CHANGED, self.OnPropertyChanged)
+        self.m_blockIdle.Bind(wx.EVT_CHECKBOX, self.m_blockIdleOnCheckBox)
 
-        # The SerialMixin emits a signal every time it receives a chunk of bytes.
+        # The SerialMixin emits a signal when it has received messages.
         self.Bind(serialcore.EVT_SERIALRX, self.OnSerialRX)
         
         logging.info("GUI initialized")
@@ -135,89 +136,165 @@ class MainFrame(gui_metasimulator.MainFrame, serialcore.SerialMixin):
             self.config = {}
         
         last_com_port = self.config.get('LastPort', 'COM1')
+        self.parser.max_fps = self.config.get('MaxFPS', const.DISPLAY_MAX_FPS)
         
         # The serial class will be accessed from the serialcore.SerialMixin.
+        # The port is opened once the window is shown, see OnStartup.
+        
+        self.serial = serial.Serial()
+        self.serial.timeout = 0.5
         
         try:
-            self.serial = serial.Serial(last_com_port)
-        except serial.SerialException:
-            self.serial = serial.Serial()
+            self.serial.port = last_com_port
+        except (serial.SerialException, ValueError):
+            pass
         
-        self.serial.close()
-        self.serial.timeout = 0.5
         self.m_comPort.Value = self.serial.port or 'None'
         
         # The real time clock is updated by a regular timer event.
         
         self.clock = wx.Timer(self)
         self.clock.Start(500)
-        self.Bind(wx.EVT_TIMER, self.OnClock)
+        self.Bind(wx.EVT_TIMER, self.OnClock, self.clock)
         
         for btn in ['B', 'C', 'D', 'E', 'F']:
             button = getattr(self, 'm_Side'+btn)
             button.Bind(wx.EVT_LEFT_UP, self.OnSideButtonUp )
             button.Bind(wx.EVT_LEFT_DOWN, self.OnSideButtonDown)
             
-        self.btn_time = {}
+        args = sys.argv[1:]
+        
+        # --stats collects statistics of the simulated watch, which are shown
+        # on the property grid; --stats-file FILE also writes them to FILE
+        # (as JSON) on exit, see the stats module.
+        
+        self.stats_file = None
+        
+        if '--stats-file' in args[:-1]:
+            self.stats_file = args[args.index('--stats-file') + 1]
+            
+        if '--stats' in args or self.stats_file:
+            self.stats = self.parser.enable_stats(self.rx_framer)
+            self.stats.deferred = True      # see OnSerialWritten
+            self.stats.gauges['Write queue'] = lambda: (
+                "%d queued, %d dropped" % (self.write_queue.qsize(),
+                                           self.write_queue.dropped))
+            self.stats.peaks['RX batch'] = 0
+            
+        # --latency MODEL delays the responses of the watch, see the latency
+        # module
         
+        if '--latency' in args[:-1]:
+            self.parser.latency = latency.from_spec(
+                args[args.index('--latency') + 1])
+            
+        # --nval-file FILE keeps the NVAL values in FILE, so they survive
+        # restarts (and resets of the watch)
+        
+        if '--nval-file' in args[:-1]:
+            self.parser.nval_store = nvalstore.MappedNVALStore(
+                args[args.index('--nval-file') + 1])
+            
         self.m_resetWatchOnButtonClick(None)
-        if self.serial.port:
-            self.m_openConnectionOnButtonClick()
         
-        if len(sys.argv) > 1:
-            if sys.argv[1] == '--debug':
-                self.m_debug.Value = True
-                streamhandler.setLevel(logging.DEBUG)
+        if '--debug' in args:
+            self.m_debug.Value = True
+            logging.root.setLevel(logging.DEBUG)
+            
+        # --capture FILE records the serial traffic, see capture.py
+        
+        if '--capture' in args[:-1]:
+            path = args[args.index('--capture') + 1]
+            self.capture = capture.CaptureWriter(path)
+            self.logger.info("Recording serial traffic to %s", path)
                 
+    def OnStartup(self):
+        """Called once the window is shown. Opening the serial port can
+        take seconds (Bluetooth ports connect to the phone first), so it
+        is done by a separate thread."""
+        
+        self.logger.info("Started in %.2f secs", time.time() - STARTUP_TIME)
+        
+        if '--exit-after-startup' in sys.argv:
+            # Used to benchmark the startup, see benchmark.py
+            self.Close()
+            return
+        
+        if self.serial.port:
+            thread = threading.Thread(target=self.OpenPortThread)
+            thread.setDaemon(1)
+            thread.start()
+            
+    def OpenPortThread(self):
+        try:
+            self.serial.open()
+        except Exception, e:
+            wx.CallAfter(self.logger.error, "Failed to open %s: %s",
+                         self.serial.port, e)
+        else:
+            wx.CallAfter(self.OnPortOpened)
+            
+    def OnPortOpened(self):
+        if not self.serial.isOpen():
+            return  # closed in the meantime
+        
+        self.StartThread()
+        self.logger.info("Opened serial connection")
+        
     def save_settings(self):
         self.config['LastPort'] = self.serial.port
         json.dump(self.config, open(INI_FILE, 'w'), indent=4)
         
     def _reset_watch(self):
-        """Resets or initializes the internal GUI representation of the
-        MetaWatch to default values. Called on startup during
-        initialization."""
+        """Resets or initializes the MetaWatch and its GUI representation to
+        default values. Called on startup during initialization."""
         
-        self.m_LEDNotice.Hide()
-        self.m_vibrateNotice.Hide()
-        
-        self.m_watchMode.Selection = 0
         self.m_watchMode.Enabled = False
         self.m_manualModeSet.Value = False
-        self.clock_offset = relativedelta(0)        
         
-        self.parser.watch_reset()
+        self.parser.reset()
         
-        # There is no seperate internal data structure for the watch state,
-        # the GUI elements *are* the internal representation. This function
-        # essentially resets them to a known state.
+        # The watch state lives in the simulator (self.parser.state), the
+        # GUI elements only show it. The property grid is rebuilt here.
         
         self.m_pg.ClearPage(0)  
         self.m_pg.Append(wxpg.PropertyCategory("NVAL Store"))        
         
         # All NVAL values are listed in the protocol_constants module. The
-        # property grid is built by parsing that list and applying default
-        # values (NVAL properties which have no default value are ignored,
-        # they are marked 'reserved' in the protocol documentation).
+        # property grid is built by parsing that list and applying the
+        # values of the NVAL store (NVAL properties which are not in the
+        # store are ignored, they are marked 'reserved' in the protocol
+        # documentation). Later changes are taken from the store by
+        # OnClock, see _sync_nvals.
+        
+        nvals = self.parser.state.nvals
+        nvals.take_changes()
+        self.nval_properties = {}   # identifier -> type of the shown value
         
         for value in nval.get_nval_list():
+            if value.identifier not in nvals:
+                continue
+                
             args, kwargs = ([], {})
-            if value.displaytype[0] and value.default:
+            current = nvals[value.identifier]
+            value_type = int
+            if value.displaytype[0]:
                 dest_type, value_type = value.displaytype
-                kwargs = dict(value = value_type(value.default))
+                kwargs = dict(value = value_type(current))
             elif isinstance(value.valuetype, list):
                 dest_type = wxpg.EnumProperty
                 args = (value.valuetype,
-                        range(len(value.valuetype)), value.default)
+                        range(len(value.valuetype)), current)
             elif isinstance(value.valuetype, dict):
                 dest_type = wxpg.EnumProperty
                 args = (value.valuetype.values(),
-                        value.valuetype.keys(), value.default)
+                        value.valuetype.keys(), current)
             else:
                 continue
                 
             self.m_pg.Append(dest_type(value.name, str("nval_%04X" % value.identifier),
                                        *args, **kwargs))
+            self.nval_properties[value.identifier] = value_type
                 
         self.m_pg.Append(wxpg.PropertyCategory("Real Time Clock"))
         self.m_pg.Append(wxpg.DateProperty("Date"))
@@ -226,6 +303,14 @@ class MainFrame(gui_metasimulator.MainFrame, serialcore.SerialMixin):
         self.m_pg.SetPropertyAttribute("Date", wxpg.PG_DATE_PICKER_STYLE,
                                          wx.DP_DROPDOWN|wx.DP_SHOWCENTURY)
         
+        if self.stats is not None:
+            self.m_pg.Append(wxpg.PropertyCategory("Statistics"))
+            
+            for index, (label, text) in enumerate(self.stats.summary()):
+                self.m_pg.Append(wxpg.StringProperty(label, "stats_%d" % index,
+                                                     text))
+                self.m_pg.SetPropertyReadOnly("stats_%d" % index)
+        
         # Call the timer function once for immediate clock update.
         self.OnClock()
         
@@ -233,16 +318,50 @@ class MainFrame(gui_metasimulator.MainFrame, serialcore.SerialMixin):
         
     def OnSideButtonDown(self, event):
         event.Skip()
-        btn_id = event.GetEventObject().Label
-        self.btn_time[btn_id] = time.time()
-        self.parser._button_press(btn_id, 0)
+        btn = event.GetEventObject().Label
+        
+        if self.capture is not None:
+            self.capture.write_button(btn, True)
+            
+        self.parser.button_down(btn)
         
     def OnSideButtonUp(self, event):
         event.Skip()
-        btn_id = event.GetEventObject().Label
-        diff = (time.time() - self.btn_time[btn_id]) * 1000
-        self.logger.debug("Button %s press-release, held %f msecs", btn_id, diff)
-        self.parser._button_press(btn_id, msecs=diff)
+        btn = event.GetEventObject().Label
+        
+        if self.capture is not None:
+            self.capture.write_button(btn, False)
+            
+        self.parser.button_up(btn)
+        
+    def OnPropertyChanged(self, event):
+        name = event.GetPropertyName()
+        
+        if name.startswith('nval_'):
+            identifier = int(name[5:], 16)
+            
+            try:
+                self.parser.set_nval(identifier, int(event.GetPropertyValue()))
+            except ValueError, e:
+                # The old value is shown again by the next _sync_nvals
+                self.logger.error("%s", e)
+                self.parser.state.nvals.mark_dirty(identifier)
+                
+    def _sync_nvals(self):
+        """Shows the NVAL values which have changed since the last call on
+        the property grid."""
+        
+        nvals = self.parser.state.nvals
+        
+        for identifier in nvals.take_changes():
+            value_type = self.nval_properties.get(identifier)
+            
+            if value_type is not None:
+                self.m_pg.SetPropertyValue("nval_%04X" % identifier,
+                                           value_type(nvals[identifier]))
+            
+    def m_blockIdleOnCheckBox(self, event):
+        self.parser.deny_device_type = event.Checked()
 
     def m_resetWatchOnButtonClick(self, event):
         self._reset_watch()
@@ -255,30 +374,52 @@ class MainFrame(gui_metasimulator.MainFrame, serialcore.SerialMixin):
             self.StopThread()
             self.serial.close()
             
+        self.log_timer.Stop()
+        self.log_listener.stop()
+        
+        if self.capture is not None:
+            self.capture.close()
+            
+        self.parser.flush_nvals()
+        self.parser.state.nvals.close()
+        
+        if self.stats_file:
+            self.stats.dump(self.stats_file)
+            self.logger.info("Wrote statistics to %s", self.stats_file)
+            
         self.save_settings()
             
         self.Destroy()
         
     def OnSerialRX(self, event):
-        """This function is called every time a new byte chunk is received
-        from the watch, representing one or more messages. This function
-        passes them to the parser and handles exceptions, like not
-        implemented or invalid packets thrown by the parser."""
-        
-        self.logger.debug("Received data: %s", ' '.join(["%02X" %
-                          ord(byte) for byte in event.data]))
-        
-        try:
-            self.parser.parse(event.data)
-        except NotImplementedError, e:
-            self.logger.warn("Can't parse: %s", e.message)
-        except protocol.ProtocolError, e:
-            self.logger.error("Protocol error: %s", e.message)
-        except ValueError, e:
-            self.logger.error("Invalid data: %s", e.message)
-        except:
-            self.logger.exception("Unexpected exception:")
+        """This function is called when messages from the watch are waiting.
+        The serial thread has already reassembled and validated them, and
+        all messages received since the last call are handled in one pass.
+        Exceptions thrown by the parser, like not implemented or invalid
+        messages, are handled per message."""
+        
+        batch = self.TakeRxBatch()
+        
+        if self.stats is not None:
+            self.stats.rx_time = self.batch_received
+            self.stats.peak('RX batch', len(batch))
+        
+        for msgtype, option_bits, payload in batch:
+            self.logger.debug("Received %s: %s",
+                              const.MESSAGE_TYPE_NAMES[msgtype],
+                              logpipe.hexdump(payload))
             
+            try:
+                self.parser.handle(msgtype, option_bits, payload)
+            except NotImplementedError, e:
+                self.logger.warn("Can't parse: %s", e.message)
+            except protocol.ProtocolError, e:
+                self.logger.error("Protocol error: %s", e.message)
+            except ValueError, e:
+                self.logger.error("Invalid data: %s", e.message)
+            except:
+                self.logger.exception("Unexpected exception:")
+                
     
     def m_openConnectionOnButtonClick(self, event=None):
         if self.serial.isOpen():
@@ -305,10 +446,53 @@ class MainFrame(gui_metasimulator.MainFrame, serialcore.SerialMixin):
         except:
             self.logger.exception("Failed to close connection")
         else:
-            self.logger.info("Closed serial connection")
+            self.logger.info("Closed serial connection (%(frames)d frames, "
+                             "%(bytes)d bytes sent)", self.write_queue.stats())
             
     def m_debugOnCheckBox(self, event):
-        self.log_window_handler.setLevel(logging.DEBUG if event.Checked() else logging.INFO)
+        # Debug messages aren't even created unless they are shown
+        logging.root.setLevel(logging.DEBUG if event.Checked() else logging.INFO)
+        
+    def OnLogTimer(self, event=None):
+        """Appends the log lines which have arrived since the last call to
+        the log window, one AppendText per run of equally coloured lines.
+        The window keeps the most recent LOG_VIEW_LINES lines."""
+        
+        lines, dropped = self.log_view.take()
+        dropped += self.log_listener.queue_handler.take_dropped()
+        
+        if dropped:
+            lines.append((logging.WARNING, "[WARNING] - log -> %d messages "
+                          "dropped" % dropped))
+        
+        if not lines:
+            return
+        
+        self.m_log.Freeze()
+        
+        try:
+            run, color = [], None
+            
+            for level, line in lines:
+                line_color = LOG_COLORS.get(level, "black")
+                
+                if line_color != color and run:
+                    self.m_log.SetDefaultStyle(wx.TextAttr(color, "white"))
+                    self.m_log.AppendText(''.join(run))
+                    run = []
+                    
+                color = line_color
+                run.append(line + '\n')
+                
+            self.m_log.SetDefaultStyle(wx.TextAttr(color, "white"))
+            self.m_log.AppendText(''.join(run))
+            
+            excess = self.m_log.GetNumberOfLines() - logpipe.LOG_VIEW_LINES
+            
+            if excess > 0:
+                self.m_log.Remove(0, self.m_log.XYToPosition(0, excess))
+        finally:
+            self.m_log.Thaw()
         
     def m_serialSetupOnButtonClick(self, event=None):
         """Event handler for the serial setup button. Calls the pySerial
@@ -316,6 +500,8 @@ class MainFrame(gui_metasimulator.MainFrame, serialcore.SerialMixin):
         closed before displaying the dialog and re-opened once it has been
         closed, regardless of the changes made by the user."""
         
+        import wxSerialConfigDialog
+        
         self.m_closeConnectionOnButtonClick()
             
         ok = False
@@ -349,28 +535,36 @@ class MainFrame(gui_metasimulator.MainFrame, serialcore.SerialMixin):
         kept up to date by a GUI timer which triggers every 0.5 seconds. The
         possibility to change the clock from the phone is implemented by
         storing an offset between the date set by the phone and the local
-        time, which is applied every time the PG is updated."""
+        time, which is applied every time the PG is updated. NVAL values
+        changed by the watch are shown, too."""
+        
+        clock = self.parser.rtc_now()
+        self.m_pg.SetPropertyValue('Date', clock)
+        self.m_pg.SetPropertyValue('Time', clock.strftime("%H:%M:%S"))
         
-        clock = datetime.datetime.now() + self.clock_offset
-        self.nval_store['Date'] = clock
-        self.nval_store['Time'] = clock.strftime("%H:%M:%S")
+        self._sync_nvals()
+        
+        if self.stats is not None:
+            for index, (label, text) in enumerate(self.stats.summary()):
+                self.m_pg.SetPropertyValue("stats_%d" % index, text)
         
     def OnDisplayPaint(self, event):
         dc = wx.PaintDC(event.GetEventObject())    
         self.parser.draw_bitmap(dc)
         
     def m_watchModeOnRadioBox(self, event):
-        self.parser.refresh_bitmap()
+        self.parser.set_mode(self.m_watchMode.Selection)
 
 class MetaSimApp(wx.App):
     def OnInit(self):
         wx.InitAllImageHandlers()
-        wx.lib.colourdb.updateColourDB()
 
         frame_main = MainFrame(None)
         frame_main.SetBackgroundColour(wx.SystemSettings.GetColour(wx.SYS_COLOUR_BACKGROUND))
         self.SetTopWindow(frame_main)
         frame_main.Show()
+        
+        wx.CallAfter(frame_main.OnStartup)
 
         return 1
 
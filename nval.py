@@ -30,7 +30,7 @@ PROPGRID_MAPPING = {
 NVALClass = namedtuple('NVAL', ['identifier', 'name', 'size', 'default', 'valuetype', 'displaytype',])
 
 
-def get_nval_list():
+def _build_nval_list():
     for nval in NVAL_VALUES:
         assert len(nval) == 5
         
@@ -41,6 +41,13 @@ def get_nval_list():
             
         yield NVALClass(*nval, displaytype=PROPGRID_MAPPING.get(dty, (None, None)))
         
+# Built once, the property grid is rebuilt on every reset
+NVAL_LIST = tuple(_build_nval_list())
+
+
+def get_nval_list():
+    return NVAL_LIST
+        
         
 if __name__ == '__main__':
-    print get_nval_list().next().name
\ No newline at end of file
+    print get_nval_list()[0].name
\ No newline at end of file
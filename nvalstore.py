@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""
+This module contains the NVAL store of the simulated watch.
+
+All values are packed into one buffer, in the order of NVAL_VALUES in
+protocol_constants and using their size in bytes (little-endian, like on
+the wire). The layout is computed once; reading or writing a value is a
+dictionary lookup and a struct call. NVAL values without a size or a
+default are marked 'reserved' in the protocol documentation and are left
+out.
+
+The store doesn't know about the GUI. It remembers which values have
+changed, and the property grid takes them from time to time (see
+take_changes).
+
+A MappedNVALStore keeps the values in a memory-mapped file, so they
+survive restarts: the file is the packed buffer itself, followed by a
+trailer with a checksum of the layout. Nothing has to be parsed when it is
+opened.
+"""
+
+import os
+import mmap
+import zlib
+import struct
+
+import protocol_constants as const
+
+FORMATS = {
+    1: struct.Struct('<B'),
+    2: struct.Struct('<H'),
+    4: struct.Struct('<I'),
+}
+
+
+def _layout():
+    layout = {}
+    defaults = bytearray()
+
+    for identifier, name, size, default, valuetype in const.NVAL_VALUES:
+        if size is None or default is None:
+            continue
+
+        layout[identifier] = (len(defaults), FORMATS[size])
+        defaults += FORMATS[size].pack(default)
+
+    return layout, bytes(defaults)
+
+# identifier -> (offset, struct), and the packed defaults of all values
+LAYOUT, DEFAULTS = _layout()
+
+# Identifiers in the order of the layout
+IDENTIFIERS = tuple(sorted(LAYOUT, key=lambda identifier: LAYOUT[identifier]))
+
+# Trailer of NVAL files: magic, CRC32 of the layout
+MAGIC = b'MWNV'
+TRAILER = struct.Struct('<4sI')
+
+LAYOUT_CHECKSUM = zlib.crc32(repr([(identifier, LAYOUT[identifier][1].size)
+                                   for identifier in IDENTIFIERS])) & 0xffffffff
+
+# Seconds between the first of a batch of writes and flushing the file
+FLUSH_DELAY = 1.0
+
+
+class NVALStore(object):
+    """NVAL values by identifier, packed into buffer (a bytearray, or
+    anything else which is writable and supports the buffer interface, like
+    an mmap). Behaves like a dictionary with a fixed set of keys. Unknown
+    identifiers raise a KeyError, values which don't fit into their size a
+    ValueError."""
+
+    def __init__(self, buffer=None):
+        if buffer is None:
+            buffer = bytearray(DEFAULTS)
+
+        if len(buffer) < len(DEFAULTS):
+            raise ValueError("NVAL buffer too small (%d bytes, %d needed)" %
+                             (len(buffer), len(DEFAULTS)))
+
+        self.buffer = buffer
+        self.changed = set()
+
+    def __getitem__(self, identifier):
+        offset, format = LAYOUT[identifier]
+        return format.unpack_from(self.buffer, offset)[0]
+
+    def __setitem__(self, identifier, value):
+        offset, format = LAYOUT[identifier]
+
+        # Not pack_into: it clears the value before finding out that the
+        # new one doesn't fit
+        try:
+            data = format.pack(value)
+        except struct.error:
+            raise ValueError("Invalid value for NVAL 0x%04x: %r" %
+                             (identifier, value))
+
+        self.buffer[offset:offset + format.size] = data
+        self.changed.add(identifier)
+
+    def __contains__(self, identifier):
+        return identifier in LAYOUT
+
+    def __iter__(self):
+        return iter(IDENTIFIERS)
+
+    def __len__(self):
+        return len(IDENTIFIERS)
+
+    def get(self, identifier, default=None):
+        if identifier not in LAYOUT:
+            return default
+
+        return self[identifier]
+
+    def iteritems(self):
+        for identifier in IDENTIFIERS:
+            yield identifier, self[identifier]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def size(self, identifier):
+        return LAYOUT[identifier][1].size
+
+    def read(self, identifier):
+        """Returns a value as it is sent over the wire."""
+
+        offset, format = LAYOUT[identifier]
+        return bytes(self.buffer[offset:offset + format.size])
+
+    def write(self, identifier, data):
+        """Sets a value to the bytes received over the wire."""
+
+        offset, format = LAYOUT[identifier]
+
+        if len(data) != format.size:
+            raise ValueError("NVAL 0x%04x has %d bytes, not %d" %
+                             (identifier, format.size, len(data)))
+
+        self.buffer[offset:offset + format.size] = bytes(data)
+        self.changed.add(identifier)
+
+    def reset(self):
+        """Restores all default values."""
+
+        self.buffer[:len(DEFAULTS)] = DEFAULTS
+        self.changed.update(IDENTIFIERS)
+
+    def mark_dirty(self, identifier):
+        """Reports a value as changed without setting it (so that whoever
+        shows it shows it again)."""
+
+        if identifier not in LAYOUT:
+            raise KeyError(identifier)
+
+        self.changed.add(identifier)
+
+    def take_changes(self):
+        """Returns the identifiers of all values which have been set since
+        the last call."""
+
+        changed, self.changed = self.changed, set()
+        return changed
+
+    def flush(self):
+        """Writes the values to persistent storage (if there is any)."""
+
+    def close(self):
+        pass
+
+
+class MappedNVALStore(NVALStore):
+    """NVAL store in a memory-mapped file. A new file, or one which was
+    written with a different layout, is initialized with the default
+    values. Changes are written to the file by flush() (or whenever the
+    operating system gets to it)."""
+
+    def __init__(self, path):
+        trailer = TRAILER.pack(MAGIC, LAYOUT_CHECKSUM)
+        size = len(DEFAULTS) + len(trailer)
+
+        mode = 'r+b' if os.path.exists(path) else 'w+b'
+        self.file = open(path, mode)
+        self.path = path
+
+        contents = self.file.read(size + 1)
+        self.initialized = (len(contents) != size or
+                            contents[len(DEFAULTS):] != trailer)
+
+        if self.initialized:
+            self.file.seek(0)
+            self.file.truncate()
+            self.file.write(DEFAULTS + trailer)
+            self.file.flush()
+
+        NVALStore.__init__(self, mmap.mmap(self.file.fileno(), size))
+
+    def flush(self):
+        self.buffer.flush()
+
+    def close(self):
+        self.buffer.flush()
+        self.buffer.close()
+        self.file.close()
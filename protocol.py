@@ -21,256 +21,510 @@ which is where all the GUI updates happen.
 import sys, os
 import struct
 import datetime
-import inspect
+import time
+import functools
 
 import crc
-from bitarray import bitarray
+import messages
 
 import protocol_constants as const
-from protocol_constants import MESSAGE_TYPES
 
 class ProtocolError(Exception): pass
 class InvalidMessage(ProtocolError): pass
 class InvalidChecksum(ProtocolError): pass
 
+class FrameReassembler(object):
+    """Reassembles watch messages from a byte stream which has been split
+    into arbitrary chunks by the serial driver. Chunks are copied into a
+    persistent receive buffer; iterating over the reassembler yields every
+    complete, CRC-validated frame as a memoryview into that buffer.
+    
+    A yielded frame is only valid until the next call to feed(). Frames
+    which have not been consumed yet stay in the buffer, so an exception
+    raised while handling one frame doesn't lose the following ones.
+    
+    Garbage between frames is skipped by searching for the next start byte
+    (no recursion involved). A stray start byte followed by a plausible
+    length would hold back the frames behind it until that many bytes have
+    arrived, so an incomplete frame is dropped as soon as a complete, valid
+    frame follows it. The counters keep track of what went wrong:
+    
+      - dropped: frames with an impossible length field, or cut short by
+        the frame following them
+      - corrupted: frames with an invalid checksum
+      - resynced: number of times the stream had to be resynchronized
+      - garbage: number of bytes skipped while resynchronizing
+    
+    """
+    
+    START = b'\x01'
+    
+    # start + len + msgtype + op_bits + 2*crc = 6 bytes
+    MIN_LENGTH = 6
+    
+    # The longest message is a two-line writeLCD (6 + 2 * (1 + 12) bytes);
+    # a longer length field would hold back all frames behind it
+    MAX_LENGTH = 32
+    
+    def __init__(self, crc_engine=None, capacity=256):
+        self.crc_engine = crc_engine or crc.FastCRC_CCITT()
+        self.buffer = bytearray(capacity)
+        self.start = 0
+        self.end = 0
+        
+        self.frames = 0
+        self.dropped = 0
+        self.corrupted = 0
+        self.resynced = 0
+        self.garbage = 0
+        
+    def __len__(self):
+        """Number of buffered bytes which have not been consumed yet."""
+        return self.end - self.start
+    
+    def reset(self):
+        """Discards all buffered data (the counters are kept)."""
+        self.start = self.end = 0
+        
+    def feed(self, data):
+        """Appends a chunk of received bytes to the receive buffer."""
+        
+        size = len(data)
+        
+        if not size:
+            return
+        
+        if self.end + size > len(self.buffer):
+            pending = self.end - self.start
+            
+            # Frames handed out earlier may still reference the buffer, so it
+            # is never resized: either the pending bytes are moved to the
+            # front, or a new (larger) buffer replaces the old one.
+            
+            if pending + size > len(self.buffer):
+                buffer = bytearray(max(2 * len(self.buffer), pending + size))
+            else:
+                buffer = self.buffer
+                
+            buffer[0:pending] = self.buffer[self.start:self.end]
+            self.buffer = buffer
+            self.start, self.end = 0, pending
+            
+        self.buffer[self.end:self.end + size] = data
+        self.end += size
+        
+    def _resync(self, offset):
+        """Skips everything before the next start byte after offset."""
+        
+        index = self.buffer.find(self.START, offset, self.end)
+        
+        if index < 0:
+            index = self.end
+            
+        self.garbage += index - self.start
+        self.resynced += 1
+        self.start = index
+        
+    def _complete_frame(self, offset):
+        """Returns the index of the first complete frame with a valid
+        checksum after offset, or None."""
+        
+        buffer = self.buffer
+        end = self.end
+        index = buffer.find(self.START, offset, end)
+        
+        while 0 <= index <= end - self.MIN_LENGTH:
+            length = buffer[index + 1]
+            
+            if (self.MIN_LENGTH <= length <= self.MAX_LENGTH and
+                    end - index >= length and
+                    self.crc_engine.checksum(buffer[index:index + length - 2])
+                    == buffer[index + length - 2] |
+                    (buffer[index + length - 1] << 8)):
+                return index
+            
+            index = buffer.find(self.START, index + 1, end)
+            
+        return None
+        
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        buffer = self.buffer
+        
+        while self.end - self.start >= 2:
+            start = self.start
+            
+            if buffer[start] != 1:
+                self._resync(start)
+                continue
+            
+            length = buffer[start + 1]
+            
+            if not self.MIN_LENGTH <= length <= self.MAX_LENGTH:
+                self.dropped += 1
+                self._resync(start + 1)
+                continue
+            
+            if self.end - start < length:
+                # Incomplete: wait for more data, unless a frame follows
+                if self._complete_frame(start + 1) is None:
+                    break
+                
+                self.dropped += 1
+                self._resync(start + 1)
+                continue
+            
+            end = start + length
+            frame = memoryview(buffer)[start:end]
+            
+            if (self.crc_engine.checksum(frame[:-2]) !=
+                    buffer[end - 2] | (buffer[end - 1] << 8)):
+                self.corrupted += 1
+                self._resync(start + 1)
+                continue
+            
+            self.start = end
+            self.frames += 1
+            
+            return frame
+        
+        # Garbage which can't be the beginning of a frame is discarded right
+        # away instead of waiting for the next chunk.
+        
+        if self.end > self.start and buffer[self.start] != 1:
+            self._resync(self.start)
+        
+        raise StopIteration
+    
+    
 class BaseProtocolParser(object):
     """This class parses incoming watch messages, checks their integrity
     and dissects them. All the message types are defined in the module
     protocol_constants. Every message type has its own handler
     function."""
     
+    # The engine is stateless, so all parsers share one
+    crc_engine = crc.FastCRC_CCITT()
+    
+    # Statistics (a stats.Stats instance), None while they are disabled
+    stats = None
+    
     def __init__(self):
-        self.crc_engine = crc.CRC_CCITT()
+        self.framer = FrameReassembler(self.crc_engine)
+        self.handlers = self._handler_table()
+        
+    @classmethod
+    def _handler_table(cls):
+        """Returns a tuple which maps every possible message type (0-255) to
+        its handler function. The message type 0x26 has the name 'setRTC',
+        so the handler function must be named 'handle_setRTC'.
+        
+        The table is built once per class and shared by all instances.
+        Handlers are looked up on the class itself, which means that
+        overridden handlers of subclasses end up in their own table."""
+        
+        table = cls.__dict__.get('_handlers')
+        
+        if table is None:
+            table = tuple(
+                getattr(cls, 'handle_%s' % name, cls._not_implemented).__func__
+                for name in const.MESSAGE_TYPE_NAMES
+            )
+            cls._handlers = table
+            
+        return table
         
     def _not_implemented(self, msgtype, *args, **kwargs):
         """Dummy handler which raises an exception every time an unknown
         message type is encountered."""
         
         raise NotImplementedError("Message type %s not implemented"
-                                  % MESSAGE_TYPES[msgtype])
+                                  % const.MESSAGE_TYPE_NAMES[msgtype])
     
     def _checksum(self, message, clip=True):
         if clip:
             message = message[0:-2]
-        crc_ = self.crc_engine.checksum(str(message))
+        crc_ = self.crc_engine.checksum(message)
         return bytearray(struct.pack('<H', crc_))
     
-    def _init_option_bits(self, bare=False):
-        """Returns a correctly initialized bitarray."""
-        
-        array = bitarray(endian='little')
-        
-        if not bare:
-            array.fromstring('\x00')
+    def parse(self, data=''):
+        """Feeds a chunk of received bytes into the frame reassembler and
+        forwards every complete watch message to a handler function (see
+        _handler_table). The chunk doesn't need to be aligned to message
+        boundaries: incomplete messages are kept until the rest arrives,
+        corrupted ones are skipped (see FrameReassembler).
+        
+        If a handler raises an exception, the remaining messages stay queued
+        and are handled by the next call (which may pass no data at all)."""
+        
+        if self.stats is not None and data:
+            self.stats.received(len(data))
+            
+        self.framer.feed(data)
         
-        return array    
+        for frame in self.framer:
+            self.handle(*dissect(frame, copy=False))
+            
+    def dispatch(self, message):
+        """Dissects a single, already validated message and passes it to
+        its handler function."""
+        return self.handle(*dissect(message))
+    
+    def handle(self, msgtype, option_bits, payload):
+        """Passes a dissected message to its handler function."""
+        if self.stats is not None:
+            return self._handle_with_stats(msgtype, option_bits, payload)
+            
+        return self.handlers[msgtype](self, msgtype, option_bits, payload)
+        
+    def _handle_with_stats(self, msgtype, option_bits, payload):
+        """Like handle, but counts the message and measures the time since
+        it was received (and, by the factory, until it was answered)."""
+        
+        stats = self.stats
+        stats.request_time = stats.rx_time
+        
+        try:
+            return self.handlers[msgtype](self, msgtype, option_bits, payload)
+        except NotImplementedError:
+            stats.not_implemented[msgtype] += 1
+            raise
+        except (ProtocolError, ValueError):
+            stats.errors += 1
+            raise
+        finally:
+            stats.rx_frames[msgtype] += 1
+            stats.request_time = None
+            
+            if stats.rx_time is not None:
+                stats.rx_to_handled.record(time.time() - stats.rx_time)
         
-    def parse(self, message):
-        """Parses one or more watch messages, checks their integrity, splits\
-        them and forwards them to a handler function. The mapping between\
-        message types and handler functions is done using the translation\
-        table in the protocol constant definitions. The message type 0x26 has\
-        the name 'setRTC', so the handler function must be named\
-        'handler_setRTC'."""
         
-        message = bytearray(message)
+HEADER = struct.Struct('xxBB')
+
+def dissect(message, copy=True):
+    """Splits a validated message into its different parts and returns them
+    as (msgtype, option_bits, payload), the option bits as an int.
+    
+    By default, the payload is a copy which doesn't reference the message
+    buffer, so it can be handed over to another thread. Without copy, it is
+    a memoryview into the message buffer."""
+    
+    msgtype, option_bits = HEADER.unpack_from(message)
+    
+    if copy:
+        payload = bytearray(message[4:-2])
+    else:
+        payload = memoryview(message)[4:-2]
+    
+    return msgtype, option_bits, payload
         
-        if message[0] != 1:
-            raise ProtocolError("Doesn't start with 0x01")
         
-        # If the packet is longer than declared, it will be truncated.
-        # Everything above the limit will be copied into a new message in
-        # order to parse it as well. Usually, this shouldn't happen: the
-        # phone is supposed to pause between different packets.
+def message(name, prebuilt=()):
+    """Decorator which binds a send_* method of MetaProtocolFactory to the
+    message type with the given name. The decorated method returns the
+    (option_bits, payload) of the message; composing and sending it is done
+    by the wrapper.
+    
+    Messages which never change can be prebuilt: prebuilt is a list of
+    argument tuples for which the message is composed in advance, once per
+    process. Calling the method with one of them (as positional arguments)
+    only costs a dictionary lookup.
+    
+    The wrapper has two more functions, which can be bound to the factory
+    (see compose_buttonEvent): compose returns the frame for the given
+    arguments without sending it, send_frame sends such a frame later."""
+    
+    msgtype = const.MESSAGE_TYPES_LOOKUP[name]
+    
+    def decorator(func):
+        frames = {}
         
-        if len(message) > message[1]:
-            if message[message[1]] == 1:
-                self.parse(message[message[1]:])
-                message = message[:message[1]]
+        @functools.wraps(func)
+        def wrapper(self, *args):
+            frame = frames.get(args)
+            
+            if frame is None:
+                option_bits, payload = func(self, *args)
+                frame = self._build_message(msgtype, option_bits, payload)
                 
-        # If the packet is shorter than declared, it is obviously damaged.
-        
-        if len(message) != message[1]:
-            raise ProtocolError("Length mismatch")
+            if self.stats is not None:
+                self.stats.sent(msgtype, len(frame))
+                
+            return self._send(frame)
         
-        # Different parts of the message:
+        def compose(self, *args):
+            frame = frames.get(args)
+            
+            if frame is None:
+                option_bits, payload = func(self, *args)
+                frame = self._build_message(msgtype, option_bits, payload)
+                
+            return frame
         
-        msgtype = message[2]
-        option_bits = bitarray(endian='little')
-        option_bits.fromstring(chr(message[3]))
-        payload = message[4:-2]
-        checksum = message[-2:]
+        def send_frame(self, frame):
+            if self.stats is not None:
+                self.stats.sent(msgtype, len(frame))
+                
+            return self._send(frame)
         
-        # Verify the checksum:
+        def prebuild(factory):
+            for args in prebuilt:
+                option_bits, payload = func(factory, *args)
+                frames[args] = factory._build_message(msgtype, option_bits,
+                                                      payload)
         
-        if checksum != self._checksum(message):
-            raise ProtocolError("Invalid checksum")
+        send_frame.msgtype = msgtype
         
-        # Pass to handler function using some black magic:
+        wrapper.msgtype = msgtype
+        wrapper.compose = compose
+        wrapper.send_frame = send_frame
+        wrapper.prebuild = prebuild
+        wrapper.frames = frames
         
-        getattr(self, 'handle_%s' % MESSAGE_TYPES[msgtype],
-                self._not_implemented)(
-            msgtype, option_bits, payload
-        )
+        return wrapper
+    
+    return decorator
         
         
 class MetaProtocolFactory(BaseProtocolParser):
     """This class is responsible for message generation.
     It shares some processing code with the protocol parser (after all,
-    there is not THAT much difference in what they do)."""
+    there is not THAT much difference in what they do).
     
-    def _compose_message(self, option_bits=None, payload=None, msgtype=None):
-        """Constructs a new message from its different parts,
-        ready to dispatch."""
+    Every send_* method is bound to its message type using the message
+    decorator. Messages are returned as immutable byte strings."""
+    
+    _prebuilt = False
+    
+    def __init__(self):
+        BaseProtocolParser.__init__(self)
+        
+        if not MetaProtocolFactory._prebuilt:
+            MetaProtocolFactory._prebuilt = True
+            
+            for name in dir(MetaProtocolFactory):
+                method = getattr(MetaProtocolFactory, name)
+                if hasattr(method, 'prebuild'):
+                    method.prebuild(self)
+    
+    def _build_message(self, msgtype, option_bits=None, payload=None):
+        """Constructs a new message from its different parts. The option
+        bits are passed as a byte value."""
         
         # Parameter sanity checking (very basic; after all, we're not
         # dealing with user data like we do in the parser)
         
-        if not option_bits:
-            option_bits = self._init_option_bits()
-            
-        assert option_bits.endian() == 'little'     
+        if option_bits is None:
+            option_bits = 0
             
         if not payload:
-            payload = bytearray(0x00)
+            payload = bytearray()
             
-        if not msgtype:
-            caller = inspect.stack()[2][3]
-            if caller.startswith('send_'):
-                msgtype = caller[5:]
-            
-        if isinstance(msgtype, str):
-            msgtype = const.MESSAGE_TYPES_LOOKUP[msgtype]
-            
-        assert msgtype in MESSAGE_TYPES.keys(), "Invalid message type"       
+        assert msgtype in const.MESSAGE_TYPES_DICT, "Invalid message type"
         
-        # Create a new message, including the start byte
-        message = bytearray()
-        message.append(1)
-        
-        # Calculate the length 
+        # Create a new message, including the start byte and the length 
         # (start + len + msgtype + op_bits + 2*crc = 6 bytes)
         
-        message.append(len(payload)+6)
-        
-        message.append(msgtype)
-        message.append(ord(option_bits.tostring()))
+        message = bytearray((1, len(payload)+6, msgtype, option_bits))
         message.extend(payload)
         
         message.extend(self._checksum(message, clip=False))
         
-        return message
+        return bytes(message)
     
-    def send_getDeviceTypeResponse(self, device_type):
-        payload = bytearray(device_type)
-        return self._compose_message(None, payload)
+    def _send(self, message):
+        """Called with every composed message, ready to dispatch. Returns
+        the message; subclasses pass it on to the serial port."""
+        return message
     
-    def send_buttonEvent(self, btn_alpha, option_bits=None):
-        if not option_bits:
-            option_bits = self._init_option_bits()
+    def _compose_message(self, option_bits=None, payload=None, msgtype=None):
+        """Constructs a new message from its different parts and sends it.
+        The message type can be given by name or by number."""
+        
+        if isinstance(msgtype, str):
+            msgtype = const.MESSAGE_TYPES_LOOKUP[msgtype]
             
-        payload = self._init_option_bits()
-        payload[const.BUTTON_ALPHA.index(btn_alpha)] = True
+        frame = self._build_message(msgtype, option_bits, payload)
         
-        return self._compose_message(option_bits, payload)
+        if self.stats is not None:
+            self.stats.sent(msgtype, len(frame))
+            
+        return self._send(frame)
+    
+    @message('getDeviceTypeResponse', prebuilt=[
+        (const.DEVICE_TYPE_ANALOG, ), (const.DEVICE_TYPE_DIGITAL, ),
+        (const.DEVICE_TYPE_DIGITAL_DEV, ), (const.DEVICE_TYPE_ANALOG_DEV, ),
+    ])
+    def send_getDeviceTypeResponse(self, device_type):
+        return None, bytearray((device_type, ))
+    
+    @message('buttonEvent', prebuilt=[
+        (btn_alpha, cb_data)
+        for btn_alpha in const.BUTTON_ALPHA
+        for cb_data in xrange(256)
+    ])
+    def send_buttonEvent(self, btn_alpha, option_bits=0):
+        payload = bytearray((1 << const.BUTTON_IDS[btn_alpha], ))
+        return option_bits, payload
+    
+    # The button slots of the simulator keep the frames of their events
+    compose_buttonEvent = send_buttonEvent.compose
+    send_buttonEvent_frame = send_buttonEvent.send_frame
+    
+    @message('nvalResponse')
+    def send_nvalResponse(self, result, identifier, size, data=b''):
+        """Answers an nval message. data is the value, for reads."""
+        return result, bytearray(messages.Nval.FORMAT.pack(identifier, size) +
+                                 data)
         
         
 class MetaProtocolParser(BaseProtocolParser):
     """The actual message processing happens in this subclass. On the
     MetaProtocol layer (this class!), every handler should return the plain
-    information fetched from the payload. The GUIMetaProtocolParser will
-    override these functions.
-    
-    Packer parsing should be pretty obvious, so no further documentation on this.
-    Note that most values are either unsigned chars or big-endian unsigned shorts.
+    information fetched from the payload, as a message object (see the
+    messages module). The WatchSimulator will override these functions.
     
-    Data should be passed using bytearray's, not binary strings.
+    Payloads can be bytearrays or memoryviews, option bits are ints.
     
     """
     
-    # TODO: return a class or named tuple instead of a simple one
-    
     def handle_setRTC(self, msgtype, option_bits, payload):
-        year = unpack(payload[:2], mode='>h')
-        
-        month = payload[2]
-        day = payload[3]
-        week_day = payload[4]
-        
-        hour = payload[5]
-        minute = payload[6]
-        second = payload[7]
-        
-        # There seems to be an undocumented protocol extension which permits
-        # to set these NVAL properties without issuing an NVAL message. Has
-        # to be verified on an actual watch. The MWM doesn't use this, but
-        # the time set application for PC does.
-        
-        if len(payload) > 8:
-            hrs12 = bool(payload[8])     # undocumented? - 12/24 hrs
-            dayFirst = bool(payload[9])  # undocumented? - DD-MM / MM-DD
-        else:
-            hrs12 = NotImplemented
-            dayFirst = NotImplemented
-        
-        return datetime.datetime(
-            year=year, day=day, month=month,
-            hour=hour, minute=minute, second=second, 
-        ), hrs12, dayFirst
+        return messages.SetRTC.decode(option_bits, payload)
     
     def handle_setLED(self, msgtype, option_bits, payload):
-        return option_bits[0]
+        return messages.SetLED.decode(option_bits, payload)
         
     def handle_setVibrate(self, msgtype, option_bits, payload):
-        action = payload[0]
-        on_time = unpack(payload[1:3])
-        off_time = unpack(payload[3:5])
-        cycles = payload[5]
-        
-        return action, on_time, off_time, cycles
+        return messages.SetVibrate.decode(option_bits, payload)
     
     def handle_enableButton(self, msgtype, option_bits, payload):
-        mode, btn_id, btn_type, cb, cb_data = payload
+        message = messages.EnableButton.decode(option_bits, payload)
         
-        if cb != 0x34:
+        if message.callback != 0x34:
             raise NotImplementedError("Button callback type other than 0x34 not"
                                       "supported")
         
-        return mode, btn_id, btn_type, cb, cb_data
+        return message
     
     def handle_disableButton(self, msgtype, option_bits, payload):
-        mode, index, press_type = payload
-        return mode, index, press_type
+        return messages.DisableButton.decode(option_bits, payload)
     
     def handle_writeLCD(self, msgtype, option_bits, payload):
-        mode = ord(option_bits[0:3].tobytes())
-        two_lines = (not option_bits[4]) and (len(payload) > 13)
-        
-        # At the moment, there are some hard-coded checks
-        # for two_lines. This introduces some redundant code.
-        
-        line1 = bitarray(endian='little')
-        line2 = bitarray(endian='little')
-        
-        line1.frombytes(str(payload[1:13]))
-        
-        if two_lines:
-            line2.frombytes(str(payload[14:26]))
-            
-        if two_lines:
-            index = payload[0], payload[13]
-        else:
-            index = (payload[0], )
-        
-        return mode, two_lines, line1, line2, index
+        return messages.WriteLCD.decode(option_bits, payload)
     
     def handle_updateLCD(self, msgtype, option_bits, payload):
-        # TODO: implement undocumented 'activate' flag
-        return ord(option_bits[0:3].tobytes())
+        return messages.UpdateLCD.decode(option_bits, payload)
+    
+    def handle_nval(self, msgtype, option_bits, payload):
+        if option_bits not in (const.NVAL_INIT, const.NVAL_READ,
+                               const.NVAL_WRITE):
+            raise NotImplementedError("NVAL operation 0x%02x not supported"
+                                      % option_bits)
         
-def unpack(bytestr, mode='<h'):
-    """Unpacks the binary representation of an unsigned short."""
-    return struct.unpack(mode, str(bytestr))[0]
+        return messages.Nval.decode(option_bits, payload)
         
 def tc2ba(text_chain):
     """Debug helper: Turns a hex character list into a bytearray."""
@@ -286,9 +540,9 @@ def main():
     message = factory.send_getDeviceTypeResponse(const.DEVICE_TYPE_DIGITAL)
     
     try:
-        print parser.parse(message)
-    except NotImplementedError:
-        pass
+        parser.parse(message)
+    except NotImplementedError, e:
+        print e
 
 
 if __name__ == '__main__':
@@ -104,6 +104,12 @@ MESSAGE_TYPES = defaultdict(lambda: '<undocumented>')
 MESSAGE_TYPES.update(MESSAGE_TYPES_DICT)
 MESSAGE_TYPES_LOOKUP = dict((v,k) for k, v in MESSAGE_TYPES.iteritems())
 
+# Indexed by message type, used for dispatching (doesn't grow on lookups,
+# unlike the defaultdict above)
+
+MESSAGE_TYPE_NAMES = tuple(MESSAGE_TYPES_DICT.get(msgtype, '<undocumented>')
+                           for msgtype in xrange(256))
+
 # Actual constants
 
 DEVICE_TYPE_ANALOG = 1
@@ -115,11 +121,28 @@ MODE_IDLE = 0
 MODE_APP = 1
 MODE_NOTIFY = 2
 
+MODES = 3                       # Number of display modes (and buffers)
+
 BUTTON_TYPE_IMMEDIATE = 0
 BUTTON_TYPE_PRESS = 1
 BUTTON_TYPE_HOLD = 2
 BUTTON_TYPE_LONG_HOLD = 3
 
+BUTTON_TYPES = 4                # Number of press types
+
+# Option bits
+
+OPTION_LED_ON = 0x01            # setLED
+OPTION_BUFFER_MASK = 0x07       # writeLCD, updateLCD: display buffer
+OPTION_SINGLE_LINE = 0x10       # writeLCD: only one line is written
+
+NVAL_INIT = 0x01                # nval: operation
+NVAL_READ = 0x02
+NVAL_WRITE = 0x03
+
+NVAL_SUCCESS = 0x00             # nvalResponse: result
+NVAL_FAILURE = 0x01
+
 # Assumptions
 
 LED_TIMEOUT = 10000
@@ -128,7 +151,10 @@ BUTTON_LONG_HOLD_TIME = 1000
 
 # GUI constants
 
+DISPLAY_MAX_FPS = 30
+
 BUTTON_ALPHA = ('A', 'B', 'C', 'D', ' ', 'E', 'F', 'P')
+BUTTON_IDS = dict((btn, btn_id) for btn_id, btn in enumerate(BUTTON_ALPHA))
 BUTTON_REAL_IDS = [0, 1, 2, 3, 5, 6]
 
 # Textual representations
@@ -10,243 +10,172 @@
 #   option) any later version.
 #
 
-"""This file contains the GUI protocol parser, which is """
+"""This file contains the GUI protocol parser, which observes the watch
+simulator and mirrors its state in the GUI, and the GUI protocol factory."""
 
 import sys, os
+import math
 import logging
-import struct
-import threading
-
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
+import time
+import Queue
 
 import wx
-import wx.propgrid as wxpr
-import numpy
-
 import protocol_constants as const
 import protocol
+import capture
+import logpipe
 
-from protocol import MetaProtocolParser, MetaProtocolFactory
+from protocol import MetaProtocolFactory
+from simulator import WatchSimulator
+from clock import Clock
 
 
-class GUIMetaProtocolParser(MetaProtocolParser):
-    """This class has direct access to the main GUI and subclasses the
-    protocol parser. This is the 'glue code' between the protocol layer and
-    the GUI representation - this class takes the parsed values and updates
-    the GUI accordingly."""
+class WxClock(Clock):
+    """Clock which runs its timers on the GUI thread, using a single wx
+    timer which is set to the next deadline. (The simulator only keeps one
+    timer here, the one driving its timer wheel.)"""
     
-    def __init__(self, window):
-        MetaProtocolParser.__init__(self)
-        self.window = window
-        self.logger = logging.getLogger('parser')
+    def __init__(self):
+        Clock.__init__(self)
+        self.wx_timer = wx.PyTimer(self._run)
         
-        self.vibrate = threading.Event()
-        self.active_timeout = None
+    def call_later(self, delay, func, *args):
+        timer = Clock.call_later(self, delay, func, *args)
         
-        if 0:
-            # Wing IDE type hints
-            import metasimulator
-            isinstance(self.window, metasimulator.MainFrame)
+        if self.timers[0] is timer:
+            self._arm()
             
-    @property
-    def active_buffer(self):
-        return self.window.m_watchMode.Selection
+        return timer
     
-    @active_buffer.setter
-    def active_buffer(self, value):
-        self.window.m_watchMode.Selection = value
-        self.refresh_bitmap(value)
-        self.update_button_colors()
+    def _arm(self):
+        timeout = self.next_timeout()
         
-    @property
-    def display_buffer(self):
-        return self.display_buffers[self.active_buffer]
-    
-    @display_buffer.setter
-    def display_buffer(self, value):
-        self.display_buffers[self.active_buffer] = value
+        if timeout is None:
+            self.wx_timer.Stop()
+        else:
+            self.wx_timer.Start(max(1, int(math.ceil(timeout * 1000))),
+                                wx.TIMER_ONE_SHOT)
             
-    def watch_reset(self):
-        """Called when internal watch state is reset
-        and on initialization.
-        
-        Anything that represents a certain state
-        should be reset here (registers etc.)."""
-        
-        self.vibrate.clear()
-        self.button_mapping = {}
+    def _run(self):
+        self.run_due()
+        self._arm()
+    
+    
+class GUIMetaProtocolParser(WatchSimulator):
+    """This class has direct access to the main GUI and subclasses the
+    watch simulator. This is the 'glue code' between the simulator and
+    the GUI representation - the simulator keeps the watch state, this class
+    only observes its changes (see the on_* hooks) and updates the GUI
+    accordingly."""
+    
+    def __init__(self, window):
+        WatchSimulator.__init__(self, window.factory, WxClock())
+        self.window = window
         
-        self.display_buffers = [
-            numpy.zeros( (96, 96, 3),'uint8'),  # Idle
-            numpy.zeros( (96, 96, 3),'uint8'),  # Application
-            numpy.zeros( (96, 96, 3),'uint8'),   # Notification
-        ]
+        # Display repaints are coalesced, see schedule_refresh
+        self.max_fps = const.DISPLAY_MAX_FPS
+        self.refresh_timer = self.timers.timer(self._scheduled_refresh)
+        self.last_refresh = 0
         
-        self.active_buffer = 0
+        # Current background colors of the side buttons, by button id
+        self.button_colors = dict.fromkeys(const.BUTTON_REAL_IDS)
+        self.bitmap = None
+        self.bitmap_buffer = None
         
-        for buffer in self.display_buffers:
-            buffer[:,:,] = 255
-            
-        #template = wx.Image("template.bmp").GetData()
-        #self.display_buffer = numpy.fromstring(template,
-                            #dtype='uint8').reshape((96, 96, 3))
+        if 0:
+            # Wing IDE type hints
+            import metasimulator
+            isinstance(self.window, metasimulator.MainFrame)
             
-        if self.active_timeout:
-            self.active_timeout.Stop()
+    def on_reset(self):
+        self.window.m_LEDNotice.Hide()
+        self.window.m_vibrateNotice.Hide()
+        self.on_mode(self.active_buffer)
         
+    def on_mode(self, mode):
+        self.window.m_watchMode.Selection = mode
         self.refresh_bitmap()
+        self.update_button_colors()
         
-    def refresh_bitmap(self, buffer_id=None):
-        if not buffer_id:
-            buffer_id = self.active_buffer
-            
-        image = wx.EmptyImage(96, 96)
-        image.SetData(self.display_buffer.tostring())
-        
-        self.bitmap = wx.BitmapFromImage(image)
-        
-        if buffer_id == self.active_buffer:
-            self.window.m_display.Refresh()
-        
-    def draw_bitmap(self, dc):
-        dc.Clear()
-        dc.DrawBitmap(self.bitmap, 0, 0, True)
-        
-    def handle_setRTC(self, *args, **kwargs):
-        date, hrs12, dayFirst = \
-            MetaProtocolParser.handle_setRTC(self, *args, **kwargs)
+    def on_display(self, mode, rows):
+        # This will refresh the current view 'live' as data arrives,
+        # not sure if the real watch does this as well.
         
-        self.window.clock_offset = relativedelta(date, datetime.now())
+        if (mode == self.active_buffer) and self.window.m_liveView.Value:
+            self.schedule_refresh()
+            
+    def on_buttons(self, mode, btn_id):
+        if mode == self.active_buffer:
+            self._update_button_color(btn_id)
         
-        if hrs12 != NotImplemented:
-            # Inofficial protocol extension, see protocol parser
-            self.window.nval_store['nval_2009'] = int(not hrs12)
-            self.window.nval_store['nval_200A'] = int(dayFirst)
+    def on_vibrate(self, state):
+        self.window.m_vibrateNotice.Show(state)
         
-        self.logger.info("RTC time set (offset %d secs)",
-                         self.window.clock_offset.seconds)
+    def on_led(self, state):
+        self.window.m_LEDNotice.Show(state)
         
+    def on_rtc(self):
         # Update live clock
         self.window.OnClock()
         
-    def handle_setLED(self, *args, **kwargs):
-        state = MetaProtocolParser.handle_setLED(self, *args, **kwargs)
+    def refresh_bitmap(self, buffer_id=None):
+        """Updates the bitmap shown on the display panel. If it already
+        shows the active buffer, only the band of rows which changed since
+        the last refresh is converted and blitted into it."""
         
-        if state:
-            self.window.m_LEDNotice.Show()
-            # Hardcoded, what does a real watch do?
-            wx.CallLater(const.LED_TIMEOUT, self.window.m_LEDNotice.Hide)
-        else:
-            self.window.m_LEDNotice.Hide()
+        if buffer_id is None:
+            buffer_id = self.active_buffer
             
-        self.logger.info("Changed LED state to %d", state)
-        
-    def _vibrateTimer(self, cycles_left, on_time, off_time, state):
-        """Recursive timer. The vibration, which usually consists of multiple
-        cycles, is handled using GUI events, i.e. timers.
-        
-        The timer sets itself until there are no more cycles left. It can
-        be interrupted by clearing the vibrate flag."""
-        
-        if not self.vibrate.is_set():
-            return  # cancelled
-        
-        if state:
-            self.window.m_vibrateNotice.Show()
-        else:
-            self.window.m_vibrateNotice.Hide()
-                        
-        if cycles_left:
-            wx.CallLater(on_time if state else off_time,
-                         self._vibrateTimer,
-                         cycles_left-1, on_time, off_time, not state)
-        else:
-            self.vibrate.clear()
-        
+        if buffer_id != self.active_buffer:
+            return
         
-    def handle_setVibrate(self, *args, **kwargs):
-        action, on_time, off_time, cycles = \
-            MetaProtocolParser.handle_setVibrate(self, *args, **kwargs)
+        buffer = self.display_buffer
         
-        if action:
-            self.vibrate.set()
-            self.logger.info("Vibrate %d times for %d/%d msecs" %
-                             (cycles, on_time, off_time))
-            
-            self._vibrateTimer(cycles+2, on_time, off_time, 1)
-        else:
-            self.window.m_vibrateNotice.Hide()
-            self.vibrate.clear()
+        if buffer is not self.bitmap_buffer:
+            image = wx.EmptyImage(96, 96)
+            image.SetData(buffer.rgb().tostring())
             
-    def _button_press(self, btn, msecs):
-        if msecs == 0:
-            ptype = const.BUTTON_TYPE_IMMEDIATE
-        elif msecs > const.BUTTON_LONG_HOLD_TIME:
-            ptype = const.BUTTON_TYPE_LONG_HOLD
-        elif msecs > const.BUTTON_HOLD_TIME:
-            ptype = const.BUTTON_TYPE_HOLD
-        else:
-            # No hold-press, IMMEDIATE triggered anyway
-            ptype = 0
+            self.bitmap = wx.BitmapFromImage(image)
+            self.bitmap_buffer = buffer
             
-        self._send_button_response(btn, ptype)
-            
-    def _send_button_response(self, btn, ptype):
-        btn_hash = (self.active_buffer,
-                    const.BUTTON_ALPHA.index(btn), ptype)
+            self.window.m_display.Refresh()
+            return
         
-        if not btn_hash in self.button_mapping:
-            # Button not registered
+        rows = buffer.expand()
+        
+        if not rows:
             return
         
-        cb, cb_data = self.button_mapping[btn_hash]
+        top, height = rows[0], rows[-1] - rows[0] + 1
         
-        assert cb == 0x34
+        image = wx.EmptyImage(96, height)
+        image.SetData(buffer.rgb()[top:top+height].tostring())
         
-        self.window.factory.send_buttonEvent(
-            btn_alpha=btn,
-            option_bits=cb_data, 
-        )
-            
-    def _button_hash_repr(self, req_hash):
-        """Helper function which returns a human-readable
-        representation of a (mode, btn_id, btn_type) message."""
+        dc = wx.MemoryDC(self.bitmap)
+        dc.DrawBitmap(wx.BitmapFromImage(image), 0, top)
+        dc.SelectObject(wx.NullBitmap)
         
-        mode = const.TEXT_DISPLAY_MODE[req_hash[0]]
-        btn_id = const.BUTTON_ALPHA[req_hash[1]]
-        btn_type = const.TEXT_BUTTON_TYPE[req_hash[2]]
+        self.window.m_display.RefreshRect(wx.Rect(0, top, 96, height))
         
-        return ("button {btn_id} for "
-                "{mode} mode ({btn_type})".format(**locals()))
-            
-    def handle_enableButton(self, *args, **kwargs):
-        mode, btn_id, btn_type, cb, cb_data = \
-            MetaProtocolParser.handle_enableButton(self, *args, **kwargs)
+    def schedule_refresh(self):
+        """Requests a refresh of the display. Requests are coalesced: no
+        matter how many rows are written in the meantime, the display is
+        repainted at most max_fps times per second."""
         
-        req_hash = (mode, btn_id, btn_type)
+        if self.refresh_timer.pending:
+            return
         
-        if req_hash in self.button_mapping:
-            self.logger.info("Re-registered %s", self._button_hash_repr(req_hash))
-        else:
-            self.logger.info("Registered %s", self._button_hash_repr(req_hash))
-            
-        data = self._init_option_bits(True)
-        data.fromstring(chr(cb_data))
-            
-        self.button_mapping[req_hash] = (cb, data)
-        self.update_button_colors()
+        delay = self.last_refresh + 1.0 / self.max_fps - time.time()
+        self.timers.schedule(self.refresh_timer, max(0, delay))
+        
+    def _scheduled_refresh(self):
+        self.last_refresh = time.time()
+        self.refresh_bitmap()
+        
+    def draw_bitmap(self, dc):
+        dc.Clear()
+        dc.DrawBitmap(self.bitmap, 0, 0, True)
         
-    def handle_disableButton(self, *args, **kwargs):
-            button_config = MetaProtocolParser.handle_disableButton(self, *args, **kwargs)
-            
-            if button_config in self.button_mapping:
-                self.button_mapping.pop(button_config)
-                self.update_button_colors()
-                self.logger.info("Button mapping %r removed", [button_config])
-            else:
-                self.logger.debug("Button mapping %r does not exist", [button_config])
-                
     def _button_by_name(self, btn_id):
         """Returns the button object given its protocol ID."""
         
@@ -255,67 +184,26 @@ class GUIMetaProtocolParser(MetaProtocolParser):
 
         return control
                 
-    def update_button_colors(self):
+    def _update_button_color(self, btn_id):
         # TODO: different colors for different action types
         
-        for btn_id in const.BUTTON_REAL_IDS:
-            self._button_by_name(btn_id).SetBackgroundColour(None)
-        
-        for mapping in self.button_mapping:
-            if mapping[0] == self.active_buffer:
-                self._button_by_name(mapping[1]).SetBackgroundColour('gray')
-                
-    def _reset_mode(self, last=0):
-        self.active_buffer = last
-        self.window.logger.info("Buffer timeout, reset to [%d] %s", last, 
-                             self.window.m_watchMode.GetItemLabel(last))
+        if btn_id not in self.button_colors:
+            # No such button on the GUI
+            return
         
-    def handle_updateLCD(self, *args, **kwargs):
-            mode = MetaProtocolParser.handle_updateLCD(self, *args, **kwargs)
+        if self.state.registered[self.active_buffer][btn_id]:
+            color = 'gray'
+        else:
+            color = None
             
-            self.logger.info("Active buffer set to [%d] %s", mode, 
-                             self.window.m_watchMode.GetItemLabel(mode))
-
-            if mode > 0:
-                timeout = 'nval_0005' if mode == 1 else 'nval_0006'
-                if self.active_timeout:
-                    self.active_timeout.Stop()
-                self.active_timeout = wx.CallLater(self.window.nval_store[timeout]*1000,
-                                                   self._reset_mode, 0)
+        # Only buttons whose color changes are touched
+        if color != self.button_colors[btn_id]:
+            self.button_colors[btn_id] = color
+            self._button_by_name(btn_id).SetBackgroundColour(color)
                 
-                # TODO: correct buffer reset
-                # TODO: interaction between timer and 'Manual mode' checkbox
-            
-            self.active_buffer = mode
-    
-    def handle_writeLCD(self, *args, **kwargs):
-        mode, two_lines, line1, line2, index = \
-            MetaProtocolParser.handle_writeLCD(self, *args, **kwargs)
-        
-        lines = (line1, line2) if two_lines else (line1, )
-        
-        # TODO: pass entire row to numpy
-        
-        for i, line1 in enumerate(lines):
-            for n, byte in enumerate(line1.unpack(zero='\xff', one='\x00')):
-                self.display_buffers[mode][index[i]][n] = ord(byte)
-
-        # This will refresh the current view 'live' as data arrives,
-        # not sure if the real watch does this as well.
-        
-        if (mode == self.active_buffer) and self.window.m_liveView.Value:
-            self.refresh_bitmap(mode)
-            
-    def handle_getDeviceType(self, *args, **kwargs):
-        if self.window.m_blockIdle.Value:
-            self.logger.info("Denied device type request")
-            return
-        
-        self.window.factory.send_getDeviceTypeResponse(
-            const.DEVICE_TYPE_DIGITAL
-        )
-        
-        self.logger.info("Responded to device type query: DEVICE_TYPE_DIGITAL")
+    def update_button_colors(self):
+        for btn_id in const.BUTTON_REAL_IDS:
+            self._update_button_color(btn_id)
                       
                       
 class GUIMetaProtocolFactory(MetaProtocolFactory):
@@ -329,12 +217,24 @@ class GUIMetaProtocolFactory(MetaProtocolFactory):
             import metasimulator
             isinstance(self.window, metasimulator.MainFrame)        
         
-    def _compose_message(self, option_bits=None, payload=None, msgtype=None):
-        message = MetaProtocolFactory._compose_message(self, option_bits,
-                                                         payload, msgtype)
+    def _send(self, message):
+        # The GUI thread must not wait for a slow link
+        try:
+            self.window.write_queue.put_nowait(message)
+        except Queue.Full:
+            self.window.write_queue.dropped += 1
+            
+            if self.stats is not None:
+                self.stats.unsent()
+                
+            self.logger.error("Write queue full, message dropped")
+            return
+        
+        if self.window.capture is not None:
+            self.window.capture.write(capture.TX, message)
+        
+        self.logger.debug("Sent data: %s", logpipe.hexdump(message))
         
-        self.window.write_queue.put(message)
-        self.logger.debug("Sent data: %s", ' '.join(["%02X" %
-                                  byte for byte in message]))
+        return message
         
         
\ No newline at end of file
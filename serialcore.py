@@ -12,7 +12,11 @@
 #   Based on parts of PySerial's examples.
 #
 
-"""This module contains the serial RX/TX thread. Pretty self-explanatory and boring."""
+"""This module contains the serial RX/TX thread. Pretty self-explanatory and boring.
+
+Received data is reassembled into messages on the serial thread already.
+The GUI thread is only woken up when messages are waiting, and always takes
+all of them at once."""
 
 import sys, os, time
 
@@ -20,20 +24,23 @@ import wx
 import serial
 import threading
 import logging
-import Queue
+
+import serialio
+import protocol
+import capture
 
 SERIALRX = wx.NewEventType()
 # bind to serial data receive events
 EVT_SERIALRX = wx.PyEventBinder(SERIALRX, 0)
 
 class SerialRxEvent(wx.PyCommandEvent):
+    """Signals that received messages are waiting, see TakeRxBatch."""
     eventType = SERIALRX
-    def __init__(self, windowID, data):
+    def __init__(self, windowID):
         wx.PyCommandEvent.__init__(self, self.eventType, windowID)
-        self.data = data
 
     def Clone(self):
-        self.__class__(self.GetId(), self.data)
+        return self.__class__(self.GetId())
         
 class SerialMixin(object):
     def __init__(self):
@@ -42,10 +49,24 @@ class SerialMixin(object):
         self.thread = None
         self.alive = threading.Event()
         self.logger = logging.getLogger("serial")
-        self.write_queue = Queue.Queue()
+        self.write_queue = serialio.WriteQueue()
+        
+        self.rx_framer = protocol.FrameReassembler()
+        self.rx_lock = threading.Lock()
+        self.rx_batch = []
+        self.rx_received = None
+        self.batch_received = None
+        self.rx_event_pending = False
+        
+        # capture.CaptureWriter recording the session, if any
+        self.capture = None
+        
+        # stats.Stats of the simulated watch, if enabled
+        self.stats = None
         
     def StartThread(self):
         """Start the receiver thread"""        
+        self.rx_framer.reset()
         self.thread = threading.Thread(target=self.ComPortThread)
         self.thread.setDaemon(1)
         self.alive.set()
@@ -55,34 +76,102 @@ class SerialMixin(object):
         """Stop the receiver thread, wait util it's finished."""
         if self.thread is not None:
             self.alive.clear()          #clear alive event for thread
+            self.write_queue.wakeup()   #interrupt the I/O loop
             self.thread.join()          #wait until thread has finished
             self.thread = None
             
+    def OnSerialData(self, data):
+        """Called by the serial thread for every received chunk. Complete
+        messages are dissected and added to the pending batch. A new event
+        is only posted if the GUI has taken the previous batch already."""
+        
+        if self.capture is not None:
+            self.capture.write(capture.RX, data)
+            
+        if self.stats is not None:
+            self.stats.bytes_in += len(data)
+        
+        self.rx_framer.feed(data)
+        messages = [protocol.dissect(frame) for frame in self.rx_framer]
+        
+        if not messages:
+            return
+        
+        with self.rx_lock:
+            if not self.rx_batch:
+                self.rx_received = time.time()
+                
+            self.rx_batch.extend(messages)
+            
+            if self.rx_event_pending:
+                return
+            
+            self.rx_event_pending = True
+        
+        self.GetEventHandler().AddPendingEvent(SerialRxEvent(self.GetId()))
+        
+    def OnSerialWritten(self, nbytes):
+        """Called by the serial thread after writing queued messages. The
+        responses count as sent now, not when they were queued."""
+        
+        stats = self.stats
+        
+        if stats is not None:
+            stats.written(nbytes)
+            
+    def TakeRxBatch(self):
+        """Returns all messages received since the last call, as a list of
+        (msgtype, option_bits, payload) tuples. Called by the GUI thread.
+        batch_received is set to the time the oldest of them arrived."""
+        
+        with self.rx_lock:
+            batch, self.rx_batch = self.rx_batch, []
+            self.batch_received = self.rx_received
+            self.rx_event_pending = False
+            
+        return batch
+            
     def ComPortThread(self):
-        """Thread that handles the incomming traffic. Does the basic input
-           transformation (newlines) and generates an SerialRxEvent"""
+        """Thread that handles the serial traffic. Received chunks are
+        passed to OnSerialData, queued messages are sent immediately.
         
-        self.serial.setTimeout(0.1)
+        Ports with a file descriptor are handled by the event-driven
+        serialio.SerialIOLoop, all others (i.e. on Windows) are polled."""
+        
+        try:
+            fd = self.serial.fileno()
+        except (AttributeError, IOError, ValueError):
+            fd = None
+        
+        try:
+            if fd is not None and serialio.fcntl:
+                serialio.SerialIOLoop(fd, self.write_queue, self.OnSerialData,
+                                      on_write=self.OnSerialWritten
+                                      ).run(self.alive)
+            else:
+                self.PollingLoop()
+        except:
+            self.logger.exception("Failed to read/write from/to serial port")
+            self.alive.clear()
+            
+            # TODO: restart thread in case of failure
+            
+    def PollingLoop(self):
+        """Fallback for ports without a file descriptor. Queued messages are
+        written before every read, the read timeout is kept short."""
+        
+        self.serial.setTimeout(0.01)
         
         while self.alive.isSet():               #loop while alive event is true
-            try:
-                text = self.serial.read(1)          #read one, with timout
-                if text:                            #check if not timeout
-                    n = self.serial.inWaiting()     #look if there is more to read
-                    if n:
-                        text = text + self.serial.read(n) #get it
-    
-                    event = SerialRxEvent(self.GetId(), text)
-                    self.GetEventHandler().AddPendingEvent(event)
+            data = self.write_queue.drain()
+            if data:
+                self.serial.write(data)
+                self.OnSerialWritten(len(data))
                 
-                if not self.write_queue.empty():
-                    self.serial.write(self.write_queue.get_nowait())
-                    
-                #time.sleep(0.01)
+            text = self.serial.read(1)          #read one, with timout
+            if text:                            #check if not timeout
+                n = self.serial.inWaiting()     #look if there is more to read
+                if n:
+                    text = text + self.serial.read(n) #get it
                     
-            except:
-                self.logger.exception("Failed to read/write from/to serial port")
-                self.alive.clear()
-                self.thread.stop()
-                
-                # TODO: restart thread in case of failure
\ No newline at end of file
+                self.OnSerialData(text)
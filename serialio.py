@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""This module contains the event-driven serial I/O loop. It doesn't depend
+on the GUI and works on anything which has a file descriptor: serial ports,
+pseudo-terminals (os.openpty() pairs are handy for testing) or pipes.
+
+Instead of polling the port with read timeouts, the loop waits in select()
+until the port becomes readable or writable, or until a message is put into
+the write queue. Outgoing messages are therefore written right away instead
+of waiting for the next read timeout.
+
+Messages are only taken out of the write queue when the port accepts data,
+and only up to PENDING_LIMIT bytes which haven't been written yet. If the
+link is slower than the application, the queue fills up; producers which
+mustn't block (like the GUI) drop their messages then and count them in
+WriteQueue.dropped."""
+
+import os
+import time
+import errno
+import select
+import Queue
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    # Windows, where serial ports don't have descriptors
+
+# Default capacity of the write queue (in messages), which keeps producers
+# from running away from a slow link
+WRITE_QUEUE_SIZE = 256
+
+# Bytes the I/O loop takes from the write queue before they have been written
+PENDING_LIMIT = 4096
+
+
+def set_nonblocking(fd):
+    """Returns the previous flags of fd."""
+
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    return flags
+
+
+class WriteQueue(Queue.Queue):
+    """Queue for outgoing messages which can wake up a select() loop. Once
+    fileno() has been called, every put() makes that file descriptor
+    readable until drain() is called.
+
+    The queue also counts the frames and bytes taken out of it, see
+    stats(). Producers count the messages they had to drop because the
+    queue was full in dropped."""
+
+    def __init__(self, maxsize=WRITE_QUEUE_SIZE):
+        Queue.Queue.__init__(self, maxsize)
+        self._wakeup = None
+
+        self.frames = 0
+        self.bytes = 0
+        self.dropped = 0
+        self._last_stats = (time.time(), 0, 0)
+
+    def fileno(self):
+        if self._wakeup is None:
+            self._wakeup = os.pipe()
+            set_nonblocking(self._wakeup[0])
+            set_nonblocking(self._wakeup[1])
+
+            # Messages queued before the loop started
+            if not self.empty():
+                self.wakeup()
+
+        return self._wakeup[0]
+
+    def wakeup(self):
+        """Wakes up the select() loop without queuing anything."""
+
+        if self._wakeup is None:
+            return
+
+        try:
+            os.write(self._wakeup[1], b'\x00')
+        except OSError, e:
+            # A full pipe already wakes up the loop
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _put(self, item):
+        Queue.Queue._put(self, item)
+        self.wakeup()
+
+    def clear_wakeup(self):
+        """Clears the wake-up signal, leaving the messages queued."""
+
+        if self._wakeup is not None:
+            try:
+                while os.read(self._wakeup[0], 4096):
+                    pass
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def drain(self, limit=None):
+        """Clears the wake-up signal and returns the queued messages as a
+        single string, ready to be written in one go. With a limit, only
+        messages are taken until it is reached (or exceeded by the last
+        one); if there are more, the wake-up signal is set again."""
+
+        self.clear_wakeup()
+
+        items = []
+        size = 0
+
+        try:
+            while limit is None or size < limit:
+                items.append(self.get_nowait())
+                size += len(items[-1])
+        except Queue.Empty:
+            pass
+        else:
+            if not self.empty():
+                self.wakeup()
+
+        data = b''.join(items)
+
+        self.frames += len(items)
+        self.bytes += len(data)
+
+        return data
+
+    def stats(self):
+        """Returns the current queue depth, the total number of frames and
+        bytes sent (and of frames dropped) and the rates since the previous
+        call."""
+
+        now = time.time()
+        last_time, last_frames, last_bytes = self._last_stats
+        elapsed = max(now - last_time, 1e-6)
+
+        self._last_stats = (now, self.frames, self.bytes)
+
+        return {
+            'depth': self.qsize(),
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'dropped': self.dropped,
+            'frames_per_sec': (self.frames - last_frames) / elapsed,
+            'bytes_per_sec': (self.bytes - last_bytes) / elapsed,
+        }
+
+
+class PortClosed(IOError): pass
+
+
+class SerialIOLoop(object):
+    """Moves data between a file descriptor and the application. Received
+    chunks are passed to the on_receive callback (on the thread which runs
+    the loop), messages from the write queue are written as soon as the port
+    accepts them. The on_write callback, if given, is called with the number
+    of bytes after every write.
+
+    The port can be a file descriptor or any object with a fileno() method,
+    like a pySerial port."""
+
+    CHUNK_SIZE = 4096
+
+    # The loop wakes up at least this often to check whether it should stop
+    TIMEOUT = 1.0
+
+    def __init__(self, port, write_queue, on_receive,
+                 pending_limit=PENDING_LIMIT, on_write=None):
+        self.fd = port if isinstance(port, int) else port.fileno()
+        self.write_queue = write_queue
+        self.on_receive = on_receive
+        self.on_write = on_write
+        self.pending_limit = pending_limit
+
+        # Data taken from the write queue which hasn't been written yet
+        self.pending = bytearray()
+
+    def _read(self):
+        try:
+            data = os.read(self.fd, self.CHUNK_SIZE)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return
+            if e.errno == errno.EIO:
+                raise PortClosed("Port closed by the other side")
+            raise
+
+        if not data:
+            raise PortClosed("Port closed by the other side")
+
+        self.on_receive(data)
+
+    def _write(self):
+        try:
+            written = os.write(self.fd, self.pending)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+            written = 0
+
+        del self.pending[:written]
+
+        if written and self.on_write is not None:
+            self.on_write(written)
+
+    def run(self, alive):
+        """Runs the loop while the threading.Event alive is set. Call
+        write_queue.wakeup() after clearing it to stop the loop at once.
+        The flags of the file descriptor are restored when the loop ends."""
+
+        fd = self.fd
+        flags = set_nonblocking(fd)
+
+        try:
+            self._run(alive)
+        finally:
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+    def _run(self, alive):
+        fd = self.fd
+        wakeup = self.write_queue.fileno()
+
+        # Whether the write queue has signalled messages which haven't been
+        # taken yet
+        queued = False
+
+        while alive.is_set():
+            readable, writable, _ = select.select(
+                [fd, wakeup], [fd] if self.pending or queued else [], [],
+                self.TIMEOUT)
+
+            # The signal is cleared right away, so that it can always be
+            # waited for (it also stops the loop); the messages are only
+            # taken once there is room for them
+            if wakeup in readable:
+                self.write_queue.clear_wakeup()
+                queued = True
+
+            # Everything which has been queued since the last wake-up (up
+            # to the limit) is written with a single call.
+
+            if fd in writable:
+                room = self.pending_limit - len(self.pending)
+
+                if queued and room > 0:
+                    self.pending += self.write_queue.drain(room)
+                    queued = False
+
+                if self.pending:
+                    self._write()
+
+            if fd in readable:
+                self._read()
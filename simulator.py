@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""
+This module contains the simulated watch itself, without any GUI code.
+
+The WatchState holds everything the watch knows, the WatchSimulator reacts
+to incoming messages by changing that state and sending responses. A GUI
+(or anything else that wants to know what is going on) subclasses the
+simulator and overrides the on_* hooks, which are called after every state
+change. Time is taken from an injectable clock (see the clock module).
+"""
+
+import logging
+import datetime
+
+import stats
+import nvalstore
+import protocol_constants as const
+
+from clock import Clock
+from timerwheel import TimerWheel
+from framebuffer import FrameBuffer
+from protocol import MetaProtocolParser
+
+
+class WatchState(object):
+    """The complete state of a simulated watch. This is plain data; it is
+    changed by the WatchSimulator."""
+
+    def __init__(self, nvals=None):
+        self.display_buffers = [
+            FrameBuffer(),  # Idle
+            FrameBuffer(),  # Application
+            FrameBuffer(),  # Notification
+        ]
+
+        self.active_buffer = const.MODE_IDLE
+
+        # Button slots by mode, button id and press type: None, or the
+        # (callback msgtype, callback data, buttonEvent frame) of the
+        # registered button
+        self.buttons = [[[None] * const.BUTTON_TYPES
+                         for btn_id in xrange(len(const.BUTTON_ALPHA))]
+                        for mode in xrange(const.MODES)]
+
+        # Number of press types registered, by mode and button id
+        self.registered = [[0] * len(const.BUTTON_ALPHA)
+                           for mode in xrange(const.MODES)]
+
+        self.nvals = nvalstore.NVALStore() if nvals is None else nvals
+
+        # Difference between the RTC and the local time
+        self.rtc_offset = datetime.timedelta(0)
+
+        self.vibrating = False
+        self.led = False
+
+    @property
+    def button_mapping(self):
+        """All registered buttons, as a dictionary of (mode, btn_id,
+        btn_type) -> (callback msgtype, callback data)."""
+
+        return dict(((mode, btn_id, btn_type), slot[:2])
+                    for mode, buttons in enumerate(self.buttons)
+                    for btn_id, slots in enumerate(buttons)
+                    for btn_type, slot in enumerate(slots)
+                    if slot is not None)
+
+
+class WatchSimulator(MetaProtocolParser):
+    """Simulates a digital MetaWatch. Incoming messages are applied to the
+    watch state, responses are sent using the factory.
+
+    All on_* methods are hooks which are called after the state has
+    changed; they do nothing by default.
+
+    A persistent NVAL store (see nvalstore.MappedNVALStore) can be passed
+    as nvals. It is kept on reset, like the NVAL memory of a real watch;
+    otherwise every reset starts with the default values."""
+
+    def __init__(self, factory, clock=None, nvals=None):
+        MetaProtocolParser.__init__(self)
+        self.factory = factory
+        self.clock = clock or Clock()
+        self.logger = logging.getLogger('parser')
+
+        self.device_type = const.DEVICE_TYPE_DIGITAL
+        self.deny_device_type = False
+
+        # Response latency model (see the latency module), None to respond
+        # right away
+        self.latency = None
+
+        self.nval_store = nvals
+        self.state = WatchState(nvals)
+
+        # All timeouts of the watch run on its own timer wheel, which is
+        # driven by the clock. The timers are created once and reused.
+        self.timers = TimerWheel(self.clock)
+
+        self._mode_timer = self.timers.timer(self._reset_mode, 0)
+        self._vibrate_timer = self.timers.timer(self._vibrate_step)
+        self._led_timer = self.timers.timer(self._set_led, False)
+        self._nval_flush_timer = self.timers.timer(self.flush_nvals)
+        self._button_times = {}
+
+        # Timers of the responses which are delayed by the latency model
+        self._delayed_responses = set()
+
+    def enable_stats(self, framer=None):
+        """Starts collecting statistics for this watch and its factory.
+        framer is the frame reassembler whose error counters are reported
+        (by default the one of this parser). Returns the Stats instance."""
+
+        self.stats = self.factory.stats = stats.Stats(self.clock)
+        self.stats.framers.append(framer or self.framer)
+
+        return self.stats
+
+    def _respond(self, send, *args):
+        """Sends a response using the given send_* method of the factory,
+        right away or after the delay of the latency model. For the
+        statistics, the response is due to the message being handled or,
+        outside of a handler, to something which happens right now (like
+        a button press)."""
+
+        since = None
+
+        if self.stats is not None:
+            since = self.stats.expect(send.msgtype, self.stats.request_time)
+
+        delay = self.latency.next() if self.latency is not None else 0
+
+        if delay > 0:
+            timer = self.timers.timer(self._send_delayed)
+            timer.args = (timer, send, args, since)
+
+            self._delayed_responses.add(timer)
+            self.timers.schedule(timer, delay)
+        else:
+            self._send_response(send, args, since)
+
+    def _send_delayed(self, timer, send, args, since):
+        self._delayed_responses.discard(timer)
+        self._send_response(send, args, since)
+
+    def _send_response(self, send, args, since):
+        # Responses are paired with their requests here, as delays can
+        # change their order
+        if self.stats is None:
+            return send(*args)
+
+        self.stats.response_since = since
+
+        try:
+            return send(*args)
+        finally:
+            self.stats.response_since = None
+
+    @property
+    def active_buffer(self):
+        return self.state.active_buffer
+
+    @property
+    def display_buffer(self):
+        return self.state.display_buffers[self.state.active_buffer]
+
+    def reset(self):
+        """Resets the watch to its initial state."""
+
+        for timer in (self._mode_timer, self._vibrate_timer, self._led_timer):
+            timer.cancel()
+
+        # The watch doesn't answer anything it received before the reset
+        for timer in self._delayed_responses:
+            timer.cancel()
+
+        self._delayed_responses.clear()
+
+        self._button_times = {}
+
+        self.flush_nvals()
+
+        self.state = WatchState(self.nval_store)
+        self.on_reset()
+
+    # Hooks
+
+    def on_reset(self):
+        """The whole state has been replaced."""
+
+    def on_display(self, mode, rows):
+        """Rows of a display buffer have been written."""
+
+    def on_mode(self, mode):
+        """The active display buffer has changed."""
+
+    def on_buttons(self, mode, btn_id):
+        """The registration of a button in a mode has changed."""
+
+    def on_vibrate(self, state):
+        """The vibration motor has been switched on or off."""
+
+    def on_led(self, state):
+        """The LED has been switched on or off."""
+
+    def on_rtc(self):
+        """The RTC has been set."""
+
+    def on_nval(self, identifier, value):
+        """An NVAL value has been changed."""
+
+    # State changes
+
+    def set_mode(self, mode):
+        self.state.active_buffer = mode
+        self.on_mode(mode)
+
+    def set_nval(self, identifier, value):
+        self.state.nvals[identifier] = value
+        self.on_nval(identifier, value)
+        self._nvals_written()
+
+    def _nvals_written(self):
+        """Flushes the NVAL store a while after the first of a batch of
+        writes, instead of after every single one."""
+
+        if not self._nval_flush_timer.pending:
+            self.timers.schedule(self._nval_flush_timer, nvalstore.FLUSH_DELAY)
+
+    def flush_nvals(self):
+        self._nval_flush_timer.cancel()
+        self.state.nvals.flush()
+
+    def rtc_now(self):
+        """Returns the current time of the watch's RTC."""
+        return self.clock.now() + self.state.rtc_offset
+
+    # Message handlers
+
+    def handle_setRTC(self, *args, **kwargs):
+        message = MetaProtocolParser.handle_setRTC(self, *args, **kwargs)
+
+        self.state.rtc_offset = message.date - self.clock.now()
+
+        if message.hrs12 != NotImplemented:
+            # Inofficial protocol extension, see messages.SetRTC
+            self.set_nval(0x2009, int(not message.hrs12))
+            self.set_nval(0x200a, int(message.day_first))
+
+        self.logger.info("RTC time set (offset %d secs)",
+                         self.state.rtc_offset.total_seconds())
+
+        self.on_rtc()
+
+    def _set_led(self, state):
+        self.state.led = bool(state)
+        self.on_led(self.state.led)
+
+    def handle_setLED(self, *args, **kwargs):
+        state = MetaProtocolParser.handle_setLED(self, *args, **kwargs).state
+
+        if state:
+            # Hardcoded, what does a real watch do?
+            self.timers.schedule(self._led_timer, const.LED_TIMEOUT / 1000.0)
+        else:
+            self._led_timer.cancel()
+
+        self._set_led(state)
+
+        self.logger.info("Changed LED state to %d", state)
+
+    def _vibrate_step(self, cycles_left, on_time, off_time, state):
+        """The vibration, which usually consists of multiple cycles, is
+        handled using timers. Every step switches the motor and schedules
+        the next one until there are no more cycles left; the last step
+        always switches it off."""
+
+        self.state.vibrating = bool(state and cycles_left)
+        self.on_vibrate(self.state.vibrating)
+
+        if cycles_left:
+            self.timers.schedule(self._vibrate_timer,
+                (on_time if state else off_time) / 1000.0,
+                cycles_left-1, on_time, off_time, not state)
+
+    def handle_setVibrate(self, *args, **kwargs):
+        message = MetaProtocolParser.handle_setVibrate(self, *args, **kwargs)
+
+        if message.action:
+            self.logger.info("Vibrate %d times for %d/%d msecs" %
+                             (message.cycles, message.on_time,
+                              message.off_time))
+
+            self._vibrate_step(message.cycles+2, message.on_time,
+                               message.off_time, 1)
+        else:
+            self._vibrate_timer.cancel()
+            self.state.vibrating = False
+            self.on_vibrate(False)
+
+    def button_down(self, btn):
+        """Called when a side button (given by its letter) is pressed."""
+        self._button_times[btn] = self.clock.time()
+        self.press_button(btn, 0)
+
+    def button_up(self, btn):
+        """Called when a side button is released."""
+
+        if btn not in self._button_times:
+            return
+
+        msecs = (self.clock.time() - self._button_times.pop(btn)) * 1000
+        self.logger.debug("Button %s press-release, held %f msecs", btn, msecs)
+        self.press_button(btn, msecs)
+
+    def press_button(self, btn, msecs):
+        """Sends the button event for a press of the given duration."""
+
+        if msecs == 0:
+            ptype = const.BUTTON_TYPE_IMMEDIATE
+        elif msecs > const.BUTTON_LONG_HOLD_TIME:
+            ptype = const.BUTTON_TYPE_LONG_HOLD
+        elif msecs > const.BUTTON_HOLD_TIME:
+            ptype = const.BUTTON_TYPE_HOLD
+        else:
+            # No hold-press, IMMEDIATE triggered anyway
+            ptype = 0
+
+        self._send_button_response(btn, ptype)
+
+    def _send_button_response(self, btn, ptype):
+        slot = self.state.buttons[self.state.active_buffer][
+            const.BUTTON_IDS[btn]][ptype]
+
+        if slot is None:
+            # Button not registered
+            return
+
+        assert slot[0] == 0x34
+
+        self._respond(self.factory.send_buttonEvent_frame, slot[2])
+
+    def _button_hash_repr(self, req_hash):
+        """Helper function which returns a human-readable
+        representation of a (mode, btn_id, btn_type) message."""
+
+        mode = const.TEXT_DISPLAY_MODE[req_hash[0]]
+        btn_id = const.BUTTON_ALPHA[req_hash[1]]
+        btn_type = const.TEXT_BUTTON_TYPE[req_hash[2]]
+
+        return ("button {btn_id} for "
+                "{mode} mode ({btn_type})".format(**locals()))
+
+    def handle_enableButton(self, *args, **kwargs):
+        message = MetaProtocolParser.handle_enableButton(self, *args, **kwargs)
+
+        req_hash = (message.mode, message.btn_id, message.btn_type)
+        slots = self.state.buttons[message.mode][message.btn_id]
+
+        if slots[message.btn_type] is not None:
+            self.logger.info("Re-registered %s", self._button_hash_repr(req_hash))
+        else:
+            self.state.registered[message.mode][message.btn_id] += 1
+            self.logger.info("Registered %s", self._button_hash_repr(req_hash))
+
+        slots[message.btn_type] = (
+            message.callback, message.callback_data,
+            self.factory.compose_buttonEvent(
+                const.BUTTON_ALPHA[message.btn_id], message.callback_data))
+
+        self.on_buttons(message.mode, message.btn_id)
+
+    def handle_disableButton(self, *args, **kwargs):
+        message = MetaProtocolParser.handle_disableButton(self, *args, **kwargs)
+
+        button_config = (message.mode, message.btn_id, message.btn_type)
+        slots = self.state.buttons[message.mode][message.btn_id]
+
+        if slots[message.btn_type] is not None:
+            slots[message.btn_type] = None
+            self.state.registered[message.mode][message.btn_id] -= 1
+            self.on_buttons(message.mode, message.btn_id)
+            self.logger.info("Button mapping %r removed", [button_config])
+        else:
+            self.logger.debug("Button mapping %r does not exist", [button_config])
+
+    def _reset_mode(self, last=0):
+        self.set_mode(last)
+        self.logger.info("Buffer timeout, reset to [%d] %s", last,
+                         const.TEXT_DISPLAY_MODE[last])
+
+    def handle_updateLCD(self, *args, **kwargs):
+        mode = MetaProtocolParser.handle_updateLCD(self, *args, **kwargs).mode
+
+        self.logger.info("Active buffer set to [%d] %s", mode,
+                         const.TEXT_DISPLAY_MODE[mode])
+
+        if mode > 0:
+            timeout = 0x0005 if mode == 1 else 0x0006
+            self.timers.schedule(self._mode_timer, self.state.nvals[timeout])
+
+            # TODO: correct buffer reset
+
+        self.set_mode(mode)
+
+    def handle_writeLCD(self, *args, **kwargs):
+        message = MetaProtocolParser.handle_writeLCD(self, *args, **kwargs)
+
+        buffer = self.state.display_buffers[message.mode]
+
+        buffer.write_row(message.rows[0], message.line1)
+
+        if message.two_lines:
+            buffer.write_row(message.rows[1], message.line2)
+
+        self.on_display(message.mode, message.rows)
+
+    def handle_getDeviceType(self, *args, **kwargs):
+        if self.deny_device_type:
+            self.logger.info("Denied device type request")
+            return
+
+        self._respond(self.factory.send_getDeviceTypeResponse,
+                      self.device_type)
+
+        self.logger.info("Responded to device type query: %d",
+                         self.device_type)
+
+    def handle_nval(self, *args, **kwargs):
+        message = MetaProtocolParser.handle_nval(self, *args, **kwargs)
+
+        identifier, size = message.identifier, message.size
+        nvals = self.state.nvals
+
+        if identifier not in nvals or nvals.size(identifier) != size:
+            self.logger.warn("Unknown NVAL 0x%04x (%d bytes)", identifier,
+                             size)
+            self._respond(self.factory.send_nvalResponse, const.NVAL_FAILURE,
+                          identifier, size)
+            return
+
+        data = b''
+
+        if message.operation == const.NVAL_READ:
+            data = nvals.read(identifier)
+        elif message.operation == const.NVAL_WRITE:
+            nvals.write(identifier, message.data)
+            self.on_nval(identifier, nvals[identifier])
+            self._nvals_written()
+
+        # The store has all values, so there is nothing to initialize
+
+        self.logger.debug("NVAL 0x%04x: %r", identifier, message)
+
+        self._respond(self.factory.send_nvalResponse, const.NVAL_SUCCESS,
+                      identifier, size, data)
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""
+This module contains the instrumentation of the simulator: counters per
+message type, error counters and latency histograms.
+
+Statistics are off by default. Parsers and factories have a stats attribute
+which is None until WatchSimulator.enable_stats() is called, so the cost
+of disabled statistics is one attribute lookup per message. A snapshot of
+everything can be exported as JSON.
+"""
+
+import json
+import time
+import bisect
+import collections
+
+import protocol_constants as const
+
+from clock import Clock
+
+# Responses whose latency is measured from the event which caused them (the
+# request, or a button press), with their labels
+RESPONSES = (
+    (const.MESSAGE_TYPES_LOOKUP['getDeviceTypeResponse'],
+     "getDeviceType to response"),
+    (const.MESSAGE_TYPES_LOOKUP['buttonEvent'], "Button to buttonEvent"),
+    (const.MESSAGE_TYPES_LOOKUP['nvalResponse'], "nval to response"),
+)
+
+
+def percentile(samples, fraction):
+    """Returns the given percentile (0.0 - 1.0) of a list of samples."""
+
+    if not samples:
+        return 0.0
+
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Histogram(object):
+    """Latency histogram with fixed buckets (1-2-5 steps from 1 usec to
+    50 secs). Recording a value costs a binary search; percentiles are
+    reported as the upper bound of their bucket."""
+
+    BOUNDS = tuple(m * 10.0 ** e for e in xrange(-6, 2) for m in (1, 2, 5))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0.0
+
+        rank = fraction * self.count
+        seen = 0
+
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                break
+
+        if index < len(self.BOUNDS):
+            return min(self.BOUNDS[index], self.max)
+
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': [[bound, count] for bound, count
+                        in zip(self.BOUNDS + (None, ), self.counts) if count],
+        }
+
+
+def _by_type(counts):
+    return dict((const.MESSAGE_TYPE_NAMES[msgtype], count)
+                for msgtype, count in enumerate(counts) if count)
+
+
+class Stats(object):
+    """Statistics of one simulated watch.
+
+    Whoever receives data calls received(), which sets rx_time; the parser
+    measures the time from there until a message has been handled, and
+    the factory the time until a response has been sent while handling
+    it. The simulator calls expect() for every response it is going to
+    send (possibly delayed, see the latency module), and sets
+    response_since to the time expect() returned while it sends that very
+    response; the time until it is actually sent is kept per response
+    type. It is measured on the clock of the simulator, so that delays in
+    virtual time count as well.
+
+    Frames count as sent when sent() is called, unless they are written
+    to the link later on another thread (like the serial thread of the
+    GUI): with deferred set, that thread calls written() with every chunk
+    it writes, and the times are taken then.
+
+    The error counters of the frame reassemblers in framers and the
+    current values of the functions in gauges (like queue depths) are
+    read when a snapshot is taken."""
+
+    def __init__(self, clock=None):
+        self.clock = clock or Clock()
+        self.started = time.time()
+
+        self.rx_frames = [0] * 256
+        self.tx_frames = [0] * 256
+        self.not_implemented = [0] * 256
+        self.errors = 0
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        self.rx_time = None
+        self.request_time = None
+        self.response_since = None
+
+        self.rx_to_handled = Histogram()
+        self.request_to_response = Histogram()
+
+        self.responses = dict((msgtype, Histogram())
+                              for msgtype, label in RESPONSES)
+
+        # Frames which haven't been written yet (with deferred set), as
+        # (msgtype, nbytes, request_time, response_since), and the bytes of
+        # the first one which have been written already
+        self.deferred = False
+        self.unwritten = collections.deque()
+        self.partially_written = 0
+
+        self.framers = []
+        self.gauges = {}
+        self.peaks = {}
+
+    def received(self, nbytes, when=None):
+        self.bytes_in += nbytes
+        self.rx_time = time.time() if when is None else when
+
+    def expect(self, msgtype, received=None):
+        """A response of the given type is going to be sent for a request
+        which was received at the given (wall-clock) time, or for an event
+        which happens right now (like a button press). Returns that time
+        on the clock of the simulator (for response_since): the time the
+        request spent in receive batches and queues counts as well."""
+
+        since = self.clock.time()
+
+        if received is not None:
+            since -= max(0.0, time.time() - received)
+
+        return since
+
+    def sent(self, msgtype, nbytes):
+        self.tx_frames[msgtype] += 1
+        self.bytes_out += nbytes
+
+        frame = (msgtype, nbytes, self.request_time, self.response_since)
+
+        if self.deferred:
+            self.unwritten.append(frame)
+        else:
+            self._record_sent(frame, time.time())
+
+    def unsent(self):
+        """The frame of the last call to sent() has been dropped instead
+        of being written (with deferred set)."""
+
+        msgtype, nbytes, _, _ = self.unwritten.pop()
+
+        self.tx_frames[msgtype] -= 1
+        self.bytes_out -= nbytes
+
+    def written(self, nbytes, when=None):
+        """Called by the thread which writes the frames (with deferred
+        set) for every chunk written, at the (wall-clock) time when. Bytes
+        written while no frame is waiting are ignored."""
+
+        when = time.time() if when is None else when
+
+        unwritten = self.unwritten
+        nbytes += self.partially_written
+
+        while unwritten and nbytes >= unwritten[0][1]:
+            frame = unwritten.popleft()
+            nbytes -= frame[1]
+            self._record_sent(frame, when)
+
+        self.partially_written = nbytes if unwritten else 0
+
+    def _record_sent(self, frame, when):
+        msgtype, nbytes, request_time, since = frame
+
+        if request_time is not None:
+            self.request_to_response.record(when - request_time)
+
+        if since is not None and msgtype in self.responses:
+            sent = self.clock.time() - max(0.0, time.time() - when)
+            self.responses[msgtype].record(sent - since)
+
+    def peak(self, name, value):
+        """Keeps the highest value seen (like the largest batch)."""
+        if value > self.peaks.get(name, 0):
+            self.peaks[name] = value
+
+    def snapshot(self):
+        framers = self.framers
+
+        return {
+            'uptime': time.time() - self.started,
+            'rx': {
+                'frames': sum(self.rx_frames),
+                'bytes': self.bytes_in,
+                'by_type': _by_type(self.rx_frames),
+                'not_implemented': _by_type(self.not_implemented),
+                'errors': self.errors,
+                'crc_failures': sum(f.corrupted for f in framers),
+                'length_errors': sum(f.dropped for f in framers),
+                'resynced': sum(f.resynced for f in framers),
+                'garbage_bytes': sum(f.garbage for f in framers),
+            },
+            'tx': {
+                'frames': sum(self.tx_frames),
+                'bytes': self.bytes_out,
+                'by_type': _by_type(self.tx_frames),
+            },
+            'gauges': dict((name, func()) for name, func
+                           in self.gauges.iteritems()),
+            'peaks': dict(self.peaks),
+            'latency': {
+                'rx_to_handled': self.rx_to_handled.snapshot(),
+                'request_to_response': self.request_to_response.snapshot(),
+            },
+            'responses': dict((const.MESSAGE_TYPE_NAMES[msgtype],
+                               histogram.snapshot()) for msgtype, histogram
+                              in self.responses.iteritems()),
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=4, sort_keys=True)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+
+    def summary(self):
+        """Returns the most important figures as (label, text) tuples, for
+        display."""
+
+        snapshot = self.snapshot()
+        rx, tx, latency = snapshot['rx'], snapshot['tx'], snapshot['latency']
+
+        def msecs(histogram):
+            return "p50 %.2f ms, p99 %.2f ms" % (histogram['p50'] * 1000,
+                                                 histogram['p99'] * 1000)
+
+        rows = [
+            ("Frames received", str(rx['frames'])),
+            ("Frames sent", str(tx['frames'])),
+            ("Bytes received/sent", "%d / %d" % (rx['bytes'], tx['bytes'])),
+            ("CRC failures", str(rx['crc_failures'])),
+            ("Length errors", str(rx['length_errors'])),
+            ("Not implemented", str(sum(rx['not_implemented'].values()))),
+            ("Invalid messages", str(rx['errors'])),
+            ("RX to handled", msecs(latency['rx_to_handled'])),
+            ("Request to response", msecs(latency['request_to_response'])),
+        ]
+
+        for msgtype, label in RESPONSES:
+            rows.append((label, msecs(snapshot['responses'][
+                const.MESSAGE_TYPE_NAMES[msgtype]])))
+
+        for name, value in sorted(snapshot['gauges'].iteritems()):
+            rows.append((name, str(value)))
+
+        for name, value in sorted(snapshot['peaks'].iteritems()):
+            rows.append(("Peak " + name, str(value)))
+
+        return rows
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""Helpers shared by the tests."""
+
+import os
+import tty
+import errno
+
+import protocol_constants as const
+
+from capture import ReplayFactory
+from protocol import MetaProtocolFactory, FrameReassembler
+
+
+def build(name, option_bits=0, payload=None):
+    """Returns the frame of a message, given by its name."""
+    return MetaProtocolFactory()._build_message(
+        const.MESSAGE_TYPES_LOOKUP[name], option_bits, payload)
+
+
+class RecordingFactory(ReplayFactory):
+    """Keeps the messages sent by a simulator in messages."""
+
+    def __init__(self):
+        ReplayFactory.__init__(self)
+        self.messages = []
+
+    def _send(self, message):
+        self.messages.append(message)
+        return ReplayFactory._send(self, message)
+
+
+class PtyPeer(object):
+    """The phone side of a pseudo-terminal, like the one of a fleet watch."""
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        tty.setraw(self.fd)
+        self.framer = FrameReassembler()
+        self.frames = []
+
+    def write(self, data):
+        os.write(self.fd, data)
+
+    def poll(self):
+        """Reads what has arrived; returns the frames received so far."""
+
+        try:
+            self.framer.feed(os.read(self.fd, 4096))
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+        self.frames.extend(frame.tobytes() for frame in self.framer)
+        return self.frames
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""Tests of recording and replaying sessions."""
+
+import io
+import unittest
+
+import capture
+import benchmark
+import protocol_constants as const
+
+from clock import VirtualClock
+from simulator import WatchSimulator
+from support import build, RecordingFactory
+
+
+def record(records, start=1000.0):
+    """Returns a capture of the given (time, direction, data) records."""
+
+    f = io.BytesIO()
+    writer = capture.CaptureWriter(f, start)
+
+    for time, direction, data in records:
+        writer.write(direction, data, start + time)
+
+    return f.getvalue()
+
+
+def reader(data):
+    return capture.CaptureReader(io.BytesIO(data))
+
+
+class CaptureFileTest(unittest.TestCase):
+    def test_round_trip(self):
+        records = [(0.5, capture.RX, b'\x01\x06'), (0.75, capture.TX, b'abc'),
+                   (2.0, capture.RX, b'')]
+
+        replayed = reader(record(records))
+
+        self.assertEqual(replayed.start, 1000.0)
+        self.assertEqual([tuple(r) for r in replayed], records)
+
+    def test_version_1(self):
+        data = bytearray(record([(0.5, capture.RX, b'\x01\x06')]))
+        data[len(capture.MAGIC)] = 1
+
+        self.assertEqual([tuple(r) for r in reader(bytes(data))],
+                         [(0.5, capture.RX, b'\x01\x06')])
+
+        data[len(capture.MAGIC)] = capture.VERSION + 1
+        self.assertRaises(capture.CaptureError, reader, bytes(data))
+
+    def test_not_a_capture(self):
+        self.assertRaises(capture.CaptureError, reader, b'MW')
+        self.assertRaises(capture.CaptureError, reader, b'X' * 32)
+
+    def test_truncated(self):
+        data = record([(0.5, capture.RX, b'\x01\x06\x01\x00')])
+
+        self.assertRaises(capture.CaptureError, list, reader(data[:-2]))
+        self.assertRaises(capture.CaptureError, list,
+                          reader(data[:capture.HEADER.size + 3]))
+
+
+class ReplayTest(unittest.TestCase):
+    def session(self):
+        """Generated traffic, split into chunks like a serial port would."""
+
+        generator = benchmark.TrafficGenerator()
+        frames = (generator.lcd_burst() + generator.button_storm()[:40] +
+                  generator.vibrate()[:4] + generator.rtc()[:2] +
+                  [generator.build('getDeviceType'),
+                   generator.build('setLED', 1)])
+
+        return record((i * 0.01, capture.RX, chunk) for i, chunk
+                      in enumerate(generator.chunks(frames)))
+
+    def test_replay(self):
+        simulator, stats = capture.replay(reader(self.session()))
+
+        self.assertEqual(stats['errors'], 0)
+        self.assertEqual(stats['corrupted'], 0)
+        self.assertEqual(stats['frames'], 49 + 40 + 4 + 2 + 2)
+        self.assertEqual(stats['tx_generated'], 1)
+
+        self.assertEqual(simulator.active_buffer, const.MODE_APP)
+        self.assertTrue(simulator.state.led)
+
+    def test_replay_is_deterministic(self):
+        first = capture.snapshot(capture.replay(reader(self.session()))[0])
+        second = capture.snapshot(capture.replay(reader(self.session()))[0])
+
+        self.assertEqual(capture.compare_snapshots(first, second), [])
+
+    def test_compare_snapshots(self):
+        simulator = capture.replay(reader(self.session()))[0]
+        expected = capture.snapshot(simulator)
+
+        simulator.set_mode(const.MODE_NOTIFY)
+
+        self.assertEqual(capture.compare_snapshots(
+            expected, capture.snapshot(simulator)), ['active_buffer'])
+
+
+
+class ButtonReplayTest(unittest.TestCase):
+    def replay(self, records, run_on=0):
+        factory = RecordingFactory()
+        simulator = WatchSimulator(factory, VirtualClock(1000.0))
+
+        return (capture.replay(reader(record(records)), simulator=simulator,
+                               run_on=run_on)[1], simulator, factory)
+
+    def test_hold_durations(self):
+        """Buttons are held for the recorded time, so the registered hold
+        and long hold events are sent."""
+
+        enable = lambda ptype: build('enableButton', 0, bytearray(
+            (const.MODE_IDLE, const.BUTTON_IDS['A'], ptype, 0x34, ptype)))
+
+        stats, simulator, factory = self.replay([
+            (0.0, capture.RX, enable(const.BUTTON_TYPE_HOLD)),
+            (0.0, capture.RX, enable(const.BUTTON_TYPE_LONG_HOLD)),
+            (1.0, capture.BUTTON, b'A\x01'),
+            (1.5, capture.BUTTON, b'A\x00'),
+            (2.0, capture.BUTTON, b'A\x01'),
+            (3.5, capture.BUTTON, b'A\x00'),
+            (4.0, capture.BUTTON, b'A\x01'),
+            (4.1, capture.BUTTON, b'A\x00')])
+
+        self.assertEqual(stats['buttons'], 6)
+        self.assertEqual(stats['records'], 2)
+
+        # The option bits of the button events are the callback data
+        self.assertEqual([bytearray(m)[3] for m in factory.messages],
+                         [const.BUTTON_TYPE_HOLD, const.BUTTON_TYPE_LONG_HOLD])
+
+    def test_run_on(self):
+        records = [(0.0, capture.RX, build('updateLCD', const.MODE_APP))]
+
+        stats, simulator = self.replay(records)[:2]
+        self.assertEqual(simulator.active_buffer, const.MODE_APP)
+
+        stats, simulator = self.replay(records, run_on=3600)[:2]
+        self.assertEqual(simulator.active_buffer, const.MODE_IDLE)
+        self.assertEqual(stats['simulated'], 3600)
+
+
+if __name__ == '__main__':
+    unittest.main()
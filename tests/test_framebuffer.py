@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""Tests of the packed display buffer."""
+
+import random
+import unittest
+
+from framebuffer import FrameBuffer, HEIGHT, WIDTH, STRIDE, PIXEL_VALUES
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def reference_pixels(line):
+    """Rasterizes a packed row one pixel at a time."""
+    return [PIXEL_VALUES[(byte >> bit) & 1]
+            for byte in bytearray(line) for bit in xrange(8)]
+
+
+class FrameBufferTest(unittest.TestCase):
+    def test_write_row(self):
+        buffer = FrameBuffer()
+        buffer.write_row(95, b'\xff' * STRIDE)
+
+        self.assertEqual(buffer.data[-STRIDE:], bytearray(b'\xff' * STRIDE))
+        self.assertEqual(len(buffer.data), HEIGHT * STRIDE)
+
+    def test_write_rows(self):
+        buffer = FrameBuffer()
+        buffer.write_rows((3, 1), b'\x01' * STRIDE + b'\x02' * STRIDE)
+
+        self.assertEqual(buffer.data[3 * STRIDE:4 * STRIDE],
+                         bytearray(b'\x01' * STRIDE))
+        self.assertEqual(buffer.data[STRIDE:2 * STRIDE],
+                         bytearray(b'\x02' * STRIDE))
+
+    def test_rows_outside_of_the_display(self):
+        buffer = FrameBuffer()
+
+        self.assertRaises(ValueError, buffer.write_row, HEIGHT, b'\xff' * STRIDE)
+        self.assertRaises(ValueError, buffer.write_row, 255, b'\xff' * STRIDE)
+        self.assertRaises(ValueError, buffer.write_rows, (0, HEIGHT),
+                          b'\xff' * 2 * STRIDE)
+
+        self.assertEqual(buffer.data, bytearray(HEIGHT * STRIDE))
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class RasterizationTest(unittest.TestCase):
+    def random_line(self, rnd):
+        return bytes(bytearray(rnd.getrandbits(8) for _ in xrange(STRIDE)))
+
+    def check(self, buffer, lines):
+        rgb = buffer.rgb()
+        self.assertEqual(rgb.shape, (HEIGHT, WIDTH, 3))
+
+        for row, line in lines.iteritems():
+            expected = reference_pixels(line)
+
+            for channel in xrange(3):
+                self.assertEqual(list(rgb[row, :, channel]), expected)
+
+    def test_rgb_matches_per_pixel_reference(self):
+        rnd = random.Random(5)
+        buffer = FrameBuffer()
+        lines = {}
+
+        for row in xrange(HEIGHT):
+            lines[row] = self.random_line(rnd)
+            buffer.write_row(row, lines[row])
+
+        self.check(buffer, lines)
+
+    def test_incremental_update(self):
+        rnd = random.Random(6)
+        buffer = FrameBuffer()
+        lines = dict((row, b'\x00' * STRIDE) for row in xrange(HEIGHT))
+
+        self.assertEqual(buffer.expand(), range(HEIGHT))
+        self.assertEqual(buffer.expand(), [])
+
+        for row in (40, 2, 95):
+            lines[row] = self.random_line(rnd)
+            buffer.write_row(row, lines[row])
+
+        self.assertEqual(buffer.expand(), [2, 40, 95])
+        self.check(buffer, lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
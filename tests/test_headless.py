@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""End-to-end tests of headless watches: a request is written to the link
+of the watch, and the response has to come back over it."""
+
+import gc
+import os
+import sys
+import socket
+import unittest
+import subprocess
+
+import latency
+import protocol_constants as const
+
+from fleet import Fleet, FleetWatch
+from clock import VirtualClock
+from eventloop import EventLoop
+from protocol import FrameReassembler, HEADER
+from support import build, PtyPeer
+
+# What an idle fleet watch may take, in bytes
+WATCH_MEMORY = 32 * 1024
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+
+def msgtype(frame):
+    return HEADER.unpack_from(frame)[0]
+
+
+class FleetWatchTest(unittest.TestCase):
+    def ask_device_type(self, fleet, expected_frames=1):
+        peer = PtyPeer(fleet.add_pty_watch())
+        self.addCleanup(peer.close)
+
+        peer.write(build('getDeviceType'))
+        frames = fleet.loop.run_until(
+            lambda: len(peer.poll()) >= expected_frames and peer.frames,
+            timeout=5)
+
+        self.assertTrue(frames, "no response")
+        return fleet.watches[-1], frames
+
+    def check_device_type(self, frames):
+        self.assertEqual(msgtype(frames[0]),
+                         const.MESSAGE_TYPES_LOOKUP['getDeviceTypeResponse'])
+        self.assertEqual(bytearray(frames[0])[4], const.DEVICE_TYPE_DIGITAL)
+
+    def test_device_type(self):
+        watch, frames = self.ask_device_type(Fleet())
+        self.check_device_type(frames)
+        self.assertEqual(watch.link_stats.frames_in, 1)
+        self.assertEqual(watch.link_stats.frames_out, 1)
+
+    def test_device_type_with_stats(self):
+        fleet = Fleet()
+        peer = PtyPeer(fleet.add_pty_watch())
+        self.addCleanup(peer.close)
+
+        stats = fleet.watches[0].simulator.enable_stats()
+
+        peer.write(build('getDeviceType'))
+        self.assertTrue(fleet.loop.run_until(peer.poll, timeout=5))
+        self.check_device_type(peer.frames)
+
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['tx']['by_type'],
+                         {'getDeviceTypeResponse': 1})
+        self.assertEqual(
+            snapshot['responses']['getDeviceTypeResponse']['count'], 1)
+
+    def test_virtual_time_latency(self):
+        clock = VirtualClock(1000.0)
+        fleet = Fleet(EventLoop(clock))
+        peer = PtyPeer(fleet.add_pty_watch())
+        self.addCleanup(peer.close)
+
+        fleet.watches[0].simulator.latency = latency.FixedLatency(30.0)
+        stats = fleet.watches[0].simulator.enable_stats()
+
+        peer.write(build('getDeviceType'))
+        self.assertTrue(fleet.loop.run_until(peer.poll, timeout=60))
+        self.check_device_type(peer.frames)
+
+        # The delay has passed in virtual time only
+        self.assertGreaterEqual(clock.time(), 1030.0)
+        self.assertGreaterEqual(
+            stats.responses[const.MESSAGE_TYPES_LOOKUP[
+                'getDeviceTypeResponse']].max, 30.0)
+
+    def test_nval(self):
+        fleet = Fleet()
+        peer = PtyPeer(fleet.add_pty_watch())
+        self.addCleanup(peer.close)
+
+        peer.write(build('nval', const.NVAL_READ,
+                         bytearray(b'\x09\x20\x01')))
+        self.assertTrue(fleet.loop.run_until(peer.poll, timeout=5))
+
+        frame = bytearray(peer.frames[0])
+        self.assertEqual(msgtype(frame),
+                         const.MESSAGE_TYPES_LOOKUP['nvalResponse'])
+        self.assertEqual(frame[3], const.NVAL_SUCCESS)
+
+
+class FleetMemoryTest(unittest.TestCase):
+    def test_idle_watch_memory(self):
+        """Sums up the objects a new watch allocates (and the strings,
+        bytearrays and numbers they hold), as RSS is too coarse here."""
+
+        loop = EventLoop()
+        FleetWatch(loop, 'warmup')
+
+        gc.collect()
+        before = set(id(obj) for obj in gc.get_objects())
+
+        watches = [FleetWatch(loop, 'watch%d' % i) for i in xrange(20)]
+
+        gc.collect()
+        counted = set()
+        size = 0
+
+        for obj in gc.get_objects():
+            if id(obj) in before or obj is before:
+                continue
+
+            for referent in [obj] + gc.get_referents(obj):
+                if id(referent) in counted or (referent is not obj and
+                                               gc.is_tracked(referent)):
+                    continue
+
+                counted.add(id(referent))
+                size += sys.getsizeof(referent)
+
+        self.assertLess(size / len(watches), WATCH_MEMORY)
+
+
+class HeadlessTest(unittest.TestCase):
+    """Runs metasimulator.py --headless in a subprocess."""
+
+    def free_port(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def run_headless(self, *args):
+        port = self.free_port()
+
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'metasimulator.py'),
+             '--headless', '--tcp', str(port)] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        def stop():
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+
+        self.addCleanup(stop)
+
+        line = process.stdout.readline()
+        self.assertIn("ready", line)
+
+        sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.addCleanup(sock.close)
+
+        return sock
+
+    def receive(self, sock):
+        framer = FrameReassembler()
+
+        while True:
+            data = sock.recv(4096)
+            self.assertTrue(data, "connection closed")
+            framer.feed(data)
+
+            for frame in framer:
+                return frame.tobytes()
+
+    def test_device_type(self):
+        sock = self.run_headless()
+        sock.sendall(build('getDeviceType'))
+
+        frame = self.receive(sock)
+        self.assertEqual(msgtype(frame),
+                         const.MESSAGE_TYPES_LOOKUP['getDeviceTypeResponse'])
+
+    def test_device_type_virtual_time(self):
+        sock = self.run_headless('--virtual-time', '--latency', 'fixed:10')
+        sock.sendall(build('getDeviceType'))
+
+        frame = self.receive(sock)
+        self.assertEqual(msgtype(frame),
+                         const.MESSAGE_TYPES_LOOKUP['getDeviceTypeResponse'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""Tests of the response latency models."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import capture
+import latency
+import protocol_constants as const
+
+from clock import VirtualClock
+from simulator import WatchSimulator
+from support import build, RecordingFactory
+
+
+class FromSpecTest(unittest.TestCase):
+    def test_fixed(self):
+        model = latency.from_spec('fixed:0.05')
+
+        self.assertIsInstance(model, latency.FixedLatency)
+        self.assertEqual([model.next() for i in xrange(3)], [0.05] * 3)
+
+    def test_jitter(self):
+        model = latency.from_spec('jitter:0.05,0.02')
+
+        self.assertIsInstance(model, latency.JitteredLatency)
+        self.assertEqual((model.delay, model.jitter), (0.05, 0.02))
+
+    def test_capture(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'watch.mwcap')
+
+        writer = capture.CaptureWriter(path, 1000.0)
+        writer.write(capture.RX, build('getDeviceType'), 1001.0)
+        writer.write(capture.TX, build('getDeviceTypeResponse', 0,
+                                       bytearray((2, ))), 1001.25)
+        writer.write(capture.TX, build('buttonEvent', 0, bytearray((1, ))),
+                     1001.5)
+        writer.write(capture.RX, build('nval', const.NVAL_READ,
+                                       bytearray(b'\x05\x00\x02')), 1002.0)
+        writer.write(capture.TX, build('nvalResponse'), 1002.5)
+        writer.close()
+
+        model = latency.from_spec('capture:' + path)
+
+        self.assertEqual(model.delays, [0.25, 0.5])
+        self.assertEqual([model.next() for i in xrange(3)], [0.25, 0.5, 0.25])
+
+    def test_invalid_specs(self):
+        for spec in ('', 'fixed', 'fixed:', 'fixed:soon', 'jitter:0.05',
+                     'jitter:0.05,0.02,1', 'jitter:a,b', 'random:0.05'):
+            self.assertRaises(ValueError, latency.from_spec, spec)
+
+    def test_empty_capture(self):
+        self.assertRaises(ValueError, latency.ReplayedLatency, [])
+
+
+class JitteredLatencyTest(unittest.TestCase):
+    def test_range(self):
+        model = latency.JitteredLatency(0.05, 0.02)
+        delays = [model.next() for i in xrange(10000)]
+
+        self.assertGreaterEqual(min(delays), 0.03)
+        self.assertLessEqual(max(delays), 0.07)
+        self.assertAlmostEqual(sum(delays) / len(delays), 0.05, places=3)
+
+        # Both ends of the range are reached
+        self.assertLess(min(delays), 0.031)
+        self.assertGreater(max(delays), 0.069)
+
+    def test_never_negative(self):
+        model = latency.JitteredLatency(0.01, 0.05)
+        delays = [model.next() for i in xrange(1000)]
+
+        self.assertEqual(min(delays), 0.0)
+        self.assertGreater(max(delays), 0.05)
+
+    def test_repeatable(self):
+        first = latency.JitteredLatency(0.05, 0.02, seed=7)
+        second = latency.JitteredLatency(0.05, 0.02, seed=7)
+
+        self.assertEqual([first.next() for i in xrange(100)],
+                         [second.next() for i in xrange(100)])
+
+
+class DelayedResponseTest(unittest.TestCase):
+    def setUp(self):
+        self.factory = RecordingFactory()
+        self.simulator = WatchSimulator(self.factory, VirtualClock(100.0))
+        self.simulator.latency = latency.FixedLatency(1.0)
+
+    def test_delayed(self):
+        self.simulator.dispatch(build('getDeviceType'))
+
+        self.simulator.clock.advance(100.9)
+        self.assertEqual(self.factory.messages, [])
+
+        self.simulator.clock.advance(101.0)
+        self.assertEqual(len(self.factory.messages), 1)
+
+    def test_cancelled_by_reset(self):
+        self.simulator.dispatch(build('getDeviceType'))
+        self.simulator.clock.advance(100.5)
+        self.simulator.reset()
+
+        self.simulator.clock.advance(110.0)
+        self.assertEqual(self.factory.messages, [])
+
+        # Requests after the reset are answered
+        self.simulator.dispatch(build('getDeviceType'))
+        self.simulator.clock.advance(112.0)
+        self.assertEqual(len(self.factory.messages), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
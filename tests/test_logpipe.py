@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""Tests of the logging pipeline: records which don't fit are dropped and
+counted."""
+
+import logging
+import unittest
+
+import logpipe
+
+
+def record(msg, level=logging.INFO):
+    return logging.LogRecord('test', level, __file__, 1, msg, (), None)
+
+
+class QueueHandlerTest(unittest.TestCase):
+    def test_overflow(self):
+        handler = logpipe.QueueHandler(maxsize=3)
+
+        for i in xrange(5):
+            handler.handle(record('record %d' % i))
+
+        self.assertEqual(handler.take_dropped(), 2)
+        self.assertEqual(handler.take_dropped(), 0)
+
+        # The oldest records are kept
+        self.assertEqual([handler.queue.get_nowait().getMessage()
+                          for i in xrange(3)],
+                         ['record 0', 'record 1', 'record 2'])
+
+        handler.handle(record('record 5'))
+        self.assertEqual(handler.take_dropped(), 0)
+
+    def test_listener(self):
+        ring = logpipe.RingBufferHandler()
+        ring.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        ring.setLevel(logging.INFO)
+
+        handler = logpipe.QueueHandler()
+        listener = logpipe.LogListener(handler, [ring])
+        listener.start()
+
+        handler.handle(record('hidden', logging.DEBUG))
+        handler.handle(record('shown', logging.WARNING))
+        listener.stop()
+
+        self.assertEqual(ring.take(),
+                         ([(logging.WARNING, 'WARNING shown')], 0))
+
+
+class RingBufferHandlerTest(unittest.TestCase):
+    def test_overflow(self):
+        handler = logpipe.RingBufferHandler(capacity=3)
+
+        for i in xrange(5):
+            handler.handle(record('line %d' % i))
+
+        # The most recent lines are kept
+        self.assertEqual(handler.take(), ([(logging.INFO, 'line %d' % i)
+                                           for i in (2, 3, 4)], 2))
+        self.assertEqual(handler.take(), ([], 0))
+
+    def test_take_makes_room(self):
+        handler = logpipe.RingBufferHandler(capacity=2)
+
+        handler.handle(record('one'))
+        handler.handle(record('two'))
+        self.assertEqual(handler.take()[1], 0)
+
+        handler.handle(record('three', logging.ERROR))
+        self.assertEqual(handler.take(), ([(logging.ERROR, 'three')], 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""Tests of message decoding, and of invalid messages reaching the
+simulator."""
+
+import unittest
+
+import capture
+import messages
+import protocol_constants as const
+
+from clock import VirtualClock
+from simulator import WatchSimulator
+from support import build, RecordingFactory
+
+LINE = bytearray(xrange(12))
+
+
+def write_lcd(mode, row1, row2=None):
+    if row2 is None:
+        return (mode | const.OPTION_SINGLE_LINE,
+                bytearray([row1]) + LINE)
+
+    return mode, bytearray([row1]) + LINE + bytearray([row2]) + LINE
+
+
+class WriteLCDTest(unittest.TestCase):
+    def test_two_lines(self):
+        message = messages.WriteLCD.decode(*write_lcd(const.MODE_APP, 4, 95))
+
+        self.assertEqual(message.mode, const.MODE_APP)
+        self.assertEqual(message.rows, (4, 95))
+        self.assertEqual(bytearray(message.line1), LINE)
+        self.assertEqual(bytearray(message.line2), LINE)
+
+    def test_single_line(self):
+        message = messages.WriteLCD.decode(*write_lcd(const.MODE_NOTIFY, 0))
+
+        self.assertEqual(message.rows, (0, ))
+        self.assertFalse(message.two_lines)
+
+    def test_invalid_mode(self):
+        for mode in (3, 5, 7):
+            self.assertRaises(ValueError, messages.WriteLCD.decode,
+                              *write_lcd(mode, 0))
+
+    def test_invalid_rows(self):
+        self.assertRaises(ValueError, messages.WriteLCD.decode,
+                          *write_lcd(const.MODE_APP, 96))
+        self.assertRaises(ValueError, messages.WriteLCD.decode,
+                          *write_lcd(const.MODE_APP, 0, 255))
+
+    def test_too_short(self):
+        self.assertRaises(ValueError, messages.WriteLCD.decode, 0,
+                          bytearray(5))
+
+
+class UpdateLCDTest(unittest.TestCase):
+    def test_modes(self):
+        for mode in xrange(const.MODES):
+            self.assertEqual(messages.UpdateLCD.decode(mode, b'').mode, mode)
+
+    def test_invalid_mode(self):
+        for mode in (3, 5, 7):
+            self.assertRaises(ValueError, messages.UpdateLCD.decode, mode, b'')
+
+
+class ButtonTest(unittest.TestCase):
+    def test_enable_button(self):
+        message = messages.EnableButton.decode(0, bytearray((1, 5, 2, 0x34, 9)))
+        self.assertEqual((message.mode, message.btn_id, message.btn_type,
+                          message.callback, message.callback_data),
+                         (1, 5, 2, 0x34, 9))
+
+    def test_invalid_buttons(self):
+        for payload in ((3, 0, 0), (0, 8, 0), (0, 0, 4)):
+            self.assertRaises(ValueError, messages.DisableButton.decode, 0,
+                              bytearray(payload))
+
+
+class ButtonSlotTest(unittest.TestCase):
+    def setUp(self):
+        self.factory = RecordingFactory()
+        self.simulator = WatchSimulator(self.factory, VirtualClock())
+
+    def button(self, name, btn, ptype, callback_data=0):
+        self.simulator.parse(build(name, 0, bytearray(
+            (const.MODE_IDLE, const.BUTTON_IDS[btn], ptype, 0x34,
+             callback_data)[:5 if name == 'enableButton' else 3])))
+
+    def test_press_sends_registered_frame(self):
+        self.button('enableButton', 'B', const.BUTTON_TYPE_IMMEDIATE, 7)
+        self.simulator.press_button('B', 0)
+
+        self.assertEqual(self.factory.messages, [
+            build('buttonEvent', 7, bytearray((1 << const.BUTTON_IDS['B'], )))])
+
+    def test_unregistered_buttons(self):
+        self.button('enableButton', 'B', const.BUTTON_TYPE_HOLD)
+        self.simulator.press_button('B', 0)
+        self.simulator.press_button('A', 500)
+
+        self.assertEqual(self.factory.messages, [])
+
+    def test_mapping(self):
+        self.button('enableButton', 'A', const.BUTTON_TYPE_HOLD, 1)
+        self.button('enableButton', 'A', const.BUTTON_TYPE_HOLD, 2)
+        self.button('enableButton', 'C', const.BUTTON_TYPE_PRESS, 3)
+        self.button('disableButton', 'C', const.BUTTON_TYPE_PRESS)
+
+        self.assertEqual(self.simulator.state.button_mapping, {
+            (const.MODE_IDLE, const.BUTTON_IDS['A'], const.BUTTON_TYPE_HOLD):
+                (0x34, 2)})
+        self.assertEqual(self.simulator.state.registered[const.MODE_IDLE][
+            const.BUTTON_IDS['A']], 1)
+        self.assertEqual(self.simulator.state.registered[const.MODE_IDLE][
+            const.BUTTON_IDS['C']], 0)
+
+
+class InvalidMessagesTest(unittest.TestCase):
+    """Invalid messages raise a ValueError, which the callers of the
+    parser catch; the messages after them are still handled."""
+
+    def test_following_frames_are_handled(self):
+        simulator = WatchSimulator(capture.ReplayFactory(), VirtualClock())
+
+        data = b''.join([
+            build('updateLCD', 5),
+            build('writeLCD', *write_lcd(3, 0)),
+            build('writeLCD', *write_lcd(const.MODE_APP, 200)),
+            build('writeLCD', *write_lcd(const.MODE_APP, 7)),
+            build('updateLCD', const.MODE_APP),
+        ])
+
+        self.assertEqual(capture._feed(simulator, data), 3)
+
+        buffer = simulator.state.display_buffers[const.MODE_APP]
+        self.assertEqual(buffer.data[7 * 12:8 * 12], LINE)
+        self.assertEqual(len(buffer.data), 96 * 12)
+        self.assertEqual(simulator.active_buffer, const.MODE_APP)
+
+
+if __name__ == '__main__':
+    unittest.main()
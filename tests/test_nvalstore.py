@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""Tests of the NVAL store and of nval messages."""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import nvalstore
+import protocol_constants as const
+
+from clock import VirtualClock
+from protocol import HEADER
+from simulator import WatchSimulator
+from support import build, RecordingFactory
+
+APP_TIMEOUT = 0x0005
+TIME_FORMAT = 0x2009
+
+
+class NVALStoreTest(unittest.TestCase):
+    def test_defaults(self):
+        store = nvalstore.NVALStore()
+
+        self.assertEqual(store[APP_TIMEOUT], 600)
+        self.assertEqual(store[TIME_FORMAT], 0)
+        self.assertEqual(store.size(APP_TIMEOUT), 2)
+
+        # Values without a size or default are left out
+        self.assertNotIn(0x0004, store)
+        self.assertIsNone(store.get(0x0004))
+        self.assertRaises(KeyError, store.__getitem__, 0x0004)
+
+    def test_set(self):
+        store = nvalstore.NVALStore()
+        store[APP_TIMEOUT] = 1234
+
+        self.assertEqual(store[APP_TIMEOUT], 1234)
+        self.assertEqual(store.read(APP_TIMEOUT), struct.pack('<H', 1234))
+        self.assertEqual(store.take_changes(), set([APP_TIMEOUT]))
+        self.assertEqual(store.take_changes(), set())
+
+    def test_values_which_dont_fit(self):
+        store = nvalstore.NVALStore()
+
+        self.assertRaises(ValueError, store.__setitem__, TIME_FORMAT, 256)
+        self.assertRaises(ValueError, store.__setitem__, APP_TIMEOUT, -1)
+        self.assertRaises(ValueError, store.write, APP_TIMEOUT, b'\x01')
+
+        self.assertEqual(store[APP_TIMEOUT], 600)
+
+    def test_mark_dirty(self):
+        store = nvalstore.NVALStore()
+        store.mark_dirty(APP_TIMEOUT)
+
+        self.assertEqual(store.take_changes(), set([APP_TIMEOUT]))
+        self.assertEqual(store[APP_TIMEOUT], 600)
+        self.assertRaises(KeyError, store.mark_dirty, 0x0004)
+
+    def test_write_and_reset(self):
+        store = nvalstore.NVALStore()
+        store.write(APP_TIMEOUT, b'\x10\x00')
+        self.assertEqual(store[APP_TIMEOUT], 16)
+
+        store.reset()
+        self.assertEqual(store[APP_TIMEOUT], 600)
+        self.assertEqual(store.take_changes(), set(nvalstore.IDENTIFIERS))
+
+
+class MappedNVALStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'nvals')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_values_survive_reopening(self):
+        store = nvalstore.MappedNVALStore(self.path)
+        self.assertTrue(store.initialized)
+
+        store[APP_TIMEOUT] = 42
+        store.close()
+
+        store = nvalstore.MappedNVALStore(self.path)
+        self.assertFalse(store.initialized)
+        self.assertEqual(store[APP_TIMEOUT], 42)
+        store.close()
+
+    def test_other_layout_is_reinitialized(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\xff' * (len(nvalstore.DEFAULTS) + 8))
+
+        store = nvalstore.MappedNVALStore(self.path)
+        self.assertTrue(store.initialized)
+        self.assertEqual(store[APP_TIMEOUT], 600)
+        store.close()
+
+
+class NvalMessageTest(unittest.TestCase):
+    def setUp(self):
+        self.factory = RecordingFactory()
+        self.simulator = WatchSimulator(self.factory, VirtualClock())
+
+    def nval(self, operation, identifier, size, data=b''):
+        self.simulator.parse(build('nval', operation, bytearray(
+            struct.pack('<HB', identifier, size) + data)))
+
+        response = bytearray(self.factory.messages.pop())
+        self.assertEqual(HEADER.unpack_from(bytes(response))[0],
+                         const.MESSAGE_TYPES_LOOKUP['nvalResponse'])
+
+        # result, identifier, size, value
+        return response[3], bytes(response[7:-2])
+
+    def test_read(self):
+        self.assertEqual(self.nval(const.NVAL_READ, APP_TIMEOUT, 2),
+                         (const.NVAL_SUCCESS, struct.pack('<H', 600)))
+
+    def test_write(self):
+        self.assertEqual(self.nval(const.NVAL_WRITE, APP_TIMEOUT, 2,
+                                   struct.pack('<H', 30)),
+                         (const.NVAL_SUCCESS, b''))
+        self.assertEqual(self.simulator.state.nvals[APP_TIMEOUT], 30)
+
+        # The new timeout is used for the application buffer
+        self.simulator.parse(build('updateLCD', const.MODE_APP))
+        self.simulator.clock.advance(29)
+        self.assertEqual(self.simulator.active_buffer, const.MODE_APP)
+        self.simulator.clock.advance(31)
+        self.assertEqual(self.simulator.active_buffer, const.MODE_IDLE)
+
+    def test_unknown_value(self):
+        self.assertEqual(self.nval(const.NVAL_READ, 0x0004, 2)[0],
+                         const.NVAL_FAILURE)
+        self.assertEqual(self.nval(const.NVAL_READ, APP_TIMEOUT, 1)[0],
+                         const.NVAL_FAILURE)
+
+    def test_kept_on_reset(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        store = nvalstore.MappedNVALStore(os.path.join(directory, 'nvals'))
+        simulator = WatchSimulator(self.factory, VirtualClock(), store)
+        simulator.set_nval(TIME_FORMAT, 1)
+        simulator.reset()
+
+        self.assertEqual(simulator.state.nvals[TIME_FORMAT], 1)
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""Tests of the CRC engines and the frame reassembler."""
+
+import random
+import unittest
+
+import crc
+import protocol_constants as const
+
+from protocol import FrameReassembler, MetaProtocolParser, \
+    MetaProtocolFactory
+from support import build
+
+
+def frames():
+    """A few valid frames, of the shortest and the longest kind."""
+    return [
+        build('getDeviceType'),
+        build('writeLCD', const.MODE_APP,
+              bytearray([0]) + bytearray(range(12)) +
+              bytearray([1]) + bytearray(range(12, 24))),
+        build('setLED', const.OPTION_LED_ON),
+    ]
+
+
+class CRCTest(unittest.TestCase):
+    def test_fast_crc_matches_reference(self):
+        rnd = random.Random(1)
+        reference = crc.CRC_CCITT()
+        fast = crc.FastCRC_CCITT()
+
+        for length in xrange(0, 40):
+            data = bytes(bytearray(rnd.getrandbits(8)
+                                   for _ in xrange(length)))
+            self.assertEqual(fast.checksum(data), reference.checksum(data))
+
+    def test_known_frame(self):
+        # getDeviceType, as sent by MetaWatchManager
+        self.assertEqual(build('getDeviceType'), b'\x01\x06\x01\x00\x0b\xd9')
+
+
+class FrameReassemblerTest(unittest.TestCase):
+    def reassemble(self, *chunks):
+        framer = FrameReassembler()
+        result = []
+
+        for chunk in chunks:
+            framer.feed(chunk)
+            result.extend(frame.tobytes() for frame in framer)
+
+        return framer, result
+
+    def test_frames(self):
+        framer, result = self.reassemble(b''.join(frames()))
+        self.assertEqual(result, frames())
+        self.assertEqual(framer.frames, 3)
+        self.assertEqual(len(framer), 0)
+
+    def test_split_frames(self):
+        stream = b''.join(frames())
+
+        for size in (1, 2, 3, 5, 7, 31):
+            chunks = [stream[i:i + size] for i in xrange(0, len(stream), size)]
+            framer, result = self.reassemble(*chunks)
+            self.assertEqual(result, frames(), "chunk size %d" % size)
+            self.assertEqual(len(framer), 0)
+
+    def test_garbage(self):
+        framer, result = self.reassemble(
+            b'\xff\x00garbage' + frames()[0] + b'\x13\x37' + frames()[1])
+
+        self.assertEqual(result, frames()[:2])
+        self.assertEqual(framer.garbage, 11)
+        self.assertEqual(len(framer), 0)
+
+    def test_trailing_garbage_is_dropped(self):
+        framer, result = self.reassemble(frames()[0] + b'\xff\xfe')
+        self.assertEqual(result, frames()[:1])
+        self.assertEqual(len(framer), 0)
+
+    def test_too_short_length(self):
+        framer, result = self.reassemble(b'\x01\x02' + b''.join(frames()))
+        self.assertEqual(result, frames())
+        self.assertEqual(framer.dropped, 1)
+
+    def test_too_long_length(self):
+        framer, result = self.reassemble(b'\x01\xff' + b''.join(frames()))
+
+        self.assertEqual(result, frames())
+        self.assertEqual(framer.dropped, 1)
+        self.assertEqual(len(framer), 0)
+
+    def test_longest_frame(self):
+        self.assertEqual(len(frames()[1]), FrameReassembler.MAX_LENGTH)
+
+    def test_corrupted_frame(self):
+        corrupted = bytearray(frames()[0])
+        corrupted[-1] ^= 0xff
+
+        framer, result = self.reassemble(bytes(corrupted) + frames()[2])
+        self.assertEqual(result, frames()[2:])
+        self.assertEqual(framer.corrupted, 1)
+
+    def test_incomplete_frame_waits(self):
+        frame = frames()[1]
+        framer, result = self.reassemble(frame[:20])
+
+        self.assertEqual(result, [])
+        self.assertEqual(len(framer), 20)
+
+        framer.feed(frame[20:])
+        self.assertEqual([f.tobytes() for f in framer], [frame])
+
+    def test_buffer_grows(self):
+        stream = b''.join(frames()) * 50
+        framer = FrameReassembler(capacity=16)
+        framer.feed(stream)
+
+        self.assertEqual(len(list(framer)), 150)
+
+    def test_stray_start_byte(self):
+        # A plausible length, but only a short frame follows: it isn't
+        # held back until 30 bytes have arrived
+        framer, result = self.reassemble(b'\x01\x1e' + frames()[0])
+
+        self.assertEqual(result, frames()[:1])
+        self.assertEqual(framer.dropped, 1)
+        self.assertEqual(len(framer), 0)
+
+    def test_stray_start_byte_on_a_quiet_link(self):
+        framer = FrameReassembler()
+        framer.feed(b'\x01\x1e\x00')
+        self.assertEqual(list(framer), [])
+
+        frame = frames()[2]
+
+        for i in xrange(len(frame) - 1):
+            framer.feed(frame[i])
+            self.assertEqual(list(framer), [])
+
+        framer.feed(frame[-1])
+        self.assertEqual([f.tobytes() for f in framer], [frame])
+        self.assertEqual(framer.garbage, 3)
+
+
+class HandlerTableTest(unittest.TestCase):
+    def test_shared_by_instances(self):
+        self.assertIs(MetaProtocolParser().handlers,
+                      MetaProtocolParser().handlers)
+        self.assertIs(MetaProtocolParser.__dict__['_handlers'],
+                      MetaProtocolParser().handlers)
+
+    def test_subclass_overrides(self):
+        # The table of the parent is built first, so the subclass would
+        # find it as an inherited attribute
+        parent = MetaProtocolParser()
+
+        class Parser(MetaProtocolParser):
+            def handle_setLED(self, msgtype, option_bits, payload):
+                return 'overridden'
+
+        class Subparser(Parser):
+            pass
+
+        parser = Parser()
+        setLED = const.MESSAGE_TYPES_LOOKUP['setLED']
+
+        self.assertIsNot(parser.handlers, parent.handlers)
+        self.assertIn('_handlers', Parser.__dict__)
+        self.assertEqual(parser.dispatch(build('setLED', 1)), 'overridden')
+        self.assertNotEqual(parent.dispatch(build('setLED', 1)), 'overridden')
+
+        # Inherited overrides, in a table of its own
+        subparser = Subparser()
+        self.assertIsNot(subparser.handlers, parser.handlers)
+        self.assertIs(subparser.handlers[setLED], parser.handlers[setLED])
+
+    def test_unknown_message_types(self):
+        parser = MetaProtocolParser()
+
+        # Documented but not handled, and undocumented
+        self.assertRaises(NotImplementedError, parser.dispatch,
+                          build('getInfo'))
+        self.assertRaises(NotImplementedError, parser.handle, 0xff, 0, b'')
+
+        class Parser(MetaProtocolParser):
+            def _not_implemented(self, msgtype, option_bits, payload):
+                return msgtype
+
+        self.assertEqual(Parser().handle(0xff, 0, b''), 0xff)
+        self.assertEqual(Parser().dispatch(build('getInfo')),
+                         const.MESSAGE_TYPES_LOOKUP['getInfo'])
+
+
+
+class PrebuiltFramesTest(unittest.TestCase):
+    """The prebuilt frames have to be the same as the ones composed when
+    they are needed."""
+
+    def setUp(self):
+        self.factory = MetaProtocolFactory()
+
+    def test_button_events(self):
+        frames = MetaProtocolFactory.send_buttonEvent.frames
+        self.assertEqual(len(frames), len(const.BUTTON_ALPHA) * 256)
+
+        for btn in const.BUTTON_ALPHA:
+            payload = bytearray((1 << const.BUTTON_IDS[btn], ))
+
+            for cb_data in xrange(256):
+                frame = build('buttonEvent', cb_data, payload)
+
+                self.assertIsInstance(frames[btn, cb_data], bytes)
+                self.assertEqual(frames[btn, cb_data], frame)
+                self.assertEqual(
+                    self.factory.send_buttonEvent(btn, cb_data), frame)
+                self.assertEqual(
+                    self.factory.compose_buttonEvent(btn, cb_data), frame)
+
+    def test_device_type_response(self):
+        frames = MetaProtocolFactory.send_getDeviceTypeResponse.frames
+        self.assertEqual(len(frames), 4)
+
+        for (device_type, ), frame in frames.iteritems():
+            self.assertEqual(frame, build('getDeviceTypeResponse', 0,
+                                          bytearray((device_type, ))))
+            self.assertEqual(
+                self.factory.send_getDeviceTypeResponse(device_type), frame)
+
+        # The payload is the device type, a single byte
+        frame = bytearray(self.factory.send_getDeviceTypeResponse(
+            const.DEVICE_TYPE_DIGITAL))
+        self.assertEqual(frame[1], 7)
+        self.assertEqual(frame[4], const.DEVICE_TYPE_DIGITAL)
+
+    def test_arguments_which_are_not_prebuilt(self):
+        self.assertEqual(self.factory.send_getDeviceTypeResponse(9),
+                         build('getDeviceTypeResponse', 0, bytearray((9, ))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""Tests of the write queue and the select() based serial I/O loop."""
+
+import os
+import tty
+import fcntl
+import time
+import Queue
+import select
+import unittest
+import threading
+
+import serialio
+
+
+class WriteQueueTest(unittest.TestCase):
+    def test_drain(self):
+        queue = serialio.WriteQueue()
+
+        for i in xrange(3):
+            queue.put(b'%d' % i * 4)
+
+        self.assertEqual(queue.drain(), b'000011112222')
+        self.assertEqual(queue.drain(), b'')
+        self.assertEqual((queue.frames, queue.bytes), (3, 12))
+
+    def test_drain_limit(self):
+        queue = serialio.WriteQueue()
+        wakeup = queue.fileno()
+
+        for i in xrange(4):
+            queue.put(b'%d' % i * 4)
+
+        self.assertEqual(queue.drain(6), b'00001111')
+
+        # The rest is signalled again
+        self.assertEqual(select.select([wakeup], [], [], 0)[0], [wakeup])
+        self.assertEqual(queue.drain(6), b'22223333')
+        self.assertEqual(select.select([wakeup], [], [], 0)[0], [])
+
+    def test_bounded(self):
+        queue = serialio.WriteQueue(maxsize=2)
+        queue.put(b'a')
+        queue.put(b'b')
+
+        self.assertRaises(Queue.Full, queue.put, b'c', timeout=0.01)
+
+
+class SerialIOLoopTest(unittest.TestCase):
+    FRAME = bytes(bytearray(xrange(32)))
+
+    def setUp(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+
+        self.queue = serialio.WriteQueue()
+        self.received = []
+        self.loop = serialio.SerialIOLoop(self.master, self.queue,
+                                          self.received.append,
+                                          pending_limit=256)
+
+        self.alive = threading.Event()
+        self.alive.set()
+        self.thread = threading.Thread(target=self.loop.run,
+                                       args=(self.alive, ))
+        self.thread.start()
+
+    def tearDown(self):
+        self.alive.clear()
+        self.queue.wakeup()
+        self.thread.join(5)
+
+        os.close(self.master)
+        os.close(self.slave)
+
+    def read_slave(self, size, timeout=5):
+        data = b''
+        deadline = time.time() + timeout
+
+        while len(data) < size and time.time() < deadline:
+            if select.select([self.slave], [], [], 0.1)[0]:
+                data += os.read(self.slave, size - len(data))
+
+        return data
+
+    def test_write_and_read(self):
+        self.queue.put(self.FRAME)
+        self.assertEqual(self.read_slave(32), self.FRAME)
+
+        os.write(self.slave, b'hello')
+        deadline = time.time() + 5
+
+        while not self.received and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(b''.join(self.received), b'hello')
+
+    def test_on_write(self):
+        written = []
+        self.loop.on_write = written.append
+
+        self.queue.put(self.FRAME)
+        self.queue.put(self.FRAME)
+        self.assertEqual(self.read_slave(64), self.FRAME * 2)
+
+        # The callback runs right after the write
+        deadline = time.time() + 5
+
+        while sum(written) < 64 and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(sum(written), 64)
+
+    def test_backpressure(self):
+        # Nobody reads the other end: once the terminal is full, the
+        # messages have to stay in the bounded queue
+        sent = 0
+
+        try:
+            while sent < 100000:
+                self.queue.put(self.FRAME, timeout=0.2)
+                sent += 1
+        except Queue.Full:
+            pass
+
+        self.assertLess(sent, 100000)
+        self.assertLessEqual(len(self.loop.pending), 256 + len(self.FRAME))
+        self.assertEqual(self.queue.qsize(), serialio.WRITE_QUEUE_SIZE)
+
+        # Everything arrives, in order
+        data = self.read_slave(sent * len(self.FRAME))
+        self.assertEqual(data, self.FRAME * sent)
+
+    def test_stop_while_backed_up(self):
+        # The terminal is full, more is queued than the loop takes
+        try:
+            while True:
+                self.queue.put(self.FRAME, timeout=0.2)
+        except Queue.Full:
+            pass
+
+        started = time.time()
+        self.alive.clear()
+        self.queue.wakeup()
+        self.thread.join(5)
+
+        self.assertLess(time.time() - started,
+                        serialio.SerialIOLoop.TIMEOUT / 2)
+
+    def test_flags_restored(self):
+        self.alive.clear()
+        self.queue.wakeup()
+        self.thread.join(5)
+
+        self.assertFalse(fcntl.fcntl(self.master, fcntl.F_GETFL) &
+                         os.O_NONBLOCK)
+
+
+if __name__ == '__main__':
+    unittest.main()
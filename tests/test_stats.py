@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""Tests of the statistics: histograms and response latencies."""
+
+import json
+import time
+import unittest
+
+import latency
+import protocol_constants as const
+
+from clock import VirtualClock
+from stats import Histogram
+from capture import ReplayFactory
+from simulator import WatchSimulator
+from support import build
+
+DEVICE_TYPE_RESPONSE = const.MESSAGE_TYPES_LOOKUP['getDeviceTypeResponse']
+
+
+class HistogramTest(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = Histogram()
+
+        for value in [0.001] * 90 + [0.1] * 10:
+            histogram.record(value)
+
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.percentile(0.5), 0.001)
+        self.assertEqual(histogram.percentile(0.99), 0.1)
+        self.assertEqual(histogram.max, 0.1)
+
+    def test_empty(self):
+        self.assertEqual(Histogram().snapshot()['p99'], 0.0)
+
+
+class ResponseLatencyTest(unittest.TestCase):
+    def simulator(self, clock):
+        simulator = WatchSimulator(ReplayFactory(), clock)
+        return simulator, simulator.enable_stats()
+
+    def response_time(self, stats):
+        return stats.responses[DEVICE_TYPE_RESPONSE].max
+
+    def test_from_receive_time(self):
+        simulator, stats = self.simulator(None)
+
+        # The request waited in a receive batch for 200 msecs (like on
+        # the serial thread of the GUI, or in a transport)
+        stats.received(6, time.time() - 0.2)
+        simulator.dispatch(build('getDeviceType'))
+
+        self.assertGreaterEqual(self.response_time(stats), 0.2)
+        self.assertLess(self.response_time(stats), 5.0)
+
+    def test_virtual_time(self):
+        simulator, stats = self.simulator(VirtualClock(100.0))
+        simulator.latency = latency.FixedLatency(2.0)
+
+        stats.received(6, time.time() - 0.2)
+        simulator.dispatch(build('getDeviceType'))
+        self.assertEqual(stats.responses[DEVICE_TYPE_RESPONSE].count, 0)
+
+        simulator.clock.advance(110.0)
+
+        self.assertGreaterEqual(self.response_time(stats), 2.2)
+        self.assertLess(self.response_time(stats), 7.0)
+
+    def test_button_press(self):
+        simulator, stats = self.simulator(VirtualClock(100.0))
+        simulator.latency = latency.FixedLatency(0.5)
+        simulator.parse(build('enableButton', 0,
+                              bytearray((0, 0, 0, 0x34, 1))))
+
+        simulator.press_button('A', 0)
+        simulator.clock.advance(101.0)
+
+        histogram = stats.responses[const.MESSAGE_TYPES_LOOKUP['buttonEvent']]
+        self.assertEqual(histogram.count, 1)
+        self.assertAlmostEqual(histogram.max, 0.5, places=2)
+
+    def test_reordered_responses(self):
+        """With jitter, a later request can be answered first; every
+        response is still measured from its own request."""
+
+        simulator, stats = self.simulator(VirtualClock(100.0))
+        simulator.latency = latency.ReplayedLatency([2.0, 0.5])
+
+        simulator.dispatch(build('getDeviceType'))
+        simulator.clock.advance(101.0)
+        simulator.dispatch(build('getDeviceType'))
+        simulator.clock.advance(110.0)
+
+        histogram = stats.responses[DEVICE_TYPE_RESPONSE]
+        self.assertEqual(histogram.count, 2)
+        self.assertAlmostEqual(histogram.max, 2.0, places=3)
+        self.assertAlmostEqual(histogram.total, 2.5, places=3)
+
+    def test_deferred(self):
+        """Responses count as sent when they are written."""
+
+        simulator, stats = self.simulator(None)
+        stats.deferred = True
+
+        stats.received(6, time.time())
+        simulator.dispatch(build('getDeviceType'))
+        simulator.dispatch(build('getDeviceType'))
+
+        histogram = stats.responses[DEVICE_TYPE_RESPONSE]
+        self.assertEqual(stats.tx_frames[DEVICE_TYPE_RESPONSE], 2)
+        self.assertEqual(histogram.count, 0)
+
+        # The frames have 7 bytes each
+        stats.written(5)
+        self.assertEqual(histogram.count, 0)
+
+        # Time spent in the write queue counts
+        time.sleep(0.05)
+
+        stats.written(5)
+        self.assertEqual(histogram.count, 1)
+        self.assertGreaterEqual(histogram.max, 0.05)
+        self.assertGreaterEqual(stats.request_to_response.max, 0.05)
+
+        stats.written(4)
+        self.assertEqual(histogram.count, 2)
+        self.assertEqual(len(stats.unwritten), 0)
+
+    def test_unsent(self):
+        simulator, stats = self.simulator(None)
+        stats.deferred = True
+
+        simulator.dispatch(build('getDeviceType'))
+        stats.unsent()
+
+        self.assertEqual(stats.tx_frames[DEVICE_TYPE_RESPONSE], 0)
+        self.assertEqual(stats.bytes_out, 0)
+
+        # Written bytes of frames sent before are ignored
+        stats.written(7)
+        simulator.dispatch(build('getDeviceType'))
+        stats.written(7)
+        self.assertEqual(stats.responses[DEVICE_TYPE_RESPONSE].count, 1)
+
+    def test_json(self):
+        simulator, stats = self.simulator(None)
+        simulator.parse(build('getDeviceType'))
+
+        snapshot = json.loads(stats.to_json())
+        self.assertEqual(snapshot['tx']['by_type'],
+                         {'getDeviceTypeResponse': 1})
+        self.assertEqual(snapshot['rx']['by_type'], {'getDeviceType': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
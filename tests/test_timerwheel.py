@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""Tests of the clocks and the timer wheel."""
+
+import random
+import unittest
+
+from clock import VirtualClock
+from timerwheel import TimerWheel, TICK, SLOTS
+
+
+class VirtualClockTest(unittest.TestCase):
+    def test_timers_run_in_order_at_their_deadline(self):
+        clock = VirtualClock(10.0)
+        calls = []
+
+        for delay in (3, 1, 2):
+            clock.call_later(delay, lambda: calls.append(clock.time()))
+
+        clock.call_later(1.5, calls.append, 'cancelled').cancel()
+        clock.advance(12.5)
+
+        self.assertEqual(calls, [11.0, 12.0])
+        self.assertEqual(clock.time(), 12.5)
+        self.assertAlmostEqual(clock.next_timeout(), 0.5)
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock(1000.0)
+        self.wheel = TimerWheel(self.clock)
+        self.calls = []
+
+    def record(self, name):
+        self.calls.append((name, round(self.clock.time(), 3)))
+
+    def test_order(self):
+        for name, delay in (('c', 0.3), ('a', 0.5), ('r', 2.0), ('seven', 7)):
+            self.wheel.call_later(delay, self.record, name)
+
+        self.clock.advance(1010.0)
+
+        self.assertEqual(self.calls, [('c', 1000.3), ('a', 1000.5),
+                                      ('r', 1002.0), ('seven', 1007.0)])
+        self.assertEqual(self.wheel.count, 0)
+
+    def test_one_timer_on_the_clock(self):
+        for i in xrange(100):
+            self.wheel.call_later(i * 0.1 + 1, self.record, i)
+
+        self.assertEqual(len(self.clock.timers), 1)
+
+    def test_random_timers(self):
+        rnd = random.Random(3)
+        expected = []
+
+        for i in xrange(2000):
+            delay = rnd.uniform(0, 3 * SLOTS * TICK)
+            expected.append((delay, i))
+            self.wheel.call_later(delay, self.calls.append, i)
+
+        self.clock.advance(1000.0 + 4 * SLOTS * TICK)
+
+        # Ordered by tick; timers of the same tick in scheduling order
+        ticks = sorted((int(-(-delay // TICK)), i) for delay, i in expected)
+        self.assertEqual(self.calls, [i for tick, i in ticks])
+
+    def test_cancel(self):
+        timer = self.wheel.call_later(1.0, self.record, 'cancelled')
+        self.wheel.call_later(2.0, self.record, 'kept')
+
+        timer.cancel()
+        self.assertFalse(timer.pending)
+
+        self.clock.advance(1005.0)
+        self.assertEqual(self.calls, [('kept', 1002.0)])
+
+    def test_empty_slots_are_dropped(self):
+        self.assertEqual(self.wheel.slots, {})
+
+        timers = [self.wheel.call_later(delay, self.record, delay)
+                  for delay in (1.0, 1.0, 2.0, 3.0)]
+        self.assertEqual(len(self.wheel.slots), 3)
+
+        timers[0].cancel()
+        timers[3].cancel()
+        self.assertEqual(len(self.wheel.slots), 2)
+
+        self.clock.advance(1010.0)
+        self.assertEqual(self.wheel.slots, {})
+
+    def test_reschedule_moves_the_timer(self):
+        timer = self.wheel.timer(self.record, 'moved')
+        self.wheel.schedule(timer, 5.0)
+        self.wheel.schedule(timer, 1.0)
+
+        self.clock.advance(1010.0)
+        self.assertEqual(self.calls, [('moved', 1001.0)])
+
+    def test_long_timer(self):
+        self.wheel.call_later(600.0, self.record, 'long')
+        self.clock.advance(1599.0)
+        self.assertEqual(self.calls, [])
+
+        self.clock.advance(1601.0)
+        self.assertEqual(self.calls, [('long', 1600.0)])
+
+    def test_rescheduling_from_callback(self):
+        timer = self.wheel.timer(None)
+
+        def step(left):
+            self.record(left)
+            if left:
+                self.wheel.schedule(timer, 0.1, left - 1)
+
+        timer.func = step
+        self.wheel.schedule(timer, 0.1, 3)
+        self.wheel.call_later(0.25, self.record, 'between')
+
+        self.clock.advance(1001.0)
+
+        self.assertEqual(self.calls, [(3, 1000.1), (2, 1000.2),
+                                      ('between', 1000.25), (1, 1000.3),
+                                      (0, 1000.4)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""Tests of the transports and protocols of the event loop, over socket
+pairs and pseudo-terminals."""
+
+import os
+import errno
+import shutil
+import socket
+import tempfile
+import unittest
+
+import transport
+import protocol_constants as const
+
+from eventloop import EventLoop
+from simulator import WatchSimulator
+from support import build, PtyPeer
+
+
+class RecordingProtocol(transport.Protocol):
+    """Remembers the calls made by its transport. Everything it receives is
+    answered by the given replies (each written with its own call)."""
+
+    def __init__(self, replies=()):
+        self.replies = replies
+        self.transport = None
+        self.received = []
+        self.buffered = []
+        self.eof = False
+        self.lost = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.received.append(data)
+
+        for reply in self.replies:
+            self.transport.write(reply)
+            self.buffered.append(self.transport.get_write_buffer_size())
+
+    def eof_received(self):
+        self.eof = True
+
+    def connection_lost(self, exc):
+        self.lost.append(exc)
+
+
+class FdTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = EventLoop()
+        self.sock, self.peer = socket.socketpair()
+        self.addCleanup(self.peer.close)
+
+    def connect(self, protocol):
+        return transport.FdTransport(self.loop, self.sock.fileno(), protocol,
+                                     on_close=(self.sock.close, ))
+
+    def recv(self, size):
+        """Reads size bytes from the peer, running the loop meanwhile."""
+
+        self.peer.setblocking(False)
+        data = []
+
+        def received():
+            try:
+                while data[-1:] != [b'']:
+                    data.append(self.peer.recv(65536))
+            except socket.error, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+            return sum(len(chunk) for chunk in data) >= size
+
+        self.loop.run_until(received, timeout=5)
+        return b''.join(data)
+
+    def test_writes_are_batched_while_receiving(self):
+        replies = [b'one', b'two', b'three']
+        protocol = RecordingProtocol(replies)
+        self.connect(protocol)
+
+        self.peer.sendall(b'ping')
+        self.loop.run_until(lambda: protocol.received, timeout=5)
+
+        # Nothing is written until the protocol has returned
+        self.assertEqual(protocol.buffered, [3, 6, 11])
+        self.assertEqual(protocol.transport.get_write_buffer_size(), 0)
+        self.assertEqual(self.recv(11), b'onetwothree')
+
+    def test_writes_outside_of_receiving_go_out_at_once(self):
+        protocol = RecordingProtocol()
+        self.connect(protocol)
+
+        protocol.transport.write(b'hello')
+        self.assertEqual(protocol.transport.get_write_buffer_size(), 0)
+        self.assertEqual(self.recv(5), b'hello')
+
+    def test_connection_lost(self):
+        protocol = RecordingProtocol()
+        transport_ = self.connect(protocol)
+
+        self.peer.close()
+        self.loop.run_until(lambda: protocol.lost, timeout=5)
+
+        self.assertTrue(protocol.eof)
+        self.assertEqual(protocol.lost, [None])
+        self.assertIsNone(transport_.fd)
+        self.assertTrue(transport_.is_closing())
+
+        # Writes after closing are dropped
+        transport_.write(b'dropped')
+        self.assertEqual(transport_.get_write_buffer_size(), 0)
+
+    def test_close_flushes_first(self):
+        protocol = RecordingProtocol()
+        transport_ = self.connect(protocol)
+
+        # More than the socket takes at once
+        data = b'x' * (1 << 20)
+        transport_.write(data)
+        self.assertGreater(transport_.get_write_buffer_size(), 0)
+
+        transport_.close()
+        self.assertEqual(protocol.lost, [])
+
+        self.assertEqual(len(self.recv(len(data))), len(data))
+        self.loop.run_until(lambda: protocol.lost, timeout=5)
+        self.assertEqual(protocol.lost, [None])
+
+
+class MetaWatchProtocolTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = EventLoop()
+        self.sock, self.peer = socket.socketpair()
+        self.addCleanup(self.peer.close)
+
+    def connect(self, link):
+        transport.FdTransport(self.loop, self.sock.fileno(), link,
+                              on_close=(self.sock.close, ))
+        return link
+
+    def test_framing(self):
+        link = self.connect(transport.MetaWatchProtocol())
+
+        # Split frames, with garbage and a corrupted frame in between
+        corrupted = bytearray(build('setLED', 1))
+        corrupted[-1] ^= 0xff
+
+        stream = (b'\x00\xff' + build('getDeviceType') + bytes(corrupted) +
+                  build('setVibrate', 0, bytearray(6)) + build('setLED', 1))
+
+        for i in xrange(0, len(stream), 5):
+            self.peer.sendall(stream[i:i + 5])
+            self.loop.run_once(0.1)
+
+        self.loop.run_until(lambda: len(link.messages) >= 3, timeout=5)
+
+        self.assertEqual([(msgtype, option_bits, bytes(payload))
+                          for msgtype, option_bits, payload in link.messages],
+                         [(const.MESSAGE_TYPES_LOOKUP['getDeviceType'], 0,
+                           b''),
+                          (const.MESSAGE_TYPES_LOOKUP['setVibrate'], 0,
+                           b'\x00' * 6),
+                          (const.MESSAGE_TYPES_LOOKUP['setLED'], 1, b'')])
+        self.assertEqual(link.framer.corrupted, 1)
+
+    def test_parser_answers(self):
+        factory = transport.LinkFactory()
+        link = self.connect(transport.MetaWatchProtocol(
+            WatchSimulator(factory, self.loop.clock), factory))
+
+        self.peer.sendall(build('getDeviceType') + build('getInfo'))
+        self.peer.setblocking(False)
+
+        frames = []
+
+        def answered():
+            try:
+                frames.append(self.peer.recv(4096))
+            except socket.error, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            return frames
+
+        self.loop.run_until(answered, timeout=5)
+
+        self.assertEqual(bytearray(frames[0])[2],
+                         const.MESSAGE_TYPES_LOOKUP['getDeviceTypeResponse'])
+
+        # getInfo isn't implemented
+        self.assertEqual(link.errors, 1)
+
+    def test_connection_lost(self):
+        link = self.connect(transport.MetaWatchProtocol())
+        self.assertIsNotNone(link.factory.transport)
+
+        self.peer.close()
+        self.loop.run_until(lambda: link.transport is None, timeout=5)
+
+        self.assertIsNone(link.factory.transport)
+
+        # Messages are dropped while not connected
+        link.factory.send_getDeviceTypeResponse(const.DEVICE_TYPE_DIGITAL)
+
+
+class SerialBridgeTest(unittest.TestCase):
+    def test_bridge(self):
+        """A simulator on a Unix socket answers over the pseudo-terminal
+        which is bridged to it."""
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'watch')
+
+        loop = EventLoop()
+
+        def watch():
+            factory = transport.LinkFactory()
+            return transport.MetaWatchProtocol(
+                WatchSimulator(factory, loop.clock), factory)
+
+        server = transport.create_unix_server(loop, watch, path)
+        self.addCleanup(server.close)
+
+        peer = PtyPeer(transport.create_serial_bridge(loop, path))
+        self.addCleanup(peer.close)
+
+        peer.write(build('getDeviceType'))
+        frames = loop.run_until(peer.poll, timeout=5)
+
+        self.assertEqual(bytearray(frames[0])[2],
+                         const.MESSAGE_TYPES_LOOKUP['getDeviceTypeResponse'])
+
+
+if __name__ == '__main__':
+    unittest.main()
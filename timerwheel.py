@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""
+This module contains the timer wheel of the simulated watch, which runs
+its vibration steps, LED and buffer timeouts and delayed responses.
+
+Time is divided into ticks of TICK seconds. A timer which expires at tick
+t is kept in slot t % SLOTS of the wheel, in a doubly linked list, so
+scheduling and cancelling it costs the same no matter how many timers
+there are. Timers which expire further in the future than one turn of the
+wheel share the slots; they are simply skipped until their turn comes.
+A slot only exists while it holds timers, so an idle wheel (the fleet
+runs one per watch) takes hardly any memory.
+
+The wheel has no thread or event loop of its own: it keeps a single timer
+on the clock it is given (see the clock module), set to the next tick with
+a timer due. So it runs wherever that clock runs its timers, including a
+VirtualClock which is advanced by a test or a replay.
+
+Timers are meant to be reused: whoever has a recurring timeout creates a
+WheelTimer once and schedules it again and again. Scheduling a timer which
+is pending moves it.
+"""
+
+import math
+import itertools
+
+from clock import Clock
+
+# Resolution of the wheel, in seconds
+TICK = 0.01
+
+# Number of slots (a power of two); one turn of the wheel is SLOTS * TICK
+SLOTS = 512
+
+# Up to this many pending timers, the next expiry is found by looking at all
+# of them rather than by scanning the slots
+FEW_TIMERS = 32
+
+
+class WheelTimer(object):
+    """A timer of a TimerWheel, which calls func(*args) when it expires."""
+
+    __slots__ = ('wheel', 'func', 'args', 'expires', 'seq', 'prev', 'next')
+
+    def __init__(self, wheel, func, args):
+        self.wheel = wheel
+        self.func = func
+        self.args = args
+        self.expires = None
+        self.seq = 0
+        self.prev = self.next = None
+
+    @property
+    def pending(self):
+        return self.prev is not None
+
+    def cancel(self):
+        """Stops the timer, if it is pending. It can be scheduled again."""
+        if self.prev is not None:
+            self.wheel._remove(self)
+
+
+class TimerWheel(object):
+    """Hashed timer wheel, driven by a clock."""
+
+    def __init__(self, clock=None, tick=TICK, slots=SLOTS):
+        if slots & (slots - 1):
+            raise ValueError("Number of slots must be a power of two")
+
+        self.clock = clock or Clock()
+        self.tick = tick
+        self.size = slots
+        self.mask = slots - 1
+
+        # Slot index -> sentinel heading a circular list, for the slots
+        # which hold timers
+        self.slots = {}
+
+        self.count = 0
+        self.pending = set()
+        self.current = self._tick_of(self.clock.time())
+        self._next_seq = itertools.count().next
+
+        self._driver = None
+        self._driver_tick = None
+        self._running = False
+
+    def _tick_of(self, when):
+        return int(math.floor(when / self.tick + 1e-6))
+
+    def timer(self, func, *args):
+        """Returns a new timer which isn't scheduled yet."""
+        return WheelTimer(self, func, args)
+
+    def schedule(self, timer, delay, *args):
+        """Schedules (or moves) a timer to expire after delay seconds. If
+        args are given, they replace the arguments of the timer."""
+
+        if timer.prev is not None:
+            self._remove(timer)
+
+        if args:
+            timer.args = args
+
+        now = self.clock.time()
+
+        if not self.count:
+            self.current = max(self.current, self._tick_of(now))
+
+        # Rounded up to the next tick
+        expires = int((now + delay) / self.tick - 1e-6) + 1
+
+        if expires <= self.current:
+            expires = self.current + 1
+
+        timer.expires = expires
+        timer.seq = self._next_seq()
+
+        # Append to the slot, so timers of the same tick run in order
+        index = expires & self.mask
+        sentinel = self.slots.get(index)
+
+        if sentinel is None:
+            sentinel = self.slots[index] = WheelTimer(None, None, None)
+            sentinel.prev = sentinel.next = sentinel
+
+        timer.prev = sentinel.prev
+        timer.next = sentinel
+        sentinel.prev.next = timer
+        sentinel.prev = timer
+
+        self.count += 1
+        self.pending.add(timer)
+
+        # While timers are run, the driver is set afterwards
+        if not self._running and (self._driver is None or
+                                  expires < self._driver_tick):
+            self._arm(expires)
+
+        return timer
+
+    def call_later(self, delay, func, *args):
+        """Calls func(*args) after delay seconds, like Clock.call_later.
+        Returns the timer, which can be cancelled."""
+        return self.schedule(WheelTimer(self, func, args), delay)
+
+    def _remove(self, timer):
+        # The driver is left alone: if there is nothing to do when it
+        # fires, it is set again (or not at all)
+        prev = timer.prev
+        prev.next = timer.next
+        timer.next.prev = prev
+        timer.prev = timer.next = None
+
+        # Only the sentinel is left: the slot is dropped
+        if prev.next is prev:
+            del self.slots[timer.expires & self.mask]
+
+        self.count -= 1
+        self.pending.discard(timer)
+
+    def _arm(self, expires):
+        if self._driver is not None:
+            self._driver.cancel()
+
+        self._driver_tick = expires
+        self._driver = self.clock.call_later(
+            max(0, expires * self.tick - self.clock.time()), self._run)
+
+    def _next_expiry(self):
+        """Returns the tick at which the next timer expires."""
+
+        if self.count <= FEW_TIMERS:
+            return min(timer.expires for timer in self.pending)
+
+        slots = self.slots
+        mask = self.mask
+
+        for tick in xrange(self.current + 1, self.current + 1 + self.size):
+            sentinel = slots.get(tick & mask)
+
+            if sentinel is None:
+                continue
+
+            timer = sentinel.next
+
+            while timer is not sentinel:
+                if timer.expires <= tick:
+                    return tick
+                timer = timer.next
+
+        return min(timer.expires for timer in self.pending)
+
+    def _run(self):
+        """Runs all timers which have expired, in the order of their
+        expiry (and scheduling)."""
+
+        self._driver = self._driver_tick = None
+
+        if not self.count:
+            return
+
+        now = self._tick_of(self.clock.time())
+
+        if now <= self.current:
+            # Woken up early
+            self._arm(self._next_expiry())
+            return
+
+        slots = self.slots
+        mask = self.mask
+        due = []
+
+        # A slot holds the timers of every turn of the wheel, so no slot
+        # has to be visited twice
+        for tick in xrange(self.current + 1,
+                           min(now, self.current + self.size) + 1):
+            sentinel = slots.get(tick & mask)
+
+            if sentinel is None:
+                continue
+
+            timer = sentinel.next
+
+            while timer is not sentinel:
+                following = timer.next
+
+                if timer.expires <= now:
+                    due.append(timer)
+
+                timer = following
+
+        self.current = now
+
+        if len(due) > 1:
+            due.sort(key=lambda timer: (timer.expires, timer.seq))
+
+        self._running = True
+
+        try:
+            for timer in due:
+                # Callbacks may have cancelled or moved the timer
+                if timer.prev is None or timer.expires > now:
+                    continue
+
+                self._remove(timer)
+                timer.func(*timer.args)
+        finally:
+            self._running = False
+
+            if self.count:
+                self._arm(self._next_expiry())
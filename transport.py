@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#   Copyright (c) 2012 Leopold Schabel
+#   This file is part of MetaWatch Simulator.
+#
+#   This software is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the
+#   Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+
+"""
+This module contains transports and protocols for the event loop, modelled
+after asyncio: a transport moves bytes between a file descriptor and a
+protocol, a protocol reacts to connection_made(), data_received() and
+connection_lost() and writes using transport.write(), which never blocks.
+
+Transports can be opened on serial ports, pseudo-terminals and TCP or Unix
+sockets. MetaWatchProtocol speaks the MetaWatch protocol over any of them,
+either handling messages with a parser (like a WatchSimulator) or queuing
+them for the application.
+
+Run as a script, it bridges a pseudo-terminal to a TCP or Unix socket, so
+software which only knows serial ports can talk to a simulator listening
+on a socket (fleet.py --tcp):
+
+    python transport.py localhost:7000 --link /tmp/watch
+
+"""
+
+import os
+import sys
+import tty
+import errno
+import socket
+import logging
+import argparse
+import collections
+
+import protocol
+
+from protocol import MetaProtocolFactory, BaseProtocolParser, FrameReassembler
+from eventloop import EventLoop
+from serialio import set_nonblocking
+
+
+class Protocol(object):
+    """Interface for protocols. All methods are called by the transport."""
+
+    def connection_made(self, transport):
+        """The transport is connected and ready."""
+
+    def data_received(self, data):
+        """Some data has been received."""
+
+    def eof_received(self):
+        """The other side closed the connection; connection_lost()
+        follows."""
+
+    def connection_lost(self, exc):
+        """The transport is closed. exc is None or the error which closed
+        it."""
+
+
+class FdTransport(object):
+    """Transport on a non-blocking file descriptor (serial port,
+    pseudo-terminal master or socket).
+
+    Writes made while the protocol handles received data are buffered and
+    written with a single call afterwards; everything which doesn't fit
+    into the kernel buffer is written once the descriptor becomes writable
+    again. The functions in on_close are called when the transport is
+    closed, and have to close the descriptor."""
+
+    READ_SIZE = 4096
+
+    def __init__(self, loop, fd, protocol, extra=None, on_close=()):
+        self.loop = loop
+        self.fd = fd
+        self.protocol = protocol
+
+        self._extra = extra or {}
+        self._on_close = on_close
+        self._buffer = bytearray()
+        self._receiving = False
+        self._writing = False
+        self._closing = False
+        self._paused = False
+
+        set_nonblocking(fd)
+
+        loop.add_reader(fd, self._on_readable)
+        protocol.connection_made(self)
+
+    def get_extra_info(self, name, default=None):
+        return self._extra.get(name, default)
+
+    def is_closing(self):
+        return self._closing
+
+    def pause_reading(self):
+        if not self._paused and not self._closing:
+            self._paused = True
+            self.loop.remove_reader(self.fd)
+
+    def resume_reading(self):
+        if self._paused and not self._closing:
+            self._paused = False
+            self.loop.add_reader(self.fd, self._on_readable)
+
+    def get_write_buffer_size(self):
+        return len(self._buffer)
+
+    def write(self, data):
+        if self._closing:
+            return
+
+        self._buffer.extend(data)
+
+        if not self._receiving:
+            self._flush()
+
+    def writelines(self, lines):
+        self.write(b''.join(lines))
+
+    def close(self):
+        """Closes the transport after the write buffer has been flushed."""
+
+        if self._closing:
+            return
+
+        self._closing = True
+        self.loop.remove_reader(self.fd)
+
+        if not self._buffer:
+            self._close(None)
+
+    def abort(self):
+        """Closes the transport at once, dropping buffered data."""
+        del self._buffer[:]
+        self._close(None)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.fd, self.READ_SIZE)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return
+            if e.errno != errno.EIO:
+                self._close(e)
+                return
+            # EIO: the other side of a pseudo-terminal or serial link is gone
+            data = b''
+
+        if not data:
+            self.protocol.eof_received()
+            self._close(None)
+            return
+
+        self._receiving = True
+
+        try:
+            self.protocol.data_received(data)
+        finally:
+            self._receiving = False
+
+        if self._buffer and self.fd is not None:
+            self._flush()
+
+    def _flush(self):
+        try:
+            written = os.write(self.fd, self._buffer)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                self._close(e)
+                return
+            written = 0
+
+        del self._buffer[:written]
+
+        if self._buffer and not self._writing:
+            self.loop.add_writer(self.fd, self._flush)
+            self._writing = True
+        elif not self._buffer:
+            if self._writing:
+                self.loop.remove_writer(self.fd)
+                self._writing = False
+            if self._closing:
+                self._close(None)
+
+    def _close(self, exc):
+        if self.fd is None:
+            return
+
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+
+        self._closing = True
+        self.fd = None
+
+        for func in self._on_close:
+            func()
+
+        self.protocol.connection_lost(exc)
+
+
+class Server(object):
+    """Accepts connections on a listening socket and creates a transport
+    and a protocol (by calling protocol_factory) for each of them."""
+
+    def __init__(self, loop, sock, protocol_factory):
+        self.loop = loop
+        self.sock = sock
+        self.protocol_factory = protocol_factory
+        self.logger = logging.getLogger('transport')
+
+        sock.setblocking(False)
+        loop.add_reader(sock.fileno(), self._accept)
+
+    def _accept(self):
+        try:
+            connection, address = self.sock.accept()
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.ECONNABORTED):
+                return
+            raise
+
+        if connection.family == socket.AF_INET:
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.logger.debug("Connection from %r", address)
+
+        FdTransport(self.loop, connection.fileno(), self.protocol_factory(),
+                    extra={'socket': connection, 'peername': address},
+                    on_close=(connection.close,))
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+
+def create_server(loop, protocol_factory, host, port, backlog=5):
+    """Listens on a TCP port. Returns a Server."""
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+
+    return Server(loop, sock, protocol_factory)
+
+
+def create_unix_server(loop, protocol_factory, path, backlog=5):
+    """Listens on a Unix socket, replacing a stale one. Returns a Server."""
+
+    if os.path.exists(path):
+        os.unlink(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(backlog)
+
+    return Server(loop, sock, protocol_factory)
+
+
+def create_connection(loop, protocol_factory, address):
+    """Connects to a TCP (host, port) or Unix socket (path) address.
+    Returns (transport, protocol)."""
+
+    if isinstance(address, basestring):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    sock.connect(address)
+
+    protocol = protocol_factory()
+    transport = FdTransport(loop, sock.fileno(), protocol,
+                            extra={'socket': sock, 'peername': address},
+                            on_close=(sock.close,))
+
+    return transport, protocol
+
+
+def open_pty(loop, protocol_factory, link=None):
+    """Creates a pseudo-terminal, attaching the protocol to its master
+    side. The slave side is kept open while the transport lives, so other
+    programs can open and close it as often as they want; its path is
+    available as get_extra_info('name') (and symlinked to link, if given).
+    Returns (transport, protocol)."""
+
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+
+    name = os.ttyname(slave)
+
+    if link:
+        if os.path.lexists(link):
+            os.unlink(link)
+        os.symlink(name, link)
+
+    def close():
+        os.close(master)
+        os.close(slave)
+
+    protocol = protocol_factory()
+    transport = FdTransport(loop, master, protocol,
+                            extra={'name': name, 'link': link},
+                            on_close=(close,))
+
+    return transport, protocol
+
+
+def open_serial(loop, protocol_factory, port, baudrate=115200):
+    """Opens a serial port (using pySerial) and attaches the protocol.
+    Returns (transport, protocol)."""
+
+    import serial
+
+    device = serial.Serial(port, baudrate, timeout=0)
+
+    protocol = protocol_factory()
+    transport = FdTransport(loop, device.fileno(), protocol,
+                            extra={'serial': device, 'name': port},
+                            on_close=(device.close,))
+
+    return transport, protocol
+
+
+class LinkFactory(MetaProtocolFactory):
+    """Writes composed messages to the transport of a link, if connected."""
+
+    def __init__(self):
+        MetaProtocolFactory.__init__(self)
+        self.transport = None
+
+    def _send(self, message):
+        if self.transport is not None:
+            self.transport.write(message)
+        return message
+
+
+class MetaWatchProtocol(Protocol):
+    """The MetaWatch protocol over a transport.
+
+    Received frames are reassembled, checked and passed to
+    message_received() as (msgtype, option_bits, payload). If a parser is
+    given, it handles them (errors are logged and counted), otherwise they
+    are appended to self.messages, where the application picks them up, for
+    example with loop.run_until(lambda: link.messages).
+
+    Messages are sent using the send_* methods of self.factory; while the
+    link is not connected, they are dropped."""
+
+    def __init__(self, parser=None, factory=None):
+        self.transport = None
+        self.parser = parser
+        self.factory = factory or LinkFactory()
+        self.logger = logging.getLogger('transport')
+
+        # A parser brings its own reassembler
+        if parser is not None:
+            self.framer = parser.framer
+        else:
+            self.framer = FrameReassembler(BaseProtocolParser.crc_engine)
+
+        self.messages = collections.deque()
+        self.errors = 0
+
+    def connection_made(self, transport):
+        # A new connection replaces the old one
+        if self.transport is not None:
+            self.transport.abort()
+
+        self.transport = transport
+        self.factory.transport = transport
+        self.framer.reset()
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            self.logger.warning("Connection lost: %s", exc)
+
+        self.transport = None
+        self.factory.transport = None
+
+    def data_received(self, data):
+        if self.parser is not None and self.parser.stats is not None:
+            self.parser.stats.received(len(data))
+
+        self.framer.feed(data)
+
+        # Queued messages must not reference the receive buffer
+        copy = self.parser is None
+
+        for frame in self.framer:
+            self.message_received(*protocol.dissect(frame, copy))
+
+    def message_received(self, msgtype, option_bits, payload):
+        if self.parser is None:
+            self.messages.append((msgtype, option_bits, payload))
+            return
+
+        try:
+            self.parser.handle(msgtype, option_bits, payload)
+        except (NotImplementedError, protocol.ProtocolError, ValueError), e:
+            self.errors += 1
+            self.logger.debug("%s", e)
+
+
+class BridgeProtocol(Protocol):
+    """Forwards everything it receives to the peer transport, and closes it
+    when its own connection is lost."""
+
+    def __init__(self):
+        self.peer = None
+
+    def data_received(self, data):
+        if self.peer is not None:
+            self.peer.write(data)
+
+    def connection_lost(self, exc):
+        if self.peer is not None:
+            self.peer.close()
+            self.peer = None
+
+
+def create_serial_bridge(loop, address, link=None):
+    """Connects a new pseudo-terminal to a TCP or Unix socket address (a
+    virtual null-modem cable). Returns the path of the pseudo-terminal."""
+
+    pty_transport, pty_side = open_pty(loop, BridgeProtocol, link)
+    sock_transport, sock_side = create_connection(loop, BridgeProtocol,
+                                                  address)
+
+    pty_side.peer = sock_transport
+    sock_side.peer = pty_transport
+
+    return pty_transport.get_extra_info('name')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bridges a pseudo-terminal "
+                                     "to a TCP or Unix socket.")
+    parser.add_argument('address', help="HOST:PORT or path of a Unix socket")
+    parser.add_argument('--link', metavar='PATH',
+                        help="create a symlink to the pseudo-terminal")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout,
+                        format="%(levelname)s - %(name)s -> %(message)s",
+                        level=logging.INFO)
+
+    address = args.address
+
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        address = (host, int(port))
+
+    loop = EventLoop()
+    name = create_serial_bridge(loop, address, args.link)
+
+    logging.getLogger('transport').info("Bridging %s to %s", name,
+                                        args.address)
+
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()